@@ -0,0 +1,302 @@
+import argparse
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, TypedDict
+
+from mpip_libs import runtime_env, database
+from mpip_libs.database import LVENPairingKey, LVENAgent
+
+parser = argparse.ArgumentParser(description='Illumio MPIP BENCHMARK')
+sub_parsers = parser.add_subparsers(dest='benchmark', required=True)
+
+sub_parser_load = sub_parsers.add_parser('load', help='Simulate agents pairing, heartbeating and polling active policies against the API server with a fake PCE')
+sub_parser_load.add_argument('--agents', type=int, default=200, help='Number of agents to simulate')
+sub_parser_load.add_argument('--concurrency', type=int, default=16, help='Number of concurrent requests')
+sub_parser_load.add_argument('--heartbeats', type=int, default=5, help='Heartbeats sent by each agent')
+sub_parser_load.add_argument('--policy-polls', type=int, default=2, help='Active policies requests sent by each agent')
+sub_parser_load.add_argument('--pce-latency-ms', type=float, default=50, help='Simulated latency of each PCE API call')
+sub_parser_load.add_argument('--pce-workloads', type=int, default=None, help='Number of unmanaged workloads in the fake PCE, defaults to the number of agents')
+sub_parser_load.add_argument('--pce-rules', type=int, default=50, help='Number of rules in the active policies of each workload')
+sub_parser_load.add_argument('--no-switch', action='store_true', help='Use a pairing key without a target switch')
+sub_parser_load.add_argument('--agent-tokens', action='store_true', help='Agents authenticate with signed tokens instead of their authentication keys')
+
+sub_parser_asgi_load = sub_parsers.add_parser('asgi-load', help='Send concurrent active policies requests to the asgi server app, its native PCE client answered by a fake PCE (needs httpx)')
+sub_parser_asgi_load.add_argument('--agents', type=int, default=1000, help='Number of agents, each one sends a request for its own workload, all at once')
+sub_parser_asgi_load.add_argument('--pce-latency-ms', type=float, default=200, help='Simulated latency of each PCE API call')
+sub_parser_asgi_load.add_argument('--pce-rules', type=int, default=50, help='Number of rules in the active policies of each workload')
+sub_parser_asgi_load.add_argument('--no-pce-limits', action='store_true', help='Disable the PCE rate limit and concurrent calls limit of runtime_env')
+
+sub_parser_cli_startup = sub_parsers.add_parser('cli-startup', help='Measure the wall time of local-only illumio-pip-cli.py subcommands, against an unreachable PCE')
+sub_parser_cli_startup.add_argument('--runs', type=int, default=5, help='Number of runs of each subcommand')
+sub_parser_cli_startup.add_argument('--agents', type=int, default=1000, help='Number of agents in the temporary database')
+
+args = parser.parse_args()
+
+
+class PhaseResult(TypedDict):
+    name: str
+    requests: int
+    errors: int
+    elapsed: float
+    latencies: List[float] # sorted, in seconds
+    pce_calls: int
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    # nearest-rank method
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run_phase(name: str, requests: List[Callable[[object], bool]], concurrency: int, fake_pce) -> PhaseResult:
+    # each request gets the Flask test client of its thread and returns whether it succeeded
+    thread_local = threading.local()
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run_request(request: Callable[[object], bool]):
+        nonlocal errors
+        client = getattr(thread_local, 'client', None)
+        if client is None:
+            client = api_server.app.test_client()
+            thread_local.client = client
+        start_time = time.perf_counter()
+        success = request(client)
+        latency = time.perf_counter() - start_time
+        with lock:
+            latencies.append(latency)
+            if not success:
+                errors += 1
+
+    print(f" * {name}: {len(requests)} requests...", flush=True)
+    pce_calls_before = fake_pce.get_calls_count()
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(run_request, requests):
+            pass
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return PhaseResult(name=name, requests=len(requests), errors=errors, elapsed=elapsed, latencies=latencies,
+                       pce_calls=fake_pce.get_calls_count() - pce_calls_before)
+
+
+def print_results(results: List[PhaseResult]):
+    template_string = "  {:<16} | {:>8} | {:>6} | {:>9} | {:>9} | {:>9} | {:>9} | {:>9}"
+    print(template_string.format('Phase', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'PCE calls'))
+    for result in results:
+        print(template_string.format(result['name'],
+                                     result['requests'],
+                                     result['errors'],
+                                     '{:.1f}'.format(result['requests'] / result['elapsed'] if result['elapsed'] > 0 else 0),
+                                     '{:.2f}'.format(percentile(result['latencies'], 50) * 1000),
+                                     '{:.2f}'.format(percentile(result['latencies'], 95) * 1000),
+                                     '{:.2f}'.format(percentile(result['latencies'], 99) * 1000),
+                                     result['pce_calls']
+                                     )
+              )
+
+
+if args.benchmark == 'load':
+    # the API server and ilo_api need the PCE types, imported here so other benchmarks don't pay for it
+    from mpip_libs import api_server, ilo_api
+    from mpip_libs.fake_pce import FakePCEConnector, workload_name
+
+    print("** LOAD BENCHMARK **", flush=True)
+    temp_directory = tempfile.mkdtemp(prefix='illumio-mpip-benchmark-')
+    runtime_env.settings_persistent_directory = temp_directory
+    runtime_env.settings_agent_tokens_enabled = args.agent_tokens
+    print(f" * using temporary database in {temp_directory}")
+    database.init(create_database_if_not_exists=True)
+
+    fake_pce = FakePCEConnector(latency=args.pce_latency_ms / 1000,
+                                workloads_count=args.pce_workloads if args.pce_workloads is not None else args.agents,
+                                rules_per_workload=args.pce_rules)
+    ilo_api.connector = fake_pce
+
+    conn = database.new_connection()
+    target_switch_href = None if args.no_switch else fake_pce.network_devices[0]['href']
+    pairing_key = LVENPairingKey.create(conn, None, None, target_switch_href)
+
+    agents: List[dict] = []
+    agents_lock = threading.Lock()
+
+    def pair_request(agent_index: int) -> Callable[[object], bool]:
+        def request(client) -> bool:
+            response = client.post('/agent/pair', json={'agent_name': workload_name(agent_index), 'pairing_key': pairing_key['key']})
+            if response.status_code != 200:
+                return False
+            with agents_lock:
+                agents.append(response.json)
+            return True
+        return request
+
+    def agent_request(agent: dict, route: str) -> Callable[[object], bool]:
+        def request(client) -> bool:
+            credentials = {'authentication_token': agent['authentication_token']} if args.agent_tokens else {'authentication_key': agent['authentication_key']}
+            response = client.post(f"/agent/{agent['agent_uuid']}/{route}", json=credentials)
+            return response.status_code == 200
+        return request
+
+    LVENAgent.start_heartbeat_flusher()
+    try:
+        results = [run_phase('pair', [pair_request(index) for index in range(args.agents)], args.concurrency, fake_pce)]
+        results.append(run_phase('heartbeat', [agent_request(agent, 'heartbeat') for _ in range(args.heartbeats) for agent in agents],
+                                 args.concurrency, fake_pce))
+        results.append(run_phase('active_policies', [agent_request(agent, 'active_policies') for _ in range(args.policy_polls) for agent in agents],
+                                 args.concurrency, fake_pce))
+    finally:
+        LVENAgent.stop_heartbeat_flusher()
+        database.close_all_connections()
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+    print("** RESULTS **")
+    print(f" * {args.agents} agents, concurrency {args.concurrency}, PCE latency {args.pce_latency_ms}ms, {args.pce_rules} rules per workload")
+    print_results(results)
+    exit(0)
+
+
+if args.benchmark == 'asgi-load':
+    # the app is called in-process, without uvicorn, so only the server side is measured
+    import asyncio
+    import json
+    import httpx
+    from mpip_libs import asgi_server, ilo_api, ilo_api_async
+    from mpip_libs.fake_pce import FakePCEConnector
+
+    print("** ASGI LOAD BENCHMARK **", flush=True)
+    temp_directory = tempfile.mkdtemp(prefix='illumio-mpip-benchmark-')
+    runtime_env.settings_persistent_directory = temp_directory
+    if args.no_pce_limits:
+        runtime_env.settings_pce_rate_limit = 0
+        runtime_env.settings_pce_max_concurrent_calls = 0
+    print(f" * using temporary database in {temp_directory}")
+    database.init(create_database_if_not_exists=True)
+
+    # the fake PCE builds the policies, the latency is awaited by the transport so it doesn't hold a thread
+    fake_pce = FakePCEConnector(latency=0, workloads_count=0, rules_per_workload=args.pce_rules)
+    ilo_api.connector = fake_pce
+
+    async def fake_pce_handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(args.pce_latency_ms / 1000)
+        return httpx.Response(200, json=fake_pce.object_workload_get_active_policies(request.url.params['workload']))
+
+    conn = database.new_connection()
+    benchmark_agents = LVENAgent.create_many(conn, [(f'lven-agent-{index:06d}', f'/orgs/1/workloads/{index}') for index in range(args.agents)])
+
+    async def active_policies_request(agent: dict) -> tuple[int, float]:
+        body = json.dumps({'authentication_key': agent['authentication_key']}).encode()
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'POST', 'path': f"/agent/{agent['uuid']}/active_policies",
+                 'query_string': b'', 'root_path': '', 'headers': [(b'content-type', b'application/json')],
+                 'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 9111)}
+        body_sent = False
+        status = 0
+
+        async def receive():
+            nonlocal body_sent
+            if body_sent:
+                return {'type': 'http.disconnect'}
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        start_time = time.perf_counter()
+        await asgi_server.app(scope, receive, send)
+        return status, time.perf_counter() - start_time
+
+    async def run_asgi_phase() -> PhaseResult:
+        ilo_api_async._client = httpx.AsyncClient(transport=httpx.MockTransport(fake_pce_handler), base_url='https://pce.invalid:8443/api/v2/orgs/1')
+        try:
+            print(f" * active_policies: {len(benchmark_agents)} concurrent requests...", flush=True)
+            pce_calls_before = fake_pce.get_calls_count()
+            start_time = time.perf_counter()
+            responses = await asyncio.gather(*[active_policies_request(agent) for agent in benchmark_agents])
+            elapsed = time.perf_counter() - start_time
+        finally:
+            await ilo_api_async.stop()
+        return PhaseResult(name='active_policies', requests=len(responses), errors=sum(1 for status, _ in responses if status != 200),
+                           elapsed=elapsed, latencies=sorted(latency for _, latency in responses),
+                           pce_calls=fake_pce.get_calls_count() - pce_calls_before)
+
+    try:
+        results = [asyncio.run(run_asgi_phase())]
+    finally:
+        database.close_all_connections()
+        shutil.rmtree(temp_directory, ignore_errors=True)
+
+    print("** RESULTS **")
+    print(f" * {args.agents} agents, PCE latency {args.pce_latency_ms}ms, {args.pce_rules} rules per workload, "
+          f"PCE limits {'disabled' if args.no_pce_limits else 'from runtime_env'}")
+    print_results(results)
+    print(f" * wall time {results[0]['elapsed']:.2f}s")
+    exit(0)
+
+
+if args.benchmark == 'cli-startup':
+    print("** CLI STARTUP BENCHMARK **", flush=True)
+    temp_directory = tempfile.mkdtemp(prefix='illumio-mpip-benchmark-')
+    for sub_directory in ('data', 'runtime', 'log'):
+        os.mkdir(os.path.join(temp_directory, sub_directory))
+    runtime_env_file = os.path.join(temp_directory, 'runtime_env.yml')
+    # the PCE is unreachable on purpose: local-only subcommands must not connect to it
+    with open(runtime_env_file, 'w') as file:
+        file.write(f"persistent_data_dir: {os.path.join(temp_directory, 'data')}\n"
+                   f"runtime_dir: {os.path.join(temp_directory, 'runtime')}\n"
+                   f"log_dir: {os.path.join(temp_directory, 'log')}\n"
+                   "pce_fqdn_and_port: pce.invalid:8443\n"
+                   "pce_api_user: benchmark\n"
+                   "pce_api_secret: benchmark\n"
+                   "pce_org_id: 1\n")
+
+    runtime_env.load_runtime_env_yaml(runtime_env_file)
+    database.create_database()
+    conn = database.new_connection()
+    LVENAgent.create_many(conn, [(f'lven-agent-{index:06d}', f'/orgs/1/workloads/{index}') for index in range(args.agents)])
+    LVENPairingKey.create(conn, None, None, None)
+    database.close_all_connections()
+
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'illumio-pip-cli.py')
+    subcommands = [['db-setup'],
+                   ['pairing-key-manager', 'list'],
+                   ['pairing-key-manager', 'create', '--remaining-uses', '1', '--expiration-delay', 'unlimited'],
+                   ['lven-agent-manager', 'list', '--limit', '100'],
+                   ['lven-agent-manager', 'list'],
+                   ['lven-agent-manager', 'list', '--format', 'json']]
+
+    template_string = "  {:<72} | {:>6} | {:>9} | {:>9} | {:>9}"
+    try:
+        print(f" * {args.agents} agents, {args.runs} runs of each subcommand")
+        print(template_string.format('Subcommand', 'Errors', 'min ms', 'median ms', 'max ms'))
+        for subcommand in subcommands:
+            durations = []
+            errors = 0
+            for _ in range(args.runs):
+                start_time = time.perf_counter()
+                completed = subprocess.run([sys.executable, cli_path, '--runtime-env-file', runtime_env_file] + subcommand,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                durations.append(time.perf_counter() - start_time)
+                if completed.returncode != 0:
+                    errors += 1
+            print(template_string.format(' '.join(subcommand), errors,
+                                         '{:.1f}'.format(min(durations) * 1000),
+                                         '{:.1f}'.format(statistics.median(durations) * 1000),
+                                         '{:.1f}'.format(max(durations) * 1000)),
+                  flush=True)
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+    exit(0)
@@ -1,14 +1,18 @@
 import argparse
+import csv
+import json
 import os
 import logging
+import sys
 import time
 import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
 
 from mpip_libs import runtime_env, database
 from mpip_libs.database import LVENPairingKey, LVENAgent
 
 from mpip_libs.misc import default_runtime_env_file_location, check_required_directories_exist
-from mpip_libs import ilo_api
+# ilo_api and pairing (which load pylo and connect to the PCE on first use) are imported by the subcommands needing them
 
 parser = argparse.ArgumentParser(description = 'Illumio MPIP CLI')
 parser.add_argument('--runtime-env-file', '-r',
@@ -23,6 +27,7 @@ sub_parser_lven_agent_manager = sub_parsers.add_parser('lven-agent-manager', hel
 
 sub_parser_pairing_key_manager_sub_parsers = sub_parser_pairing_key_manager.add_subparsers(dest='action', required=True)
 sub_parser_pairing_key_manager_action_list = sub_parser_pairing_key_manager_sub_parsers.add_parser('list', help='List pairing keys')
+sub_parser_pairing_key_manager_action_list.add_argument('--usable-only', action='store_true', help='Skip expired and used up pairing keys')
 sub_parser_pairing_key_manager_action_create = sub_parser_pairing_key_manager_sub_parsers.add_parser('create', help='Create a pairing key')
 sub_parser_pairing_key_manager_action_delete = sub_parser_pairing_key_manager_sub_parsers.add_parser('delete', help='Delete a pairing key')
 
@@ -35,22 +40,72 @@ sub_parser_lven_agent_manager_sub_parsers = sub_parser_lven_agent_manager.add_su
 sub_parser_lven_agent_manager_delete_all = sub_parser_lven_agent_manager_sub_parsers.add_parser('delete-all', help='Delete all LVEN agents')
 sub_parser_lven_agent_manager_list = sub_parser_lven_agent_manager_sub_parsers.add_parser('list', help='List LVEN agents')
 sub_parser_lven_agent_manager_list.add_argument('--show-authentication-keys', '-p', action='store_true', help='Show the authentication keys of the agents')
+sub_parser_lven_agent_manager_list.add_argument('--stale', type=int, required=False, metavar='SECONDS', help='Only list agents without heartbeat for more than SECONDS')
+sub_parser_lven_agent_manager_list.add_argument('--seen-within', type=int, required=False, metavar='SECONDS', help='Only list agents with a heartbeat in the last SECONDS')
+sub_parser_lven_agent_manager_list.add_argument('--name-prefix', type=str, required=False, help='Only list agents whose name starts with this prefix')
+
+# listings are streamed from the database and paginated on their primary key (uuid for agents, key for pairing keys)
+for listing_sub_parser in (sub_parser_pairing_key_manager_action_list, sub_parser_lven_agent_manager_list):
+    listing_sub_parser.add_argument('--limit', type=int, required=False, help='Maximum number of entries to list')
+    listing_sub_parser.add_argument('--after', type=str, required=False, help='Only list entries after this UUID/key, ie: the last one of the previous page')
+    listing_sub_parser.add_argument('--format', dest='output_format', type=str, choices=['table', 'json', 'csv'], default='table', help='Output format')
+sub_parser_lven_agent_manager_import = sub_parser_lven_agent_manager_sub_parsers.add_parser('import', help='Pair LVEN agents in bulk from a CSV or JSONL file')
+sub_parser_lven_agent_manager_import.add_argument('--file', '-f', type=str, required=True, help='CSV (with a header) or JSONL file with the columns/fields "agent_name" and optionally "target_switch"')
+sub_parser_lven_agent_manager_import.add_argument('--format', type=str, choices=['csv', 'jsonl'], required=False, help='Format of the file, guessed from its extension if not provided')
+sub_parser_lven_agent_manager_import.add_argument('--target-switch-href-or-name', '-t', type=str, required=False, help='Target switch HREF or name for rows which do not specify one')
+sub_parser_lven_agent_manager_import.add_argument('--report-file', type=str, required=False, help='Write the per-row results (including authentication keys and tokens) to this CSV or JSONL file')
 
 args = parser.parse_args()
 
+# with json/csv output, status messages go to stderr so stdout can be piped to another tool
+output_format = getattr(args, 'output_format', 'table')
+status_output = sys.stderr if output_format != 'table' else sys.stdout
+
+
+def write_listing(entries: Iterator[dict], table_columns: List[Tuple[str, int, Callable[[dict], str]]]) -> Tuple[int, Optional[dict]]:
+    # writes entries as they come out of the database cursor, returns how many were written and the last one (for the next page)
+    count = 0
+    last_entry = None
+    if output_format == 'json':
+        sys.stdout.write('[')
+        for entry in entries:
+            sys.stdout.write(('\n' if last_entry is None else ',\n') + json.dumps(entry))
+            last_entry = entry
+            count += 1
+        sys.stdout.write('\n]\n')
+    elif output_format == 'csv':
+        writer = None
+        for entry in entries:
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(entry.keys()))
+                writer.writeheader()
+            writer.writerow(entry)
+            last_entry = entry
+            count += 1
+    else:
+        template_string = '  ' + ' | '.join('{:<' + str(width) + '}' for _, width, _ in table_columns)
+        print(template_string.format(*[header for header, _, _ in table_columns]))
+        for entry in entries:
+            print(template_string.format(*[str(formatter(entry)) for _, _, formatter in table_columns]))
+            last_entry = entry
+            count += 1
+    sys.stdout.flush()
+    return count, last_entry
+
+
+def format_timestamp(timestamp: Optional[int], none_value: str = 'never') -> str:
+    return str(datetime.datetime.fromtimestamp(timestamp)) if timestamp is not None else none_value
+
+
 # get full path of the runtime_env file
 runtime_env_file = os.path.abspath(args.runtime_env_file)
 
-print('* using runtime_env file:', runtime_env_file, flush=True)
+print('* using runtime_env file:', runtime_env_file, flush=True, file=status_output)
 runtime_env.load_runtime_env_yaml(runtime_env_file)
 
-print('* checking directories... ', end='', flush=True)
+print('* checking directories... ', end='', flush=True, file=status_output)
 check_required_directories_exist()
-print('OK')
-
-print('* Initializing Illumio PCE API link... ', end='', flush=True)
-ilo_api.init()
-print('OK')
+print('OK', file=status_output)
 
 if args.tool == 'db-setup':
     print("** STARTED DB SETUP **", flush=True)
@@ -58,36 +113,42 @@ if args.tool == 'db-setup':
         print("* DB doesn't exist yet, creating it...", flush=True, end='')
         database.create_database()
         print('OK')
-    else:
-        # database already exists, ERROR!
-        logging.error("* DB already exists, nothing to do.")
-        exit(1)
+        exit(0)
+
+    # database already exists, bring its schema up to date
+    conn = database.new_connection()
+    print(f"* DB already exists with schema version {database.get_schema_version(conn)}, applying pending migrations...", flush=True, end='')
+    applied_migrations = database.migrate(conn)
+    print('OK')
+    if len(applied_migrations) == 0:
+        print("* Schema is already up to date, nothing to do.")
+    for migration in applied_migrations:
+        print(f" * applied {migration}")
     exit(0)
 
-print("* checking database...", end='', flush=True)
+print("* checking database...", end='', flush=True, file=status_output)
 if not database.database_exists():
-    print('FAIL')
-    print(f"The database file {database.database_file_path()} does not exist. Did you set it up first? (db-setup)")
+    print('FAIL', file=status_output)
+    print(f"The database file {database.database_file_path()} does not exist. Did you set it up first? (db-setup)", file=status_output)
     exit(1)
 
 conn = database.new_connection()
-print('OK', flush=True)
+print('OK', flush=True, file=status_output)
 
 
 if args.tool == 'pairing-key-manager':
     if args.action == 'list':
-        print("** LISTING PAIRING KEYS **", flush=True)
-        pairing_keys = database.LVENPairingKey.get_all(conn)
-        # print pairing keys as nice table
-        print("  {:<32} | {:<10} | {:<61} | {:<19} | {:<19}".format('Key', 'Remaining', 'Switch HREF', 'Valid Until', 'Created at'))
-        for pairing_key in pairing_keys:
-            print("  {:<32} | {:<10} | {:<61} | {:<19} | {:<19}".format(pairing_key['key'],
-                                                          pairing_key['remaining_uses'] if pairing_key['remaining_uses'] is not None else 'unlimited',
-                                                          pairing_key['target_switch_href'] if pairing_key['target_switch_href'] is not None else 'none',
-                                                          str(datetime.datetime.fromtimestamp(pairing_key['valid_until'])) if pairing_key['valid_until'] is not None else 'never',
-                                                          str(datetime.datetime.fromtimestamp(pairing_key["created_at"]))
-                                                          )
-                  )
+        print("** LISTING PAIRING KEYS **", flush=True, file=status_output)
+        pairing_keys = database.LVENPairingKey.iter_pairing_keys(conn, after_key=args.after, limit=args.limit, usable_only=args.usable_only)
+        count, last_pairing_key = write_listing(pairing_keys, [
+            ('Key', 32, lambda pairing_key: pairing_key['key']),
+            ('Remaining', 10, lambda pairing_key: pairing_key['remaining_uses'] if pairing_key['remaining_uses'] is not None else 'unlimited'),
+            ('Switch HREF', 61, lambda pairing_key: pairing_key['target_switch_href'] if pairing_key['target_switch_href'] is not None else 'none'),
+            ('Valid Until', 19, lambda pairing_key: format_timestamp(pairing_key['valid_until'])),
+            ('Created at', 19, lambda pairing_key: format_timestamp(pairing_key['created_at'])),
+        ])
+        if args.limit is not None and count == args.limit:
+            print(f" * next page: --after {last_pairing_key['key']}", file=status_output)
         exit(0)
     elif args.action == 'create':
         # check for remaining uses value to be 'unlimited' or an int
@@ -116,6 +177,7 @@ if args.tool == 'pairing-key-manager':
 
         if args.target_switch_href_or_name is not None:
             # first we need to find if the switch exists inside the PCE
+            from mpip_libs import ilo_api
             print("** FINDING SWITCH IN PCE **", flush=True)
             print(" * Searching for switch with HREF or name: {}".format(args.target_switch_href_or_name))
             switch = ilo_api.find_switch_from_href_or_name(args.target_switch_href_or_name)
@@ -156,24 +218,72 @@ elif args.tool == 'lven-agent-manager':
         print('OK')
         exit(0)
     elif args.action == 'list':
-        print("** LISTING LVEN AGENTS **", flush=True)
-        agents = database.LVENAgent.get_all(conn)
-        # print agents as nice table
-        template_string = "  {:<36} | {:<20} | {:<55} | {:<19} | {:<19}"
+        print("** LISTING LVEN AGENTS **", flush=True, file=status_output)
+        now = time.time()
+        agents = database.LVENAgent.iter_agents(conn, after_uuid=args.after, limit=args.limit, name_prefix=args.name_prefix,
+                                                heartbeat_older_than=now - args.stale if args.stale is not None else None,
+                                                heartbeat_newer_than=now - args.seen_within if args.seen_within is not None else None)
+        if not args.show_authentication_keys:
+            agents = ({field: value for field, value in agent.items() if field != 'authentication_key'} for agent in agents)
+
+        table_columns = [('UUID', 36, lambda agent: agent['uuid']),
+                         ('Name', 20, lambda agent: agent['name']),
+                         ('PCE Workload HREF', 55, lambda agent: agent['pce_workload_href']),
+                         ('Last Heartbeat', 19, lambda agent: format_timestamp(agent['last_heartbeat'])),
+                         ('Created at', 19, lambda agent: format_timestamp(agent['created_at']))]
         if args.show_authentication_keys:
-            template_string += " | {:<64}"
-
-        print(template_string.format('UUID', 'Name', 'PCE Workload HREF', 'Last Heartbeat', 'Created at', 'Authentication Key' if args.show_authentication_keys else ''))
-        for agent in agents:
-            print(template_string.format(agent['uuid'],
-                                                          agent['name'],
-                                                          agent['pce_workload_href'],
-                                                          str(datetime.datetime.fromtimestamp(agent['last_heartbeat'])),
-                                                          str(datetime.datetime.fromtimestamp(agent["created_at"])),
-                                                          agent['authentication_key'] if args.show_authentication_keys else ''
-                                                          )
-                  )
+            table_columns.append(('Authentication Key', 64, lambda agent: agent['authentication_key']))
+
+        count, last_agent = write_listing(agents, table_columns)
+        if args.limit is not None and count == args.limit:
+            print(f" * next page: --after {last_agent['uuid']}", file=status_output)
         exit(0)
+    elif args.action == 'import':
+        from mpip_libs import pairing
+        print("** IMPORTING LVEN AGENTS **", flush=True)
+        file_format = args.format
+        if file_format is None:
+            file_format = 'jsonl' if args.file.lower().endswith(('.jsonl', '.json')) else 'csv'
+
+        print(f" * Reading {file_format.upper()} file {args.file}...", flush=True, end='')
+        with open(args.file, 'r', newline='') as file:
+            if file_format == 'csv':
+                rows = [dict(row) for row in csv.DictReader(file)]
+            else:
+                rows = [json.loads(line) for line in file if line.strip() != '']
+        for row in rows:
+            # empty CSV cells mean "not provided"
+            if row.get('target_switch') in ('', None):
+                row['target_switch'] = args.target_switch_href_or_name
+        print(f"OK ({len(rows)} rows)", flush=True)
+
+        results = pairing.bulk_pair_agents(conn, rows)
+
+        template_string = "  {:<5} | {:<20} | {:<6} | {:<36} | {}"
+        print(template_string.format('Row', 'Name', 'Status', 'UUID', 'Error'))
+        for result in results:
+            print(template_string.format(result['row'],
+                                         result['agent_name'] if result['agent_name'] is not None else '',
+                                         result['status'],
+                                         result['agent_uuid'] if result['agent_uuid'] is not None else '',
+                                         result['error'] if result['error'] is not None else ''
+                                         )
+                  )
+
+        if args.report_file is not None:
+            with open(args.report_file, 'w', newline='') as file:
+                if args.report_file.lower().endswith(('.jsonl', '.json')):
+                    for result in results:
+                        file.write(json.dumps(result) + '\n')
+                else:
+                    writer = csv.DictWriter(file, fieldnames=list(pairing.BulkPairingRowResult.__annotations__.keys()))
+                    writer.writeheader()
+                    writer.writerows(results)
+            print(f" * Report written to {args.report_file}")
+
+        paired_count = len([result for result in results if result['status'] == 'paired'])
+        print(f" * {paired_count} agents paired, {len(results) - paired_count} failed")
+        exit(0 if paired_count == len(results) else 1)
     else:
         # unsupported action
         logging.error(f"Unsupported action: {args.action}")
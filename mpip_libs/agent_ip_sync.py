@@ -0,0 +1,126 @@
+import logging
+import threading
+from typing import Optional, TypedDict
+
+import mpip_libs.database as database
+import mpip_libs.ilo_api as ilo_api
+from mpip_libs.database import LVENAgentIPAddress
+from mpip_libs.misc import PeriodicWorker
+
+# pushes the IP addresses reported by the agents to the interfaces of their PCE workloads. Heartbeats only flag the
+# agents whose addresses changed (see LVENAgentIPAddress.update()), a background worker sends the latest addresses of
+# the flagged workloads in bulk updates, so an agent changing its addresses several times between two runs costs
+# a single PCE update.
+
+
+class AgentIPSyncStats(TypedDict):
+    runs: int
+    failed_runs: int
+    bulk_updates: int # PCE calls
+    workloads_updated: int
+    workloads_rejected: int # bulk update entries refused, retried by a later run
+    workloads_not_found: int # workloads deleted or now managed, nothing to update
+
+
+class AgentIPSync:
+    def __init__(self, interval: float, batch_size: int):
+        self.batch_size = batch_size
+        self._stats_lock = threading.Lock()
+        self._stats = AgentIPSyncStats(runs=0, failed_runs=0, bulk_updates=0, workloads_updated=0, workloads_rejected=0,
+                                       workloads_not_found=0)
+        self._worker = PeriodicWorker('agent-ip-sync', interval, self._run, run_on_stop=False)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self):
+        self._worker.stop()
+
+    def _run(self):
+        try:
+            self.sync(database.new_connection())
+        except Exception:
+            with self._stats_lock:
+                self._stats['failed_runs'] += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._stats['runs'] += 1
+
+    def sync(self, db) -> int:
+        # returns the number of workloads updated. Stops at the first failed bulk update, its agents stay flagged.
+        # refused entries stay flagged too, behind the others, the run stops when they come back
+        updated_count = 0
+        workloads_by_href = None # downloaded once per run, see ilo_api.get_unmanaged_workloads_by_href()
+        postponed_hrefs = set()
+        while True:
+            updates = LVENAgentIPAddress.get_pending_workload_updates(db, self.batch_size)
+            updates = [update for update in updates if update['pce_workload_href'] not in postponed_hrefs]
+            if len(updates) == 0:
+                return updated_count
+
+            if workloads_by_href is None:
+                workloads_by_href = ilo_api.get_unmanaged_workloads_by_href()
+            results = ilo_api.update_workloads_ip_addresses({update['pce_workload_href']: update['ip_addresses'] for update in updates},
+                                                            workloads_by_href)
+            rejected_hrefs = set()
+            not_found_count = 0
+            for result in results:
+                if result.get('status') == 'updated':
+                    continue
+                if result.get('token') == 'unmanaged_workload_not_found':
+                    # deleted or managed by a VEN now, retrying won't help
+                    not_found_count += 1
+                    continue
+                logging.warning(f"PCE refused the IP addresses of workload {result.get('href')}: "
+                                f"{result.get('status')} {result.get('token', '')} {result.get('message', '')}")
+                rejected_hrefs.add(result.get('href'))
+            LVENAgentIPAddress.mark_pushed(db, [update for update in updates if update['pce_workload_href'] not in rejected_hrefs])
+            if len(rejected_hrefs) > 0:
+                LVENAgentIPAddress.postpone(db, [update for update in updates if update['pce_workload_href'] in rejected_hrefs])
+                postponed_hrefs.update(rejected_hrefs)
+
+            workloads_updated = len(updates) - len(rejected_hrefs) - not_found_count
+            updated_count += workloads_updated
+            with self._stats_lock:
+                self._stats['bulk_updates'] += 1
+                self._stats['workloads_updated'] += workloads_updated
+                self._stats['workloads_rejected'] += len(rejected_hrefs)
+                self._stats['workloads_not_found'] += not_found_count
+
+            # both pending lists are read up to batch_size entries, a shorter batch means all were read
+            agents_count = sum(len(update['changes']) for update in updates)
+            workloads_count = sum(1 for update in updates if update['workload_changed_at'] is not None)
+            if agents_count < self.batch_size and workloads_count < self.batch_size:
+                return updated_count
+
+    def get_stats(self) -> AgentIPSyncStats:
+        with self._stats_lock:
+            return AgentIPSyncStats(**self._stats)
+
+
+# only the server pushes the addresses, see start()
+_sync: Optional[AgentIPSync] = None
+
+
+def start(interval: float, batch_size: int):
+    global _sync
+    if _sync is not None:
+        return
+    _sync = AgentIPSync(interval, batch_size)
+    _sync.start()
+
+
+def stop():
+    global _sync
+    if _sync is not None:
+        _sync.stop()
+        _sync = None
+
+
+def get_stats() -> AgentIPSyncStats:
+    sync = _sync
+    if sync is None:
+        return AgentIPSyncStats(runs=0, failed_runs=0, bulk_updates=0, workloads_updated=0, workloads_rejected=0,
+                                workloads_not_found=0)
+    return sync.get_stats()
@@ -0,0 +1,265 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from sqlite3 import Connection
+from typing import Optional, TypedDict
+
+import mpip_libs.database as database
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs import shared_state
+from mpip_libs.misc import PeriodicWorker
+
+# signed agent tokens, an alternative to the authentication keys: pairing returns a token carrying the agent uuid and
+# its workload href, signed with HMAC-SHA256. Agent requests sending it are authenticated without reading the agent
+# from the database, the only lookup is in the in-memory list of the deleted agents (lven_agents_revoked_tokens,
+# filled by a trigger), refreshed from the database every agent_token_revocations_refresh_interval seconds.
+# tokens are refused once older than agent_token_max_age, the agent then authenticates with its key. All the tokens of
+# an agent deleted before that age are expired as well, so its revocation is dropped: the list doesn't grow forever.
+#
+# token: 'v1.' + base64url(JSON claims) + '.' + base64url(signature of the first two parts)
+
+token_version = 'v1'
+# where the signing secret is generated when runtime_env agent_token_secret is not set, so the server processes
+# and the CLI (which pairs agents too) use the same one
+secret_file_name = 'agent_token_secret'
+# shorter secrets (ie: an empty agent_token_secret or a truncated file) are refused, tokens could be forged
+min_secret_length = 32
+
+
+class AgentTokenClaims(TypedDict):
+    agent_uuid: str
+    pce_workload_href: str
+    issued_at: float
+
+
+class AgentTokensStats(TypedDict):
+    revoked_agents: int
+    verified: int
+    rejected: int # bad signature or token of another agent
+    revoked: int # token of a deleted agent
+    expired: int # token older than agent_token_max_age
+    revocations_pruned: int # revocations dropped from the database, see prune_revocations()
+
+
+_secret: Optional[bytes] = None
+_secret_lock = threading.Lock()
+
+_revoked_uuids: dict[str, float] = {} # agent uuid -> revoked_at
+_revocations_pruned_at: Optional[float] = None # monotonic, last time the expired revocations were dropped from _revoked_uuids
+_revocations_last_rowid = 0
+_revocations_refreshed_at: Optional[float] = None # monotonic, None until the first refresh or after expire_revocations()
+_revocations_generation = 0 # shared_state 'agent_credentials' generation when refreshed, bumped when agents are deleted
+_revocations_expirations = 0 # expire_revocations() calls, a refresh racing with one doesn't count as fresh
+_revocations_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = AgentTokensStats(revoked_agents=0, verified=0, rejected=0, revoked=0, expired=0, revocations_pruned=0)
+
+_pruner: Optional[PeriodicWorker] = None
+
+
+def _get_secret() -> bytes:
+    global _secret
+    if _secret is None:
+        with _secret_lock:
+            if _secret is None:
+                if runtime_env.settings_agent_token_secret is not None:
+                    secret = runtime_env.settings_agent_token_secret.encode()
+                else:
+                    secret = _load_or_create_secret_file(os.path.join(runtime_env.settings_persistent_directory, secret_file_name))
+                if len(secret) < min_secret_length:
+                    raise ValueError(f'Agent token secret must be at least {min_secret_length} characters long')
+                _secret = secret
+    return _secret
+
+
+def load_secret():
+    # the prefork supervisor loads it before forking so all the workers get the same one without racing for the file
+    _get_secret()
+
+
+def _load_or_create_secret_file(file_path: str) -> bytes:
+    # the secret is written to a temporary file which is then linked to file_path: the link fails if another process
+    # created it first, and the file never exists with a partial content
+    temp_file_path = f'{file_path}.{os.getpid()}.{secrets.token_hex(4)}.tmp'
+    fd = os.open(temp_file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        secret = secrets.token_urlsafe(48)
+        with os.fdopen(fd, 'w') as secret_file:
+            secret_file.write(secret + '\n')
+            secret_file.flush()
+            os.fsync(secret_file.fileno())
+        try:
+            os.link(temp_file_path, file_path)
+            return secret.encode()
+        except FileExistsError:
+            with open(file_path, 'r') as secret_file:
+                return secret_file.read().strip().encode()
+    finally:
+        os.remove(temp_file_path)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(signed_part: str) -> str:
+    return _b64encode(hmac.new(_get_secret(), signed_part.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue(agent_uuid: str, pce_workload_href: str) -> str:
+    claims = {'u': agent_uuid, 'w': pce_workload_href, 't': time.time()}
+    signed_part = token_version + '.' + _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return signed_part + '.' + _sign(signed_part)
+
+
+def _count(field: str, count: int = 1):
+    with _stats_lock:
+        _stats[field] += count
+
+
+def _decode(token: str) -> Optional[AgentTokenClaims]:
+    # claims of a token signed with our secret, None otherwise
+    if not isinstance(token, str):
+        return None
+    parts = token.split('.')
+    if len(parts) != 3 or parts[0] != token_version:
+        return None
+    signed_part = parts[0] + '.' + parts[1]
+    try:
+        signature_valid = hmac.compare_digest(_sign(signed_part).encode(), parts[2].encode('ascii'))
+    except UnicodeEncodeError:
+        return None
+    if not signature_valid:
+        return None
+    claims = json.loads(_b64decode(parts[1]))
+    return AgentTokenClaims(agent_uuid=claims['u'], pce_workload_href=claims['w'], issued_at=claims['t'])
+
+
+def verify(agent_uuid: str, token: str) -> tuple[Optional[AgentTokenClaims], Optional[tuple[str, int]]]:
+    # returns the claims or the error response to send back, same responses as the authentication key checks.
+    # no database access, see revocations_need_refresh()
+    claims = _decode(token)
+    if claims is None or claims['agent_uuid'] != agent_uuid:
+        _count('rejected')
+        return None, ('Authentication token is incorrect', 403)
+    if _is_expired(claims['issued_at']):
+        _count('expired')
+        return None, ('Authentication token has expired', 403)
+    if agent_uuid in _revoked_uuids:
+        _count('revoked')
+        return None, ('Agent UUID does not exist', 404)
+    _count('verified')
+    return claims, None
+
+
+def _get_expiration_cutoff() -> Optional[float]:
+    # tokens issued before this time are refused, None if they never expire
+    if runtime_env.settings_agent_token_max_age <= 0:
+        return None
+    return time.time() - runtime_env.settings_agent_token_max_age
+
+
+def _is_expired(issued_at: float) -> bool:
+    cutoff = _get_expiration_cutoff()
+    return cutoff is not None and issued_at < cutoff
+
+
+def revocations_need_refresh() -> bool:
+    return (_revocations_refreshed_at is None
+            or time.monotonic() - _revocations_refreshed_at >= runtime_env.settings_agent_token_revocations_refresh_interval
+            or shared_state.get_generation('agent_credentials') != _revocations_generation)
+
+
+def refresh_revocations(db: Connection):
+    # reads the agents deleted since the last refresh, by any process (ie: CLI)
+    global _revocations_last_rowid, _revocations_refreshed_at, _revocations_generation, _revocations_pruned_at
+    # a single thread refreshes, the others keep verifying with the current list
+    if not _revocations_lock.acquire(blocking=False):
+        return
+    try:
+        generation = shared_state.get_generation('agent_credentials')
+        expirations = _revocations_expirations
+        c = db.cursor()
+        c.execute('SELECT rowid, agent_uuid, revoked_at FROM lven_agents_revoked_tokens WHERE rowid > ? ORDER BY rowid',
+                  (_revocations_last_rowid,))
+        for row in c.fetchall():
+            _revoked_uuids[row['agent_uuid']] = row['revoked_at']
+            _revocations_last_rowid = row['rowid']
+
+        # every process drops its expired entries, prune_revocations() only cleans the database
+        cutoff = _get_expiration_cutoff()
+        if cutoff is not None and (_revocations_pruned_at is None or
+                                   time.monotonic() - _revocations_pruned_at >= runtime_env.settings_agent_token_revocations_prune_interval):
+            for agent_uuid in [agent_uuid for agent_uuid, revoked_at in _revoked_uuids.items() if revoked_at < cutoff]:
+                del _revoked_uuids[agent_uuid]
+            _revocations_pruned_at = time.monotonic()
+
+        _revocations_generation = generation
+        _revocations_refreshed_at = time.monotonic() if expirations == _revocations_expirations else None
+    finally:
+        _revocations_lock.release()
+
+
+def verify_with_refresh(db: Connection, agent_uuid: str, token: str) -> tuple[Optional[AgentTokenClaims], Optional[tuple[str, int]]]:
+    if revocations_need_refresh():
+        refresh_revocations(db)
+    return verify(agent_uuid, token)
+
+
+def prune_revocations(db: Connection) -> int:
+    # deletes the revocations of the agents deleted before the expiration cutoff: their tokens were issued even earlier
+    # and are refused anyway. The newest row is kept so new rowids keep growing past the servers' last read one.
+    # returns the number of rows deleted
+    cutoff = _get_expiration_cutoff()
+    if cutoff is None:
+        return 0
+    try:
+        c = db.execute('DELETE FROM lven_agents_revoked_tokens WHERE revoked_at < ? '
+                       'AND rowid < (SELECT MAX(rowid) FROM lven_agents_revoked_tokens)', (cutoff,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _count('revocations_pruned', c.rowcount)
+    return c.rowcount
+
+
+def start_revocations_pruner():
+    # a single process prunes the database, see api_server.run_server_process()
+    global _pruner
+    if _pruner is not None or _get_expiration_cutoff() is None:
+        return
+    _pruner = PeriodicWorker('agent-token-revocations-pruner', runtime_env.settings_agent_token_revocations_prune_interval,
+                             lambda: prune_revocations(database.new_connection()), run_on_stop=False)
+    _pruner.start()
+
+
+def stop_revocations_pruner():
+    global _pruner
+    if _pruner is not None:
+        _pruner.stop()
+        _pruner = None
+
+
+def expire_revocations():
+    # agents were deleted by this process, the next verification reloads the list
+    global _revocations_refreshed_at, _revocations_expirations
+    _revocations_expirations += 1
+    _revocations_refreshed_at = None
+
+
+def get_stats() -> AgentTokensStats:
+    with _stats_lock:
+        stats = AgentTokensStats(**_stats)
+    stats['revoked_agents'] = len(_revoked_uuids)
+    return stats
@@ -1,102 +1,339 @@
 from flask import Flask
 from flask import request
+from flask import Response
+from flask import g
+from werkzeug.http import parse_etags
+import mpip_libs.compression as compression
 import mpip_libs.database as database
-from mpip_libs.database import LVENAgent, LVENPairingKey
+from mpip_libs.database import LVENAgent, LVENAgentIPAddress, LVENPairingKey
+import mpip_libs.agent_ip_sync as agent_ip_sync
+import mpip_libs.agent_tokens as agent_tokens
 import mpip_libs.ilo_api as ilo_api
+import mpip_libs.liveness as liveness
+import mpip_libs.metrics as metrics
+from mpip_libs.pce_guard import PCEUnavailableEx
+import mpip_libs.pairing as pairing
+import mpip_libs.policy_delivery as policy_delivery
+import mpip_libs.policy_watcher as policy_watcher
+import mpip_libs.runtime_env as runtime_env
+import functools
+import hmac
 import time
 import waitress
 import logging
+from typing import Callable, Optional
 
 
 app = Flask(__name__)
 
+# waitress server, kept to report its threads and queue on /metrics
+_waitress_server = None
+
+
+def _get_waitress_stats() -> dict:
+    if _waitress_server is None:
+        return {}
+    task_dispatcher = _waitress_server.task_dispatcher
+    return {'threads': len(task_dispatcher.threads),
+            'active_threads': task_dispatcher.active_count,
+            'queue_depth': len(task_dispatcher.queue)}
+
+
+metrics.register(metrics.StatsGauges('mpip_waitress', 'Waitress worker threads and queue', _get_waitress_stats))
+metrics.register(metrics.StatsGauges('mpip_database_pool', 'SQLite connections pool', database.get_pool_stats))
+metrics.register(metrics.StatsGauges('mpip_heartbeat_buffer', 'Heartbeats write-behind buffer', LVENAgent.get_heartbeat_buffer_stats))
+metrics.register(metrics.StatsGauges('mpip_agent_credentials_cache', 'Agent credentials cache', LVENAgent.get_credentials_cache_stats))
+metrics.register(metrics.StatsGauges('mpip_agent_tokens', 'Signed agent tokens verifications', agent_tokens.get_stats))
+metrics.register(metrics.StatsGauges('mpip_active_policies_cache', 'Active policies cache', ilo_api.get_active_policies_cache_stats))
+metrics.register(metrics.StatsGauges('mpip_active_policies_history', 'Active policies versions kept for deltas', ilo_api.get_active_policies_history_stats))
+metrics.register(metrics.StatsGauges('mpip_pce_guard', 'PCE calls rate limit, retries and circuit breaker', ilo_api.get_pce_guard_stats))
+metrics.register(metrics.StatsGauges('mpip_pce_single_flight', 'Coalesced PCE calls', ilo_api.get_single_flight_stats))
+metrics.register(metrics.StatsGauges('mpip_liveness', 'Stale agents tracker', liveness.get_stats))
+metrics.register(metrics.StatsGauges('mpip_policy_watcher', 'Active policies long-poll watcher', policy_watcher.get_stats))
+metrics.register(metrics.StatsGauges('mpip_agent_ip_addresses_cache', 'Agents known IP addresses cache', LVENAgentIPAddress.get_known_addresses_cache_stats))
+metrics.register(metrics.StatsGauges('mpip_agent_ip_sync', 'Agents IP addresses pushed to the PCE', agent_ip_sync.get_stats))
+metrics.register(metrics.StatsGauges('mpip_pairing_jobs', 'Asynchronous pairing jobs', pairing.get_pairing_jobs_stats))
+
+
 def start_server(developer_mode: bool = False):
-    if developer_mode:
-        app.run()
-    else:
-        waitress.serve(app, listen='*:9111')
+    if not developer_mode and runtime_env.settings_server_mode == 'prefork':
+        # the supervisor only forks and watches the workers, each one runs run_server_process()
+        import mpip_libs.prefork as prefork
+        prefork.serve()
+        return
+    run_server_process(developer_mode)
+
+
+def run_server_process(developer_mode: bool = False, sockets: Optional[list] = None, run_singleton_tasks: bool = True):
+    # sockets: already listening sockets to serve (prefork workers), '*:9111' is opened otherwise
+    # run_singleton_tasks: False for the prefork workers but one, for the tasks which must run once per server
+    global _waitress_server
+
+    # the liveness tracker only sees the heartbeats of its process, prefork workers use the database instead
+    if runtime_env.settings_server_mode != 'prefork':
+        liveness.start(runtime_env.settings_liveness_granularity, runtime_env.settings_liveness_thresholds,
+                       LVENAgent.iter_heartbeats(database.new_connection()))
+    LVENAgent.start_heartbeat_flusher()
+    # the other prefork workers load the PCE indexes on demand and follow the policy version polled by this one
+    if run_singleton_tasks:
+        ilo_api.start_background_tasks()
+    policy_watcher.start(runtime_env.settings_policy_watch_interval, runtime_env.settings_policy_watch_full_recheck_interval,
+                         get_policy_watch_max_blocking_waiters(developer_mode), poll_pce=run_singleton_tasks)
+    if run_singleton_tasks and runtime_env.settings_agent_ip_sync_enabled:
+        agent_ip_sync.start(runtime_env.settings_agent_ip_sync_interval, runtime_env.settings_agent_ip_sync_batch_size)
+    if run_singleton_tasks and runtime_env.settings_agent_tokens_enabled:
+        agent_tokens.start_revocations_pruner()
+    try:
+        if developer_mode:
+            app.run()
+        elif runtime_env.settings_server_mode == 'asgi':
+            # imported here as it needs the optional uvicorn package
+            import mpip_libs.asgi_server as asgi_server
+            asgi_server.serve()
+        else:
+            # same as waitress.serve() but keeping a reference to the server
+            logging.basicConfig()
+            if sockets is not None:
+                _waitress_server = waitress.create_server(app, sockets=sockets, threads=runtime_env.settings_waitress_threads)
+            else:
+                _waitress_server = waitress.create_server(app, listen='*:9111', threads=runtime_env.settings_waitress_threads)
+            _waitress_server.print_listen('Serving on http://{}:{}')
+            _waitress_server.run()
+    finally:
+        pairing.shutdown_workers()
+        agent_ip_sync.stop()
+        agent_tokens.stop_revocations_pruner()
+        policy_watcher.stop()
+        ilo_api.stop_background_tasks()
+        LVENAgent.stop_heartbeat_flusher()
+        liveness.stop()
+        database.close_all_connections()
+
+
+def get_policy_watch_max_blocking_waiters(developer_mode: bool) -> Optional[int]:
+    # waiters of the 'asgi' mode don't hold a thread, the development server starts a thread per request
+    if developer_mode or runtime_env.settings_server_mode == 'asgi':
+        return None
+    if runtime_env.settings_policy_watch_max_blocking_waiters >= runtime_env.settings_waitress_threads:
+        logging.warning(f"policy_watch_max_blocking_waiters ({runtime_env.settings_policy_watch_max_blocking_waiters}) leaves no "
+                        f"thread out of the {runtime_env.settings_waitress_threads} waitress_threads for the other requests")
+    return runtime_env.settings_policy_watch_max_blocking_waiters
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response: Response) -> Response:
+    start_time = g.get('request_start_time')
+    if start_time is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = str(response.status_code)
+        metrics.http_requests_total.inc(route, request.method, status)
+        metrics.http_request_duration_seconds.observe(time.perf_counter() - start_time, route, request.method, status)
+    return response
+
+
+@app.errorhandler(PCEUnavailableEx)
+def _pce_unavailable(exception: PCEUnavailableEx):
+    # the PCE was not called (circuit open or too many calls waiting), the client may retry later
+    return Response(str(exception), status=503, headers={'Retry-After': str(retry_after_pce_unavailable())})
+
+
+def retry_after_pce_unavailable() -> int:
+    return max(1, int(runtime_env.settings_pce_circuit_breaker_reset_timeout))
+
+
+@app.after_request
+def _compress_response(response: Response) -> Response:
+    # active policies responses are compressed by policy_delivery, which caches the compressed full policies
+    if response.status_code not in (200, 226) or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if not compression.should_compress(len(data), response.mimetype):
+        return response
+    response.set_data(compression.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def server_metrics():
+    return Response(metrics.render_all(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/server/stats', methods=['GET'])
+def server_stats():
+    return {'database_pool': database.get_pool_stats(),
+            'heartbeat_buffer': LVENAgent.get_heartbeat_buffer_stats(),
+            'agent_credentials_cache': LVENAgent.get_credentials_cache_stats(),
+            'agent_tokens': agent_tokens.get_stats(),
+            'active_policies_cache': ilo_api.get_active_policies_cache_stats(),
+            'active_policies_history': ilo_api.get_active_policies_history_stats(),
+            'pce_single_flight': ilo_api.get_single_flight_stats(),
+            'pce_guard': ilo_api.get_pce_guard_stats(),
+            'policy_watcher': policy_watcher.get_stats(),
+            'agent_ip_addresses_cache': LVENAgentIPAddress.get_known_addresses_cache_stats(),
+            'agent_ip_sync': agent_ip_sync.get_stats(),
+            'pairing_jobs': pairing.get_pairing_jobs_stats()}, 200
 
 
 @app.route('/agent/pair', methods=['POST'])
 def agent_register():
     db = database.new_connection()
 
-    # check if an agent name was provided
-    if 'agent_name' not in request.json:
-        return 'Agent name not provided', 400
+    try:
+        activation_key = pairing.validate_pairing_request(db, request.json)
+
+        # in async mode the PCE work is done by a pairing worker, the agent polls for the result
+        if runtime_env.settings_pairing_mode == 'async':
+            job = pairing.submit_pairing_job(request.json['agent_name'], activation_key)
+            return {'job_id': job['job_id'], 'status': job['status']}, 202
 
-    agent_name = request.json['agent_name']
-    #does the agent name already exist?
-    if database.LVENAgent.name_exists(db, agent_name):
-        return 'Agent name already exists', 400
+        result = pairing.pair_agent(db, request.json['agent_name'], activation_key)
+    except pairing.PairingError as e:
+        return e.message, e.http_status
 
-    # check if an activation key was provided
+    return result, 200
+
+
+@app.route('/agent/pair/bulk', methods=['POST'])
+def agent_register_bulk():
+    db = database.new_connection()
+
+    if 'agents' not in request.json or not isinstance(request.json['agents'], list):
+        return 'List of agents not provided', 400
+    if not all(isinstance(agent, dict) for agent in request.json['agents']):
+        return 'Each agent must be an object with an agent_name', 400
     if 'pairing_key' not in request.json:
         return 'Activation key not provided', 400
 
-    #does the activation key exist?
-    activation_key: LVENPairingKey.PairingKeyObject = database.LVENPairingKey.get_single(db, request.json['pairing_key'])
-    if activation_key is None:
-        return 'Activation key does not exist', 400
+    try:
+        activation_key = pairing.validate_activation_key(db, request.json['pairing_key'])
+    except pairing.PairingError as e:
+        return e.message, e.http_status
+
+    results = pairing.bulk_pair_agents(db, request.json['agents'], activation_key)
+
+    return {'results': results}, 200
+
+
+@app.route('/agent/pair/<job_id>', methods=['GET'])
+def agent_register_job_status(job_id: str):
+    job = pairing.get_pairing_job(job_id)
+    if job is None:
+        return 'Pairing job does not exist', 404
+
+    return job, 200
+
+
+def admin_api_route(route_function: Callable) -> Callable:
+    # the admin API answers 404 until runtime_env admin_api_token is set, then requires it as a bearer token
+    @functools.wraps(route_function)
+    def wrapper(*args, **kwargs):
+        token = runtime_env.settings_admin_api_token
+        if token is None:
+            return 'Admin API is disabled', 404
+        authorization = request.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or not hmac.compare_digest(authorization[len('Bearer '):].encode(), token.encode()):
+            return 'Admin API token is missing or incorrect', 401
+        return route_function(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route('/agents/stale', methods=['GET'])
+@admin_api_route
+def agents_stale():
+    # agents without heartbeat for more than 'threshold' seconds, lists agent uuids so it is part of the admin API
+    threshold = request.args.get('threshold', type=int)
+    if threshold is None or threshold < 0:
+        return 'Threshold (seconds) not provided or invalid', 400
+    if liveness.is_started():
+        stale_agents = liveness.get_stale_agents(threshold)
+    elif runtime_env.settings_server_mode == 'prefork':
+        # prefork workers share their heartbeats through the database, late by up to the heartbeat flush interval
+        stale_agents = [agent['uuid'] for agent in LVENAgent.iter_agents(database.new_connection(),
+                                                                         heartbeat_older_than=time.time() - threshold)]
+    else:
+        return 'Liveness tracking is not running', 503
+
+    return {'threshold': threshold, 'count': len(stale_agents), 'agents': stale_agents}, 200
 
-    #is the activation key still valid?
-    if activation_key['valid_until'] is not None and activation_key['valid_until'] < int(time.time()):
-        return 'Activation key has expired', 400
 
-    #does it still have enough use counts?
-    if activation_key['remaining_uses'] is not None and activation_key['remaining_uses'] <= 0:
-        return 'Activation key has no more uses left', 400
+def authenticate_agent(db, agent_uuid: str) -> tuple[Optional[LVENAgent.AgentCredentials], Optional[tuple[str, int]]]:
+    # returns the agent credentials or the error response to send back, served from cache in steady state
+    token = get_agent_token(request.get_json(silent=True))
+    if token is not None:
+        # no database read, the agent uuid and workload are in the signed token
+        claims, error_response = agent_tokens.verify_with_refresh(db, agent_uuid, token)
+        if error_response is not None:
+            return None, error_response
+        return LVENAgent.AgentCredentials(pce_workload_href=claims['pce_workload_href']), None
 
-    # does the agent_name exists in the PCE?
-    pce_workloads = ilo_api.find_unmanaged_workloads_with_specific_name(agent_name)
-    if len(pce_workloads) == 0:
-        return 'Agent name does not exist in the PCE or is already managed', 400
-    if len(pce_workloads) > 1:
-        return 'Agent name exists more than once in the PCE', 400
+    #does the agent uuid exist?
+    credentials = database.LVENAgent.get_credentials(db, agent_uuid)
+    if credentials is None:
+        return None, ('Agent UUID does not exist', 404)
 
-    workload_href = pce_workloads[0]['href']
+    error_response = check_agent_authentication_key(credentials, request.json)
+    if error_response is not None:
+        return None, error_response
 
-    if activation_key['target_switch_href'] is not None:
-        # does the switch still exist in the PCE?
-        switch = ilo_api.find_switch_from_href_or_name(activation_key['target_switch_href'])
-        if switch is None:
-            return 'Target switch does not exist in the PCE', 400
-        # is the workload_href already bound to the switch?
-        if ilo_api.find_if_workload_is_already_assigned_to_a_switch_port(workload_href, activation_key['target_switch_href']):
-            return 'Workload is already bound to the switch', 400
+    return credentials, None
 
-        # bind the workload to the switch
-        logging.info('Binding workload {workload_href} to switch {activation_key["target_switch_href"]}')
-        ilo_api.bind_workload_to_switch(workload_href, activation_key['target_switch_href'])
 
+def get_agent_token(request_json) -> Optional[str]:
+    # shared with asgi_server, the signed token the agent authenticates with if any, see agent_tokens
+    if not runtime_env.settings_agent_tokens_enabled or not isinstance(request_json, dict):
+        return None
+    return request_json.get('authentication_token')
 
-    # create the agent
-    agent = database.LVENAgent.create(db, agent_name, pce_workload_href=workload_href)
 
-    # decrease the use count of the activation key
-    if activation_key['remaining_uses'] is not None:
-        database.LVENPairingKey.decrease_use_count(db, activation_key['key'])
+def check_agent_authentication_key(credentials: LVENAgent.AgentCredentials, request_json: dict) -> Optional[tuple[str, int]]:
+    # shared with asgi_server, returns the error response to send back if any
+    #is the authentication key correct?
+    if 'authentication_key' not in request_json:
+        return 'Authentication key not provided', 403
+    if request_json['authentication_key'] != credentials['authentication_key']:
+        return 'Authentication key is incorrect', 403
+
+    return None
 
-    return {'agent_uuid': agent['uuid'], 'authentication_key': agent['authentication_key'] }, 200
+
+def get_heartbeat_ip_addresses(request_json: dict) -> tuple[Optional[frozenset[str]], Optional[tuple[str, int]]]:
+    # shared with asgi_server, the optional 'ip_addresses' of a heartbeat or the error response to send back
+    if 'ip_addresses' not in request_json:
+        return None, None
+    ip_addresses = LVENAgentIPAddress.parse_ip_addresses(request_json['ip_addresses'])
+    if ip_addresses is None:
+        return None, (f'Invalid IP addresses, a list of at most {LVENAgentIPAddress.max_ip_addresses_per_agent} is expected', 400)
+    return ip_addresses, None
 
 
 @app.route('/agent/<agent_uuid>/heartbeat', methods=['POST'])
 def agent_heartbeat(agent_uuid: str):
     db = database.new_connection()
 
-    #does the agent uuid exist?
-    agent: LVENAgent.LVENAgentObject = database.LVENAgent.get(db, agent_uuid)
-    if agent is None:
-        return 'Agent UUID does not exist', 404
+    agent, error_response = authenticate_agent(db, agent_uuid)
+    if error_response is not None:
+        return error_response
 
-    #is the authentication key correct?
-    if 'authentication_key' not in request.json:
-        return 'Authentication key not provided', 403
-    if request.json['authentication_key'] != agent['authentication_key']:
-        return 'Authentication key is incorrect', 403
+    ip_addresses, error_response = get_heartbeat_ip_addresses(request.json)
+    if error_response is not None:
+        return error_response
 
-    # update the last heartbeat
-    database.LVENAgent.heartbeat(db, agent_uuid)
+    # update the last heartbeat, it will be written to the database by the next flush
+    database.LVENAgent.record_heartbeat(db, agent_uuid)
+    # IP addresses are only written when they changed, agent_ip_sync pushes them to the PCE later
+    if ip_addresses is not None:
+        LVENAgentIPAddress.update(db, agent_uuid, ip_addresses)
 
     return {'action': 'agent_heartbeat','status': 'success'}, 200
 
@@ -104,25 +341,215 @@ def agent_heartbeat(agent_uuid: str):
 def agent_active_policies(agent_uuid: str):
     db = database.new_connection()
 
-    #does the agent uuid exist?
-    agent: LVENAgent.LVENAgentObject = database.LVENAgent.get(db, agent_uuid)
-    if agent is None:
+    agent, error_response = authenticate_agent(db, agent_uuid)
+    if error_response is not None:
+        return error_response
+
+    # get the active policies, agents already holding the current version only get a 304, or a delta if they ask for it
+    active_policies = ilo_api.get_workload_active_policies_cached(agent['pce_workload_href'])
+    rendered = policy_delivery.render_active_policies(agent['pce_workload_href'], active_policies, request.if_none_match,
+                                                      policy_delivery.accepts_delta(request.headers.get('A-IM')),
+                                                      request.headers.get('Accept-Encoding'))
+
+    return Response(rendered['body'], status=rendered['status'], headers=rendered['headers'])
+
+
+def get_policy_watch_parameters(request_json: dict, if_none_match: Optional[str]) -> tuple[Optional[str], Optional[float]]:
+    # (version the agent holds, timeout) of an active_policies/watch request, shared with asgi_server. timeout is None if invalid
+    version = request_json.get('version')
+    if version is None and if_none_match:
+        etags = parse_etags(if_none_match)
+        version = next(iter(etags), None)
+    timeout = request_json.get('timeout', runtime_env.settings_policy_watch_default_timeout)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout < 0:
+        return version, None
+    return version, min(timeout, runtime_env.settings_policy_watch_max_timeout)
+
+
+@app.route('/agent/<agent_uuid>/active_policies/watch', methods=['POST'])
+def agent_active_policies_watch(agent_uuid: str):
+    # long-poll: answers as soon as the active policies differ from 'version' (or If-None-Match), 304 after 'timeout' seconds
+    db = database.new_connection()
+
+    agent, error_response = authenticate_agent(db, agent_uuid)
+    if error_response is not None:
+        return error_response
+
+    version, timeout = get_policy_watch_parameters(request.json, request.headers.get('If-None-Match'))
+    if timeout is None:
+        return 'Timeout must be a positive number of seconds', 400
+
+    watcher = policy_watcher.get_watcher()
+    if watcher is None:
+        # no watcher (ie: development server), answer right away
+        active_policies = ilo_api.get_workload_active_policies_cached(agent['pce_workload_href'])
+        if active_policies['etag'] == version:
+            active_policies = None
+    elif watcher.max_blocking_waiters == 0:
+        # threaded server mode without threads sized for long-polling, see runtime_env policy_watch_max_blocking_waiters
+        return f"Waiting for active policies changes is not enabled in server_mode '{runtime_env.settings_server_mode}'", 501
+    else:
+        try:
+            active_policies = watcher.wait_for_change(agent['pce_workload_href'], version, timeout)
+        except policy_watcher.TooManyWaitersEx as e:
+            # policy_watch_max_blocking_waiters are already waiting, the agent comes back after the next policy check
+            return Response(str(e), status=503, headers={'Retry-After': str(max(1, int(runtime_env.settings_policy_watch_interval)))})
+
+    if active_policies is None:
+        response = Response(status=304)
+        if version is not None:
+            response.set_etag(version)
+        return response
+
+    rendered = policy_delivery.render_active_policies(agent['pce_workload_href'], active_policies, [version] if version is not None else [],
+                                                      policy_delivery.accepts_delta(request.headers.get('A-IM')),
+                                                      request.headers.get('Accept-Encoding'))
+    return Response(rendered['body'], status=rendered['status'], headers=rendered['headers'])
+
+
+def get_page_size() -> Optional[int]:
+    # ?limit=, defaults to and capped by runtime_env admin_api_max_page_size, None if invalid
+    limit = request.args.get('limit', default=runtime_env.settings_admin_api_max_page_size, type=int)
+    if limit is None or limit <= 0:
+        return None
+    return min(limit, runtime_env.settings_admin_api_max_page_size)
+
+
+def get_batch(field: str) -> Optional[list[str]]:
+    # list of strings to batch delete from the request body, None if invalid
+    if request.json is None or not isinstance(request.json.get(field), list):
+        return None
+    if not all(isinstance(value, str) for value in request.json[field]):
+        return None
+    return request.json[field]
+
+
+@app.route('/admin/agents', methods=['GET'])
+@admin_api_route
+def admin_agents_list():
+    # keyset pagination: pass the returned 'next_after' as ?after= to get the next page
+    limit = get_page_size()
+    if limit is None:
+        return 'Limit must be a positive integer', 400
+    include_authentication_keys = request.args.get('include_authentication_keys', default='false').lower() == 'true'
+
+    db = database.new_connection()
+    # one extra row tells if there is a next page
+    agents = list(LVENAgent.iter_agents(db, after_uuid=request.args.get('after'), limit=limit + 1,
+                                        name_prefix=request.args.get('name_prefix')))
+    next_after = agents[limit - 1]['uuid'] if len(agents) > limit else None
+    agents = agents[:limit]
+    if not include_authentication_keys:
+        for agent in agents:
+            del agent['authentication_key']
+
+    return {'agents': agents, 'next_after': next_after}, 200
+
+
+@app.route('/admin/agents', methods=['POST'])
+@admin_api_route
+def admin_agents_create():
+    # creates an agent for an existing PCE workload, bypassing the pairing keys
+    if request.json is None or not isinstance(request.json.get('agent_name'), str) or not isinstance(request.json.get('pce_workload_href'), str):
+        return 'agent_name and pce_workload_href must be provided', 400
+
+    db = database.new_connection()
+    if LVENAgent.name_exists(db, request.json['agent_name']):
+        return 'Agent name already exists', 409
+
+    agent = LVENAgent.create(db, request.json['agent_name'], request.json['pce_workload_href'])
+
+    return agent, 201
+
+
+@app.route('/admin/agents/<agent_uuid>', methods=['DELETE'])
+@admin_api_route
+def admin_agents_delete(agent_uuid: str):
+    db = database.new_connection()
+    try:
+        LVENAgent.delete(db, agent_uuid)
+    except ValueError:
         return 'Agent UUID does not exist', 404
 
-    #is the authentication key correct?
-    if 'authentication_key' not in request.json:
-        return 'Authentication key not provided', 403
-    if request.json['authentication_key'] != agent['authentication_key']:
-        return 'Authentication key is incorrect', 403
+    return {'deleted': [agent_uuid]}, 200
+
+
+@app.route('/admin/agents/delete', methods=['POST'])
+@admin_api_route
+def admin_agents_delete_batch():
+    agent_uuids = get_batch('uuids')
+    if agent_uuids is None:
+        return 'List of uuids not provided', 400
+
+    db = database.new_connection()
+    deleted_uuids = LVENAgent.delete_many(db, agent_uuids)
+    deleted_uuids_set = set(deleted_uuids)
+
+    return {'deleted': deleted_uuids, 'not_found': [agent_uuid for agent_uuid in agent_uuids if agent_uuid not in deleted_uuids_set]}, 200
 
-    # get the active policies
-    active_policies = ilo_api.get_workload_active_policies(agent['pce_workload_href'])
 
-    return active_policies, 200
+@app.route('/admin/pairing_keys', methods=['GET'])
+@admin_api_route
+def admin_pairing_keys_list():
+    # keyset pagination: pass the returned 'next_after' as ?after= to get the next page
+    limit = get_page_size()
+    if limit is None:
+        return 'Limit must be a positive integer', 400
+    usable_only = request.args.get('usable_only', default='false').lower() == 'true'
 
+    db = database.new_connection()
+    pairing_keys = list(LVENPairingKey.iter_pairing_keys(db, after_key=request.args.get('after'), limit=limit + 1, usable_only=usable_only))
+    next_after = pairing_keys[limit - 1]['key'] if len(pairing_keys) > limit else None
+
+    return {'pairing_keys': pairing_keys[:limit], 'next_after': next_after}, 200
+
+
+@app.route('/admin/pairing_keys', methods=['POST'])
+@admin_api_route
+def admin_pairing_keys_create():
+    # same parameters as 'pairing-key-manager create', null meaning unlimited
+    request_json = request.json if request.json is not None else {}
+    valid_for = request_json.get('valid_for')
+    remaining_uses = request_json.get('remaining_uses')
+    if valid_for is not None and (not isinstance(valid_for, int) or valid_for <= 0):
+        return 'valid_for must be a positive integer or null', 400
+    if remaining_uses is not None and (not isinstance(remaining_uses, int) or remaining_uses <= 0):
+        return 'remaining_uses must be a positive integer or null', 400
+
+    target_switch_href = None
+    if request_json.get('target_switch_href_or_name') is not None:
+        switch = ilo_api.find_switch_from_href_or_name(request_json['target_switch_href_or_name'])
+        if switch is None:
+            return 'Target switch not found in the PCE', 400
+        target_switch_href = switch['href']
+
+    db = database.new_connection()
+    pairing_key = LVENPairingKey.create(db, valid_for, remaining_uses, target_switch_href)
 
+    return pairing_key, 201
 
 
+@app.route('/admin/pairing_keys/<pairing_key>', methods=['DELETE'])
+@admin_api_route
+def admin_pairing_keys_delete(pairing_key: str):
+    db = database.new_connection()
+    try:
+        LVENPairingKey.delete(db, pairing_key)
+    except LVENPairingKey.LVENPairingKeyDoesNotExist:
+        return 'Pairing key does not exist', 404
+
+    return {'deleted': [pairing_key]}, 200
 
 
+@app.route('/admin/pairing_keys/delete', methods=['POST'])
+@admin_api_route
+def admin_pairing_keys_delete_batch():
+    pairing_keys = get_batch('keys')
+    if pairing_keys is None:
+        return 'List of keys not provided', 400
+
+    db = database.new_connection()
+    deleted_keys = LVENPairingKey.delete_many(db, pairing_keys)
+    deleted_keys_set = set(deleted_keys)
 
+    return {'deleted': deleted_keys, 'not_found': [pairing_key for pairing_key in pairing_keys if pairing_key not in deleted_keys_set]}, 200
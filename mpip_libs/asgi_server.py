@@ -0,0 +1,303 @@
+import asyncio
+import io
+import json
+import logging
+import re
+import sys
+import time
+from typing import Any, Callable, Optional
+
+from werkzeug.http import parse_etags, quote_etag
+
+import mpip_libs.agent_tokens as agent_tokens
+import mpip_libs.api_server as api_server
+import mpip_libs.database as database
+import mpip_libs.ilo_api as ilo_api
+import mpip_libs.ilo_api_async as ilo_api_async
+import mpip_libs.metrics as metrics
+import mpip_libs.policy_delivery as policy_delivery
+import mpip_libs.policy_watcher as policy_watcher
+from mpip_libs.database import LVENAgent, LVENAgentIPAddress
+from mpip_libs.pce_guard import PCEUnavailableEx
+
+# 'asgi' server mode (runtime_env server_mode), needs uvicorn.
+# the agents routes are served by coroutines so requests waiting on the PCE don't hold a thread. SQLite calls are
+# short and run in the default executor threads on their pooled connections. Every other route is passed to the
+# Flask app in api_server, run in a worker thread like waitress would.
+
+listen_host = '0.0.0.0'
+listen_port = 9111
+
+_agent_route_regex = re.compile(r'^/agent/([^/]+)/(heartbeat|active_policies|active_policies/watch)$')
+
+metrics.register(metrics.StatsGauges('mpip_pce_async_single_flight', 'Coalesced native PCE calls of the asgi server',
+                                     ilo_api_async.get_single_flight_stats))
+
+
+def serve():
+    import uvicorn
+    uvicorn.run(app, host=listen_host, port=listen_port, lifespan='on', log_level='info')
+
+
+async def run_db(function: Callable, *args) -> Any:
+    # runs function(db, *args) with the pooled connection of an executor thread
+    return await asyncio.to_thread(lambda: function(database.new_connection(), *args))
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def _send_response(send, status: int, body: bytes = b'', content_type: Optional[str] = None, headers: Optional[list] = None):
+    response_headers = [(b'content-length', str(len(body)).encode())]
+    if content_type is not None:
+        response_headers.append((b'content-type', content_type.encode()))
+    if headers is not None:
+        response_headers.extend(headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_text(send, text: str, status: int):
+    await _send_response(send, status, text.encode(), 'text/html; charset=utf-8')
+
+
+async def _send_json(send, value: Any, status: int = 200):
+    await _send_response(send, status, json.dumps(value).encode(), 'application/json')
+
+
+def _get_header(scope, name: bytes) -> Optional[str]:
+    for header_name, header_value in scope['headers']:
+        if header_name == name:
+            return header_value.decode('latin-1')
+    return None
+
+
+async def _authenticate_agent(agent_uuid: str, body: bytes) -> tuple[Optional[LVENAgent.AgentCredentials], dict, Optional[tuple[str, int]]]:
+    # same checks and responses as api_server.authenticate_agent(), also returns the parsed body
+    try:
+        request_json = json.loads(body)
+    except ValueError:
+        request_json = None
+
+    token = api_server.get_agent_token(request_json)
+    if token is not None:
+        # the revocations list is the only database read, once per refresh interval
+        if agent_tokens.revocations_need_refresh():
+            await run_db(agent_tokens.refresh_revocations)
+        claims, error_response = agent_tokens.verify(agent_uuid, token)
+        if error_response is not None:
+            return None, request_json, error_response
+        return LVENAgent.AgentCredentials(pce_workload_href=claims['pce_workload_href']), request_json, None
+
+    credentials = await run_db(LVENAgent.get_credentials, agent_uuid)
+    if credentials is None:
+        return None, {}, ('Agent UUID does not exist', 404)
+
+    if not isinstance(request_json, dict):
+        return None, {}, ('Invalid JSON body', 400)
+
+    error_response = api_server.check_agent_authentication_key(credentials, request_json)
+    if error_response is not None:
+        return None, request_json, error_response
+
+    return credentials, request_json, None
+
+
+async def agent_heartbeat(scope, send, agent_uuid: str, body: bytes) -> int:
+    credentials, request_json, error_response = await _authenticate_agent(agent_uuid, body)
+    if error_response is not None:
+        await _send_text(send, *error_response)
+        return error_response[1]
+
+    ip_addresses, error_response = api_server.get_heartbeat_ip_addresses(request_json)
+    if error_response is not None:
+        await _send_text(send, *error_response)
+        return error_response[1]
+
+    await run_db(LVENAgent.record_heartbeat, agent_uuid)
+    if ip_addresses is not None:
+        await run_db(LVENAgentIPAddress.update, agent_uuid, ip_addresses)
+
+    await _send_json(send, {'action': 'agent_heartbeat', 'status': 'success'})
+    return 200
+
+
+async def agent_active_policies(scope, send, agent_uuid: str, body: bytes) -> int:
+    credentials, request_json, error_response = await _authenticate_agent(agent_uuid, body)
+    if error_response is not None:
+        await _send_text(send, *error_response)
+        return error_response[1]
+
+    active_policies = await ilo_api_async.get_workload_active_policies_cached(credentials['pce_workload_href'])
+    return await _send_active_policies(scope, send, credentials['pce_workload_href'], active_policies,
+                                       parse_etags(_get_header(scope, b'if-none-match')))
+
+
+async def _send_active_policies(scope, send, workload_href: str, active_policies: ilo_api.CachedActivePolicies, known_versions) -> int:
+    rendered = policy_delivery.render_active_policies(workload_href, active_policies, known_versions,
+                                                      policy_delivery.accepts_delta(_get_header(scope, b'a-im')),
+                                                      _get_header(scope, b'accept-encoding'))
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in rendered['headers'].items()]
+    await _send_response(send, rendered['status'], rendered['body'], headers=headers)
+    return rendered['status']
+
+
+async def _wait_for_policies_change(watcher: policy_watcher.PolicyWatcher, workload_href: str,
+                                    current: ilo_api.CachedActivePolicies, timeout: float) -> Optional[ilo_api.CachedActivePolicies]:
+    # same as PolicyWatcher.wait_for_change() without holding a thread, the watcher thread resolves a future of this loop
+    loop = asyncio.get_running_loop()
+    changed_future = loop.create_future()
+
+    def resolve(policies: ilo_api.CachedActivePolicies):
+        if not changed_future.done():
+            changed_future.set_result(policies)
+
+    def notify(policies: ilo_api.CachedActivePolicies):
+        loop.call_soon_threadsafe(resolve, policies)
+
+    watcher.add_waiter(workload_href, current, notify)
+    try:
+        return await asyncio.wait_for(changed_future, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        watcher.remove_waiter(workload_href, notify)
+
+
+async def agent_active_policies_watch(scope, send, agent_uuid: str, body: bytes) -> int:
+    credentials, request_json, error_response = await _authenticate_agent(agent_uuid, body)
+    if error_response is not None:
+        await _send_text(send, *error_response)
+        return error_response[1]
+
+    version, timeout = api_server.get_policy_watch_parameters(request_json, _get_header(scope, b'if-none-match'))
+    if timeout is None:
+        await _send_text(send, 'Timeout must be a positive number of seconds', 400)
+        return 400
+
+    active_policies = await ilo_api_async.get_workload_active_policies_cached(credentials['pce_workload_href'])
+    if active_policies['etag'] == version:
+        watcher = policy_watcher.get_watcher()
+        if watcher is None:
+            # no watcher, answer right away
+            active_policies = None
+        else:
+            active_policies = await _wait_for_policies_change(watcher, credentials['pce_workload_href'], active_policies, timeout)
+
+    if active_policies is None:
+        await _send_response(send, 304, headers=[(b'etag', quote_etag(version).encode())])
+        return 304
+
+    return await _send_active_policies(scope, send, credentials['pce_workload_href'], active_policies,
+                                       [version] if version is not None else [])
+
+
+_agent_routes = {'heartbeat': ('/agent/<agent_uuid>/heartbeat', agent_heartbeat),
+                 'active_policies': ('/agent/<agent_uuid>/active_policies', agent_active_policies),
+                 'active_policies/watch': ('/agent/<agent_uuid>/active_policies/watch', agent_active_policies_watch)}
+
+
+def _build_wsgi_environ(scope, body: bytes) -> dict:
+    server = scope.get('server') or ('localhost', listen_port)
+    client = scope.get('client') or ('', 0)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+               'REMOTE_ADDR': client[0],
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for header_name, header_value in scope['headers']:
+        name = header_name.decode('latin-1').upper().replace('-', '_')
+        value = header_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+async def _call_flask_app(scope, send, body: bytes):
+    environ = _build_wsgi_environ(scope, body)
+    response_start = {}
+
+    def start_response(status: str, headers: list, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def run_flask_app() -> bytes:
+        result = api_server.app(environ, start_response)
+        try:
+            return b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    response_body = await asyncio.to_thread(run_flask_app)
+    await send({'type': 'http.response.start', 'status': response_start['status'], 'headers': response_start['headers']})
+    await send({'type': 'http.response.body', 'body': response_body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await ilo_api_async.start()
+            logging.info(f"ASGI server ready, native PCE client: {ilo_api_async.is_native()}")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await ilo_api_async.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await _read_body(receive)
+
+    match = _agent_route_regex.match(scope['path'])
+    if match is None or scope['method'] != 'POST':
+        # the Flask app records its own metrics
+        await _call_flask_app(scope, send, body)
+        return
+
+    route, handler = _agent_routes[match.group(2)]
+    start_time = time.perf_counter()
+    try:
+        status = await handler(scope, send, match.group(1), body)
+    except PCEUnavailableEx as exception:
+        status = 503
+        await _send_response(send, status, str(exception).encode(), 'text/html; charset=utf-8',
+                             [(b'retry-after', str(api_server.retry_after_pce_unavailable()).encode())])
+    except Exception:
+        logging.exception(f"Exception on {scope['method']} {scope['path']}")
+        status = 500
+        await _send_text(send, 'Internal Server Error', status)
+    metrics.http_requests_total.inc(route, scope['method'], str(status))
+    metrics.http_request_duration_seconds.observe(time.perf_counter() - start_time, route, scope['method'], str(status))
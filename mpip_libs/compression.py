@@ -0,0 +1,49 @@
+import gzip
+from typing import Optional
+
+from werkzeug.http import parse_accept_header
+
+import mpip_libs.runtime_env as runtime_env
+
+# Content-Encoding negotiation for the responses. zstd is only offered when the optional zstandard package is installed.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+gzip_level = 6
+zstd_level = 3
+
+# preferred first
+supported_encodings = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+compressible_mimetypes = ('application/json', 'text/plain', 'text/html')
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    # best supported encoding accepted by the client, None for identity
+    if not runtime_env.settings_response_compression_enabled or not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best_encoding = None
+    best_quality = 0
+    for encoding in supported_encodings:
+        # quality() falls back to '*' when the encoding is not listed
+        quality = accepted.quality(encoding)
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+    return best_encoding
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        # mtime=0 so the same data always gives the same bytes
+        return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    raise ValueError(f'Unsupported content encoding {encoding}')
+
+
+def should_compress(data_length: int, mimetype: Optional[str]) -> bool:
+    return data_length >= runtime_env.settings_response_compression_min_size and mimetype in compressible_mimetypes
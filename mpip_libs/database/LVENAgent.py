@@ -1,9 +1,17 @@
-from typing import TypedDict, Optional
+from typing import Iterator, NotRequired, TypedDict, Optional
+import logging
 import random
+import threading
 import time
 import uuid
 from sqlite3 import Connection
 
+import mpip_libs.database as database
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs import agent_tokens, liveness, shared_state
+from mpip_libs.cache import LRUCache, CacheStats
+from mpip_libs.misc import PeriodicWorker
+
 class LVENAgentObject(TypedDict):
     uuid: str
     name: str
@@ -12,9 +20,21 @@ class LVENAgentObject(TypedDict):
     last_heartbeat: int
     created_at: int
 
+class AgentCredentials(TypedDict):
+    authentication_key: NotRequired[str] # not known when the agent authenticated with a signed token
+    pce_workload_href: str
+
 class LVENAgentNotFound(Exception):
     pass
 
+# uuid -> AgentCredentials (or None for unknown agents), created on first use so runtime_env settings are loaded
+_credentials_cache: Optional[LRUCache] = None
+_credentials_cache_lock = threading.Lock()
+# shared_state generation the cache content matches, other prefork workers bump it when agents are deleted
+_credentials_cache_generation = 0
+# entries invalidated by this process, a lookup which read the database before an invalidation doesn't cache its result
+_credentials_cache_invalidations = 0
+
 def row_to_agent(row: dict) -> LVENAgentObject:
     return LVENAgentObject(uuid=row['uuid'], name=row['name'], pce_workload_href=row['pce_workload_href'],
                           created_at=row['created_at'] , last_heartbeat=row['last_heartbeat'], authentication_key=row['authentication_key'])
@@ -33,25 +53,60 @@ def delete(db: Connection, agent_uuid: str):
     c = db.cursor()
     c.execute('DELETE FROM lven_agents WHERE uuid = ?', (agent_uuid,))
     db.commit()
+    _invalidate_cached_credentials([agent_uuid])
+    shared_state.bump_generation('agent_credentials')
+    agent_tokens.expire_revocations()
+    liveness.forget(agent_uuid)
     # count the number of rows deleted
     if c.rowcount == 0:
         raise ValueError(f"Agent with UUID {agent_uuid} does not exist")
 
-def create(db: Connection, agent_name: str, pce_workload_href: str) -> LVENAgentObject:
-    # Generate a UUID for the agent and make sure it doesn't exist
-    agent_uuid = str(uuid.uuid4())
-    authentication_key = random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=64)
-    authentication_key = ''.join(authentication_key)
+def delete_many(db: Connection, agent_uuids: list[str]) -> list[str]:
+    # returns the uuids which were deleted, unknown ones are ignored
+    deleted_uuids = []
+    c = db.cursor()
+    # chunked to stay below SQLite's host parameters limit
+    for index in range(0, len(agent_uuids), database.max_statement_parameters):
+        chunk = agent_uuids[index:index + database.max_statement_parameters]
+        c.execute(f"DELETE FROM lven_agents WHERE uuid IN ({','.join('?' * len(chunk))}) RETURNING uuid", chunk)
+        deleted_uuids.extend(row['uuid'] for row in c.fetchall())
+    db.commit()
+
+    _invalidate_cached_credentials(deleted_uuids)
+    for agent_uuid in deleted_uuids:
+        liveness.forget(agent_uuid)
+    if len(deleted_uuids) > 0:
+        shared_state.bump_generation('agent_credentials')
+        agent_tokens.expire_revocations()
+    return deleted_uuids
 
-    while uuid_exists(db, agent_uuid):
-        agent_uuid = str(uuid.uuid4())
+def create(db: Connection, agent_name: str, pce_workload_href: str, commit: bool = True) -> LVENAgentObject:
+    # commit=False lets the caller include the insert in a larger transaction (ie: with the pairing key consumption)
+    return create_many(db, [(agent_name, pce_workload_href)], commit=commit)[0]
+
+def create_many(db: Connection, agents: list[tuple[str, str]], commit: bool = True) -> list[LVENAgentObject]:
+    # agents is a list of (agent_name, pce_workload_href) inserted in a single transaction
+    now = time.time()
+    new_agents: list[LVENAgentObject] = []
+    for agent_name, pce_workload_href in agents:
+        authentication_key = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=64))
+        # uuid4 collisions are not realistic, the primary key would reject the insert anyway
+        new_agents.append(LVENAgentObject(uuid=str(uuid.uuid4()), name=agent_name, pce_workload_href=pce_workload_href,
+                                          authentication_key=authentication_key, last_heartbeat=now, created_at=now))
 
     c = db.cursor()
-    c.execute('INSERT INTO lven_agents (uuid, name, pce_workload_href, last_heartbeat, created_at, authentication_key) VALUES (?, ?, ?, ?, ?, ?)',
-              (agent_uuid, agent_name, pce_workload_href, time.time(), time.time(), authentication_key))
-    db.commit()
+    c.executemany('INSERT INTO lven_agents (uuid, name, pce_workload_href, last_heartbeat, created_at, authentication_key) VALUES (?, ?, ?, ?, ?, ?)',
+                  [(agent['uuid'], agent['name'], agent['pce_workload_href'], agent['last_heartbeat'], agent['created_at'], agent['authentication_key'])
+                   for agent in new_agents])
+    if commit:
+        db.commit()
+
+    # unknown uuids are cached for a short time
+    _invalidate_cached_credentials([agent['uuid'] for agent in new_agents])
+    for agent in new_agents:
+        liveness.record_heartbeat(agent['uuid'], agent['last_heartbeat'])
 
-    return get(db, agent_uuid)
+    return new_agents
 
 def get(db: Connection, agent_uuid: str) -> Optional[LVENAgentObject]:
     c = db.cursor()
@@ -61,16 +116,121 @@ def get(db: Connection, agent_uuid: str) -> Optional[LVENAgentObject]:
         return None
     return row_to_agent(row)
 
+def _get_credentials_cache() -> LRUCache:
+    global _credentials_cache, _credentials_cache_generation
+    if _credentials_cache is None:
+        with _credentials_cache_lock:
+            if _credentials_cache is None:
+                _credentials_cache = LRUCache(max_entries=runtime_env.settings_agent_credentials_cache_max_entries,
+                                              default_ttl=runtime_env.settings_agent_credentials_cache_ttl)
+    generation = shared_state.get_generation('agent_credentials')
+    if generation != _credentials_cache_generation:
+        with _credentials_cache_lock:
+            if generation != _credentials_cache_generation:
+                # entries cached before the change are dropped before they can be read
+                _credentials_cache.clear()
+                _credentials_cache_generation = generation
+    return _credentials_cache
+
+def _get_credentials_cache_version() -> tuple[int, int]:
+    return shared_state.get_generation('agent_credentials'), _credentials_cache_invalidations
+
+def _set_cached_credentials(agent_uuid: str, credentials: Optional[AgentCredentials], version: tuple[int, int],
+                            ttl: Optional[float] = None):
+    # version is _get_credentials_cache_version() before the database was read: an agent deleted since then must
+    # not be cached again
+    cache = _get_credentials_cache()
+    with _credentials_cache_lock:
+        if _get_credentials_cache_version() != version:
+            return
+        cache.set(agent_uuid, credentials, ttl=ttl)
+
+def _invalidate_cached_credentials(agent_uuids: Optional[list[str]] = None):
+    # None for all the agents
+    global _credentials_cache_invalidations
+    cache = _get_credentials_cache()
+    with _credentials_cache_lock:
+        _credentials_cache_invalidations += 1
+        if agent_uuids is None:
+            cache.clear()
+        else:
+            for agent_uuid in agent_uuids:
+                cache.invalidate(agent_uuid)
+
+def get_credentials(db: Connection, agent_uuid: str) -> Optional[AgentCredentials]:
+    # cached lookup used to authenticate agent requests, unknown UUIDs are cached for a shorter time.
+    # entries expire so changes made by another process (ie: CLI) are eventually picked up.
+    found, credentials = _get_credentials_cache().get(agent_uuid)
+    if found:
+        return credentials
+
+    version = _get_credentials_cache_version()
+    c = db.cursor()
+    c.execute('SELECT authentication_key, pce_workload_href FROM lven_agents WHERE uuid = ?', (agent_uuid,))
+    row = c.fetchone()
+    if row is None:
+        _set_cached_credentials(agent_uuid, None, version, ttl=runtime_env.settings_agent_credentials_cache_negative_ttl)
+        return None
+
+    credentials = AgentCredentials(authentication_key=row['authentication_key'], pce_workload_href=row['pce_workload_href'])
+    _set_cached_credentials(agent_uuid, credentials, version)
+    return credentials
+
+def get_credentials_cache_stats() -> CacheStats:
+    return _get_credentials_cache().get_stats()
+
 def get_all(db: Connection) -> list[LVENAgentObject]:
+    return list(iter_agents(db))
+
+def iter_agents(db: Connection, after_uuid: Optional[str] = None, limit: Optional[int] = None,
+                name_prefix: Optional[str] = None, heartbeat_older_than: Optional[float] = None,
+                heartbeat_newer_than: Optional[float] = None) -> Iterator[LVENAgentObject]:
+    # streams agents ordered by uuid straight from the cursor, after_uuid is the last uuid of the previous page.
+    # heartbeats still in the server write-behind buffer are not seen by the heartbeat filters.
+    conditions = []
+    parameters = []
+    if after_uuid is not None:
+        conditions.append('uuid > ?')
+        parameters.append(after_uuid)
+    if name_prefix is not None and name_prefix != '':
+        # a range instead of LIKE so the name index can be used and '%' or '_' in names are not wildcards
+        conditions.append('name >= ? AND name < ?')
+        parameters.extend((name_prefix, name_prefix + '\U0010ffff'))
+    if heartbeat_older_than is not None:
+        conditions.append('last_heartbeat < ?')
+        parameters.append(heartbeat_older_than)
+    if heartbeat_newer_than is not None:
+        conditions.append('last_heartbeat >= ?')
+        parameters.append(heartbeat_newer_than)
+
+    query = 'SELECT * FROM lven_agents'
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY uuid'
+    if limit is not None:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+
     c = db.cursor()
-    c.execute('SELECT * FROM lven_agents')
-    rows = c.fetchall()
-    return [row_to_agent(row) for row in rows]
+    c.execute(query, parameters)
+    for row in c:
+        yield row_to_agent(row)
+
+def iter_heartbeats(db: Connection):
+    # (uuid, last_heartbeat) of all agents, used to seed the liveness tracker
+    c = db.cursor()
+    c.execute('SELECT uuid, last_heartbeat FROM lven_agents')
+    for row in c:
+        yield row['uuid'], row['last_heartbeat']
 
 def delete_all(db: Connection):
     c = db.cursor()
     c.execute('DELETE FROM lven_agents')
     db.commit()
+    _invalidate_cached_credentials()
+    shared_state.bump_generation('agent_credentials')
+    agent_tokens.expire_revocations()
+    liveness.forget_all()
 
 
 def heartbeat(db: Connection, agent_uuid: str):
@@ -78,4 +238,103 @@ def heartbeat(db: Connection, agent_uuid: str):
     c.execute('UPDATE lven_agents SET last_heartbeat = ? WHERE uuid = ?', (time.time(), agent_uuid))
     db.commit()
     if c.rowcount == 0:
-        raise LVENAgentNotFound(f"LVEN Agent with UUID '{agent_uuid}' does not exist")
\ No newline at end of file
+        raise LVENAgentNotFound(f"LVEN Agent with UUID '{agent_uuid}' does not exist")
+
+
+class HeartbeatBufferStats(TypedDict):
+    pending: int # agents with a heartbeat waiting to be written
+    recorded: int # heartbeats received since startup
+    flushes: int # batches written to the database
+    flushed_rows: int # rows written to the database, lower than 'recorded' thanks to coalescing
+    flush_errors: int
+
+
+# write-behind heartbeats: only the latest timestamp of each agent is kept until the flusher writes them in a single transaction
+_pending_heartbeats: dict[str, float] = {}
+_pending_heartbeats_lock = threading.Lock()
+_heartbeat_flusher: Optional[PeriodicWorker] = None
+_heartbeat_stats = HeartbeatBufferStats(pending=0, recorded=0, flushes=0, flushed_rows=0, flush_errors=0)
+
+
+def record_heartbeat(db: Connection, agent_uuid: str):
+    # without a running flusher (ie: CLI) heartbeats are written right away
+    now = time.time()
+    liveness.record_heartbeat(agent_uuid, now)
+
+    flusher = _heartbeat_flusher
+    if flusher is None:
+        heartbeat(db, agent_uuid)
+        return
+
+    with _pending_heartbeats_lock:
+        _pending_heartbeats[agent_uuid] = now
+        _heartbeat_stats['recorded'] += 1
+        pending_count = len(_pending_heartbeats)
+
+    if pending_count >= runtime_env.settings_heartbeat_flush_batch_size:
+        flusher.wake()
+
+
+def flush_heartbeats(db: Connection) -> int:
+    global _pending_heartbeats
+    with _pending_heartbeats_lock:
+        if len(_pending_heartbeats) == 0:
+            return 0
+        batch = _pending_heartbeats
+        _pending_heartbeats = {}
+
+    try:
+        c = db.cursor()
+        # an agent deleted in the meantime simply won't match any row
+        c.executemany('UPDATE lven_agents SET last_heartbeat = ? WHERE uuid = ? AND last_heartbeat < ?',
+                      [(timestamp, agent_uuid, timestamp) for agent_uuid, timestamp in batch.items()])
+        db.commit()
+    except Exception:
+        db.rollback()
+        # put the batch back so it is retried on next flush, unless a newer heartbeat was received meanwhile
+        with _pending_heartbeats_lock:
+            for agent_uuid, timestamp in batch.items():
+                if _pending_heartbeats.get(agent_uuid, 0) < timestamp:
+                    _pending_heartbeats[agent_uuid] = timestamp
+            _heartbeat_stats['flush_errors'] += 1
+        raise
+
+    with _pending_heartbeats_lock:
+        _heartbeat_stats['flushes'] += 1
+        _heartbeat_stats['flushed_rows'] += len(batch)
+
+    return len(batch)
+
+
+def start_heartbeat_flusher():
+    global _heartbeat_flusher
+    if _heartbeat_flusher is not None:
+        return
+
+    _heartbeat_flusher = PeriodicWorker('heartbeat-flusher', runtime_env.settings_heartbeat_flush_interval_ms / 1000,
+                                        lambda: flush_heartbeats(database.new_connection()))
+    _heartbeat_flusher.start()
+    logging.info('Heartbeat flusher started (interval=%dms, batch size=%d)',
+                 runtime_env.settings_heartbeat_flush_interval_ms, runtime_env.settings_heartbeat_flush_batch_size)
+
+
+def stop_heartbeat_flusher():
+    global _heartbeat_flusher
+    if _heartbeat_flusher is None:
+        return
+
+    # the flusher writes whatever is still pending before exiting
+    flusher = _heartbeat_flusher
+    _heartbeat_flusher = None
+    flusher.stop()
+
+    # heartbeats recorded while the flusher was stopping
+    flush_heartbeats(database.new_connection())
+    logging.info('Heartbeat flusher stopped')
+
+
+def get_heartbeat_buffer_stats() -> HeartbeatBufferStats:
+    with _pending_heartbeats_lock:
+        stats = HeartbeatBufferStats(**_heartbeat_stats)
+        stats['pending'] = len(_pending_heartbeats)
+    return stats
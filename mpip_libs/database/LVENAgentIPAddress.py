@@ -0,0 +1,187 @@
+from typing import Optional, TypedDict
+import ipaddress
+import threading
+import time
+from sqlite3 import Connection
+
+import mpip_libs.database as database
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs import shared_state
+from mpip_libs.cache import LRUCache, CacheStats
+
+# IP addresses reported by the agents in their heartbeats. Only changes are written, the agent is then flagged
+# (lven_agents.ip_addresses_changed_at) until agent_ip_sync pushes the addresses to its PCE workload. When an agent is
+# deleted its workload is queued instead (lven_workloads_ip_addresses_pending), so its addresses are removed from the
+# workload even if it was the last agent.
+
+# more than this in a heartbeat is rejected
+max_ip_addresses_per_agent = 64
+
+
+class PendingWorkloadUpdate(TypedDict):
+    pce_workload_href: str
+    ip_addresses: list[str] # of all the agents of the workload
+    changes: list[tuple[str, float]] # (agent uuid, ip_addresses_changed_at) to clear once pushed
+    workload_changed_at: Optional[float] # lven_workloads_ip_addresses_pending entry to clear once pushed, if any
+
+
+# agent uuid -> frozenset of its stored IP addresses, so heartbeats repeating the same addresses don't read the database
+_known_addresses_cache: Optional[LRUCache] = None
+_known_addresses_cache_lock = threading.Lock()
+
+
+def _get_known_addresses_cache() -> LRUCache:
+    global _known_addresses_cache
+    if _known_addresses_cache is None:
+        with _known_addresses_cache_lock:
+            if _known_addresses_cache is None:
+                _known_addresses_cache = LRUCache(max_entries=runtime_env.settings_agent_ip_addresses_cache_max_entries,
+                                                  default_ttl=runtime_env.settings_agent_ip_addresses_cache_ttl)
+    return _known_addresses_cache
+
+
+def get_enabled_known_addresses_cache() -> Optional[LRUCache]:
+    # the prefork workers don't cache: the heartbeats of an agent go to any of them, so the cached addresses of a
+    # worker may be outdated. They compare with the stored addresses instead, a single indexed read
+    return _get_known_addresses_cache() if not shared_state.is_enabled() else None
+
+
+def _address_sort_key(address: str) -> tuple[int, int]:
+    # IPv4 first, then IPv6
+    parsed = ipaddress.ip_address(address)
+    return parsed.version, int(parsed)
+
+
+def parse_ip_addresses(values) -> Optional[frozenset[str]]:
+    # normalized addresses from a heartbeat, None if invalid
+    if not isinstance(values, list) or len(values) > max_ip_addresses_per_agent:
+        return None
+    addresses = set()
+    for value in values:
+        if not isinstance(value, str):
+            return None
+        try:
+            addresses.add(str(ipaddress.ip_address(value.strip())))
+        except ValueError:
+            return None
+    return frozenset(addresses)
+
+
+def get(db: Connection, agent_uuid: str) -> set[str]:
+    c = db.cursor()
+    c.execute('SELECT ip_address FROM lven_agents_ip_addresses WHERE agent_uuid = ?', (agent_uuid,))
+    return {row['ip_address'] for row in c.fetchall()}
+
+
+def update(db: Connection, agent_uuid: str, ip_addresses: frozenset[str]) -> bool:
+    # stores the addresses reported by an agent, returns True if they changed
+    cache = get_enabled_known_addresses_cache()
+    if cache is not None:
+        found, known_addresses = cache.get(agent_uuid)
+        if found and known_addresses == ip_addresses:
+            return False
+
+    stored_addresses = get(db, agent_uuid)
+    added = ip_addresses - stored_addresses
+    removed = stored_addresses - ip_addresses
+    if len(added) == 0 and len(removed) == 0:
+        if cache is not None:
+            cache.set(agent_uuid, ip_addresses)
+        return False
+
+    c = db.cursor()
+    try:
+        c.execute('UPDATE lven_agents SET ip_addresses_changed_at = ? WHERE uuid = ?', (time.time(), agent_uuid))
+        if c.rowcount == 0:
+            # deleted in the meantime
+            db.rollback()
+            return False
+        c.executemany('DELETE FROM lven_agents_ip_addresses WHERE agent_uuid = ? AND ip_address = ?',
+                      [(agent_uuid, ip_address) for ip_address in removed])
+        c.executemany('INSERT OR IGNORE INTO lven_agents_ip_addresses (agent_uuid, ip_address) VALUES (?, ?)',
+                      [(agent_uuid, ip_address) for ip_address in added])
+        db.commit()
+    except Exception:
+        db.rollback()
+        if cache is not None:
+            cache.invalidate(agent_uuid)
+        raise
+
+    if cache is not None:
+        cache.set(agent_uuid, ip_addresses)
+    return True
+
+
+def get_pending_workload_updates(db: Connection, limit: int) -> list[PendingWorkloadUpdate]:
+    # workloads of up to 'limit' agents with addresses not pushed yet, and up to 'limit' workloads queued by agent
+    # deletions, oldest changes first. The addresses of a workload are those of all its agents.
+    c = db.cursor()
+    c.execute('SELECT uuid, pce_workload_href, ip_addresses_changed_at FROM lven_agents WHERE ip_addresses_changed_at IS NOT NULL '
+              'ORDER BY ip_addresses_changed_at LIMIT ?', (limit,))
+    changes_by_workload: dict[str, list[tuple[str, float]]] = {}
+    for row in c.fetchall():
+        changes_by_workload.setdefault(row['pce_workload_href'], []).append((row['uuid'], row['ip_addresses_changed_at']))
+    c.execute('SELECT pce_workload_href, changed_at FROM lven_workloads_ip_addresses_pending ORDER BY changed_at LIMIT ?', (limit,))
+    workload_changes: dict[str, float] = {row['pce_workload_href']: row['changed_at'] for row in c.fetchall()}
+    for workload_href in workload_changes:
+        changes_by_workload.setdefault(workload_href, [])
+
+    workload_hrefs = list(changes_by_workload.keys())
+    addresses_by_workload: dict[str, set[str]] = {workload_href: set() for workload_href in workload_hrefs}
+    # chunked to stay below SQLite's host parameters limit
+    for index in range(0, len(workload_hrefs), database.max_statement_parameters):
+        chunk = workload_hrefs[index:index + database.max_statement_parameters]
+        c.execute('SELECT a.pce_workload_href, i.ip_address FROM lven_agents a '
+                  'JOIN lven_agents_ip_addresses i ON i.agent_uuid = a.uuid '
+                  f"WHERE a.pce_workload_href IN ({','.join('?' * len(chunk))})", chunk)
+        for row in c.fetchall():
+            addresses_by_workload[row['pce_workload_href']].add(row['ip_address'])
+
+    return [PendingWorkloadUpdate(pce_workload_href=workload_href,
+                                  ip_addresses=sorted(addresses_by_workload[workload_href], key=_address_sort_key),
+                                  changes=changes_by_workload[workload_href],
+                                  workload_changed_at=workload_changes.get(workload_href))
+            for workload_href in workload_hrefs]
+
+
+def mark_pushed(db: Connection, updates: list[PendingWorkloadUpdate]):
+    # agents and workloads whose addresses changed again since they were read stay pending
+    c = db.cursor()
+    try:
+        c.executemany('UPDATE lven_agents SET ip_addresses_changed_at = NULL WHERE uuid = ? AND ip_addresses_changed_at = ?',
+                      [change for update in updates for change in update['changes']])
+        c.executemany('DELETE FROM lven_workloads_ip_addresses_pending WHERE pce_workload_href = ? AND changed_at = ?',
+                      [(update['pce_workload_href'], update['workload_changed_at']) for update in updates
+                       if update['workload_changed_at'] is not None])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+def postpone(db: Connection, updates: list[PendingWorkloadUpdate]):
+    # updates the PCE refused stay pending behind the others, they are retried by a later run
+    now = time.time()
+    c = db.cursor()
+    try:
+        c.executemany('UPDATE lven_agents SET ip_addresses_changed_at = ? WHERE uuid = ? AND ip_addresses_changed_at = ?',
+                      [(now, agent_uuid, changed_at) for update in updates for agent_uuid, changed_at in update['changes']])
+        c.executemany('UPDATE lven_workloads_ip_addresses_pending SET changed_at = ? WHERE pce_workload_href = ? AND changed_at = ?',
+                      [(now, update['pce_workload_href'], update['workload_changed_at']) for update in updates
+                       if update['workload_changed_at'] is not None])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+def count_pending(db: Connection) -> int:
+    # agents and deleted agents workloads waiting to be pushed
+    c = db.cursor()
+    c.execute('SELECT (SELECT COUNT(*) FROM lven_agents WHERE ip_addresses_changed_at IS NOT NULL) + '
+              '(SELECT COUNT(*) FROM lven_workloads_ip_addresses_pending)')
+    return c.fetchone()[0]
+
+
+def get_known_addresses_cache_stats() -> CacheStats:
+    return _get_known_addresses_cache().get_stats()
@@ -1,9 +1,11 @@
-from typing import TypedDict, Optional
+from typing import Iterator, TypedDict, Optional
 import random
 import time
 from sqlite3 import Connection
 import logging
 
+import mpip_libs.database as database
+
 class PairingKeyObject(TypedDict):
     key: str # the pairing itself, a 32 character string
     target_switch_href: Optional[str] # the HREF of the switch the key is will create an association with the Workload
@@ -43,6 +45,17 @@ def delete(db: Connection, pairing_key: str):
     if c.rowcount == 0:
         raise LVENPairingKeyDoesNotExist(f"LVEN Pairing key '{pairing_key}' does not exist")
 
+def delete_many(db: Connection, pairing_keys: list[str]) -> list[str]:
+    # returns the keys which were deleted, unknown ones are ignored
+    deleted_keys = []
+    c = db.cursor()
+    for index in range(0, len(pairing_keys), database.max_statement_parameters):
+        chunk = pairing_keys[index:index + database.max_statement_parameters]
+        c.execute(f"DELETE FROM lven_agent_pairing_keys WHERE key IN ({','.join('?' * len(chunk))}) RETURNING key", chunk)
+        deleted_keys.extend(row['key'] for row in c.fetchall())
+    db.commit()
+    return deleted_keys
+
 def exists(db: Connection, pairing_key: str) -> bool:
     c = db.cursor()
     c.execute('SELECT * FROM lven_agent_pairing_keys WHERE key = ?', (pairing_key,))
@@ -57,19 +70,50 @@ def get_single(db: Connection, pairing_key: str) -> Optional[PairingKeyObject]:
     return row_to_pairing_key(row)
 
 def get_all(db: Connection) -> list[PairingKeyObject]:
+    return list(iter_pairing_keys(db))
+
+def iter_pairing_keys(db: Connection, after_key: Optional[str] = None, limit: Optional[int] = None,
+                      usable_only: bool = False) -> Iterator[PairingKeyObject]:
+    # streams pairing keys ordered by key straight from the cursor, after_key is the last key of the previous page.
+    # usable_only skips expired and used up keys.
+    conditions = []
+    parameters = []
+    if after_key is not None:
+        conditions.append('key > ?')
+        parameters.append(after_key)
+    if usable_only:
+        conditions.append('(valid_until IS NULL OR valid_until >= ?) AND (remaining_uses IS NULL OR remaining_uses > 0)')
+        parameters.append(int(time.time()))
+
+    query = 'SELECT * FROM lven_agent_pairing_keys'
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY key'
+    if limit is not None:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+
     c = db.cursor()
-    c.execute('SELECT * FROM lven_agent_pairing_keys')
-    rows = c.fetchall()
-    return [row_to_pairing_key(row) for row in rows]
+    c.execute(query, parameters)
+    for row in c:
+        yield row_to_pairing_key(row)
 
-def decrease_use_count(db: Connection, pairing_key: str):
-    # remaining_uses is allowed to be None, so we need to check for that
+def consume(db: Connection, pairing_key: str, count: int = 1) -> Optional[PairingKeyObject]:
+    # atomically takes 'count' uses of a key which is not expired and has enough uses left, returns the updated key
+    # or None if it can't be used. Nothing is committed, see release() to give uses back.
     c = db.cursor()
-    c.execute('SELECT remaining_uses FROM lven_agent_pairing_keys WHERE key = ?', (pairing_key,))
+    c.execute('UPDATE lven_agent_pairing_keys SET remaining_uses = remaining_uses - ? '
+              'WHERE key = ? AND (valid_until IS NULL OR valid_until >= ?) AND (remaining_uses IS NULL OR remaining_uses >= ?) '
+              'RETURNING *',
+              (count, pairing_key, int(time.time()), count))
     row = c.fetchone()
     if row is None:
-        raise LVENPairingKeyDoesNotExist(f"LVEN Pairing key '{pairing_key}' does not exist")
-    if row['remaining_uses'] is None:
-        return
-    c.execute('UPDATE lven_agent_pairing_keys SET remaining_uses = remaining_uses - 1 WHERE key = ?', (pairing_key,))
+        return None
+    return row_to_pairing_key(row)
+
+def release(db: Connection, pairing_key: str, count: int = 1):
+    # gives back uses taken by consume() which were not used (ie: pairing failed), unlimited keys are left as they are
+    c = db.cursor()
+    c.execute('UPDATE lven_agent_pairing_keys SET remaining_uses = remaining_uses + ? WHERE key = ? AND remaining_uses IS NOT NULL',
+              (count, pairing_key))
     db.commit()
@@ -1,16 +1,43 @@
 import sqlite3
 import os
 import mpip_libs.runtime_env as runtime_env
+from mpip_libs import metrics
 import logging
 import random
+import threading
 import time
 from typing import TypedDict, Optional
 
 database_structure_file_path = os.path.dirname(__file__) + '/database.sql'
+# schema changes applied on top of database.sql, named <version>_<description>.sql
+database_migrations_directory_path = os.path.dirname(__file__) + '/migrations'
 def database_file_path() -> str:
     return runtime_env.settings_persistent_directory + '/mpip.sqlite3'
 
 
+class ConnectionPoolStats(TypedDict):
+    connections_open: int # connections currently held by worker threads
+    connections_opened: int # total connections opened since startup
+    connections_closed: int # total connections closed (dead threads or shutdown)
+    checkouts: int # total calls to new_connection()
+    reuses: int # calls to new_connection() served by an existing connection
+    rollbacks: int # transactions left open by a previous request and rolled back on checkout
+
+
+# SQLITE_MAX_VARIABLE_NUMBER is 999 on SQLite builds older than 3.32
+max_statement_parameters = 900
+
+supported_journal_modes = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+supported_synchronous_modes = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+# one connection per thread: waitress worker threads are long-lived so each one keeps its own connection
+_thread_local = threading.local()
+_pool_lock = threading.Lock()
+_pool_connections: dict[int, tuple[threading.Thread, sqlite3.Connection]] = {}
+_pool_stats = ConnectionPoolStats(connections_open=0, connections_opened=0, connections_closed=0,
+                                  checkouts=0, reuses=0, rollbacks=0)
+
+
 def init(create_database_if_not_exists: bool = False):
 
     # create the database if it doesn't exist
@@ -20,16 +47,93 @@ def init(create_database_if_not_exists: bool = False):
         else:
             raise FileNotFoundError(f"The database file {database_file_path()} does not exist.")
 
-    # connect to the database
-    conn = sqlite3.connect(database_file_path())
+    # connect to the database, this will also switch the journal mode (WAL is persisted in the database file)
+    conn = new_connection()
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
 
-    logging.info('Database connection established')
+    logging.info('Database connection established (journal_mode=%s)', journal_mode)
 
-def new_connection():
-    conn = sqlite3.connect(database_file_path())
+    # existing deployments get the schema changes made since they were created
+    migrate(conn)
+
+
+def _open_connection() -> sqlite3.Connection:
+    journal_mode = runtime_env.settings_database_journal_mode
+    if journal_mode not in supported_journal_modes:
+        raise ValueError(f"Unsupported database journal mode '{journal_mode}', supported values are: {supported_journal_modes}")
+    synchronous = runtime_env.settings_database_synchronous
+    if synchronous not in supported_synchronous_modes:
+        raise ValueError(f"Unsupported database synchronous mode '{synchronous}', supported values are: {supported_synchronous_modes}")
+
+    # check_same_thread is disabled so close_all_connections() can close them from the main thread on shutdown,
+    # connections are otherwise never shared between threads
+    # statements are timed for /metrics
+    conn = sqlite3.connect(database_file_path(), check_same_thread=False, factory=metrics.InstrumentedConnection)
     conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {int(runtime_env.settings_database_busy_timeout_ms)}')
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+    # negative value means KiB rather than pages
+    conn.execute(f'PRAGMA cache_size = -{int(runtime_env.settings_database_cache_size_kib)}')
+    conn.execute('PRAGMA temp_store = MEMORY')
     return conn
 
+
+def _close_connections_of_dead_threads():
+    # must be called with _pool_lock held
+    for thread_id, (thread, conn) in list(_pool_connections.items()):
+        if not thread.is_alive():
+            conn.close()
+            del _pool_connections[thread_id]
+            _pool_stats['connections_closed'] += 1
+
+
+def new_connection() -> sqlite3.Connection:
+    # returns the connection of the calling thread, opening it on first use. Callers must not close it.
+    conn: Optional[sqlite3.Connection] = getattr(_thread_local, 'connection', None)
+
+    # the connection might have been closed by close_all_connections() in the meantime
+    if conn is not None and _pool_connections.get(threading.get_ident(), (None, None))[1] is conn:
+        # a previous request on this thread may have failed mid-transaction, don't let it hold the write lock
+        rolled_back = conn.in_transaction
+        if rolled_back:
+            conn.rollback()
+        with _pool_lock:
+            _pool_stats['checkouts'] += 1
+            _pool_stats['reuses'] += 1
+            if rolled_back:
+                _pool_stats['rollbacks'] += 1
+        return conn
+
+    conn = _open_connection()
+    _thread_local.connection = conn
+    current_thread = threading.current_thread()
+    with _pool_lock:
+        _close_connections_of_dead_threads()
+        _pool_connections[current_thread.ident] = (current_thread, conn)
+        _pool_stats['checkouts'] += 1
+        _pool_stats['connections_opened'] += 1
+        _pool_stats['connections_open'] = len(_pool_connections)
+
+    logging.debug('Opened database connection for thread %s', current_thread.name)
+    return conn
+
+
+def close_all_connections():
+    with _pool_lock:
+        for thread, conn in _pool_connections.values():
+            conn.close()
+            _pool_stats['connections_closed'] += 1
+        _pool_connections.clear()
+        _pool_stats['connections_open'] = 0
+    _thread_local.connection = None
+
+
+def get_pool_stats() -> ConnectionPoolStats:
+    with _pool_lock:
+        return ConnectionPoolStats(**_pool_stats)
+
+
 def create_database():
     # create the database
     global conn
@@ -46,13 +150,87 @@ def create_database():
     with open(database_structure_file_path, 'r') as file:
         c.executescript(file.read())
     conn.commit()
+    migrate(conn)
     conn.close()
 
 
+def list_migrations() -> list[tuple[int, str]]:
+    # returns (version, file name) of all migrations sorted by version
+    migrations = []
+    for file_name in os.listdir(database_migrations_directory_path):
+        if not file_name.endswith('.sql'):
+            continue
+        version = file_name.split('_', 1)[0]
+        if not version.isdigit():
+            raise ValueError(f"Invalid migration file name '{file_name}', it must start with a version number")
+        migrations.append((int(version), file_name))
+    migrations.sort()
+    return migrations
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL, applied_at INTEGER NOT NULL)')
+    conn.commit()
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] if row[0] is not None else 0
+
+
+def split_sql_statements(script: str) -> list[str]:
+    # sqlite3 executes a single statement at a time, complete_statement() knows about quotes and trigger bodies
+    statements = []
+    statement = ''
+    parts = script.split(';')
+    for part in parts[:-1]:
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    statement += parts[-1]
+    if statement.strip() != '':
+        statements.append(statement.strip())
+    return statements
+
+
+def migrate(conn: sqlite3.Connection) -> list[str]:
+    # applies the migrations newer than the current schema version, each one in its own transaction.
+    # returns the names of the migrations applied
+    current_version = get_schema_version(conn)
+    applied = []
+
+    for version, file_name in list_migrations():
+        if version <= current_version:
+            continue
+
+        logging.info('Applying database migration %s', file_name)
+        with open(os.path.join(database_migrations_directory_path, file_name), 'r') as file:
+            migration_sql = file.read()
+
+        # the write lock is taken first, then the version is read again: another process (ie: the server and a CLI
+        # command started together) may have applied the migration since, and most schema changes can't run twice
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+            if row[0] is not None and row[0] >= version:
+                conn.rollback()
+                logging.info('Database migration %s was already applied', file_name)
+                continue
+            for statement in split_sql_statements(migration_sql):
+                conn.execute(statement)
+            conn.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                         (version, file_name, int(time.time())))
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        applied.append(file_name)
+
+    return applied
+
+
 def database_exists() -> bool:
     return os.path.exists(database_file_path())
 
 
 
 
-
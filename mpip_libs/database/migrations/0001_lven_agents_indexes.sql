@@ -0,0 +1,7 @@
+-- THIS IS SQLITE3 FORMAT
+
+-- LVENAgent.name_exists() is called on every pairing
+CREATE INDEX IF NOT EXISTS lven_agents_name_idx ON lven_agents (name);
+
+-- stale agents lookups
+CREATE INDEX IF NOT EXISTS lven_agents_last_heartbeat_idx ON lven_agents (last_heartbeat);
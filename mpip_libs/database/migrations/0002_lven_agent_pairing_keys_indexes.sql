@@ -0,0 +1,4 @@
+-- THIS IS SQLITE3 FORMAT
+
+-- expired pairing keys lookups
+CREATE INDEX IF NOT EXISTS lven_agent_pairing_keys_valid_until_idx ON lven_agent_pairing_keys (valid_until);
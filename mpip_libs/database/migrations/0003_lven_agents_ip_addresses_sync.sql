@@ -0,0 +1,20 @@
+-- THIS IS SQLITE3 FORMAT
+
+-- when the IP addresses reported by the agent last changed, NULL once they were pushed to its PCE workload
+ALTER TABLE lven_agents ADD COLUMN ip_addresses_changed_at REAL;
+
+-- pending PCE updates lookups
+CREATE INDEX IF NOT EXISTS lven_agents_ip_addresses_changed_at_idx ON lven_agents (ip_addresses_changed_at)
+    WHERE ip_addresses_changed_at IS NOT NULL;
+-- the addresses pushed to a workload are those of all its agents
+CREATE INDEX IF NOT EXISTS lven_agents_pce_workload_href_idx ON lven_agents (pce_workload_href);
+
+-- foreign keys are not enforced, the IP addresses of deleted agents go with them. The other agents of the workload are
+-- flagged so the addresses of the workload are pushed again without those of the deleted agent.
+CREATE TRIGGER IF NOT EXISTS lven_agents_ip_addresses_delete AFTER DELETE ON lven_agents
+BEGIN
+    UPDATE lven_agents SET ip_addresses_changed_at = (julianday('now') - 2440587.5) * 86400.0
+        WHERE pce_workload_href = OLD.pce_workload_href
+          AND EXISTS (SELECT 1 FROM lven_agents_ip_addresses WHERE agent_uuid = OLD.uuid);
+    DELETE FROM lven_agents_ip_addresses WHERE agent_uuid = OLD.uuid;
+END;
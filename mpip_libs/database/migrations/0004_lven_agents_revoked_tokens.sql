@@ -0,0 +1,14 @@
+-- THIS IS SQLITE3 FORMAT
+
+-- agents deleted since signed tokens were introduced, their tokens are refused, see agent_tokens.
+-- rowid keeps the insertion order so the servers only read the new entries.
+CREATE TABLE IF NOT EXISTS lven_agents_revoked_tokens (
+    agent_uuid TEXT PRIMARY KEY NOT NULL,
+    revoked_at REAL NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS lven_agents_revoked_tokens_insert AFTER DELETE ON lven_agents
+BEGIN
+    INSERT OR IGNORE INTO lven_agents_revoked_tokens (agent_uuid, revoked_at)
+        VALUES (OLD.uuid, (julianday('now') - 2440587.5) * 86400.0);
+END;
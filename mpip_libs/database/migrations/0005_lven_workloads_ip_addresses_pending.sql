@@ -0,0 +1,18 @@
+-- THIS IS SQLITE3 FORMAT
+
+-- workloads whose addresses must be pushed again because an agent was deleted, even when it was their last agent
+-- (the interfaces of the deleted agent are then removed). Cleared by agent_ip_sync once pushed.
+CREATE TABLE IF NOT EXISTS lven_workloads_ip_addresses_pending (
+    pce_workload_href TEXT PRIMARY KEY NOT NULL,
+    changed_at REAL NOT NULL
+);
+
+-- replaces the trigger of 0003 which only flagged the other agents of the workload
+DROP TRIGGER IF EXISTS lven_agents_ip_addresses_delete;
+CREATE TRIGGER IF NOT EXISTS lven_agents_ip_addresses_delete AFTER DELETE ON lven_agents
+BEGIN
+    INSERT OR REPLACE INTO lven_workloads_ip_addresses_pending (pce_workload_href, changed_at)
+        SELECT OLD.pce_workload_href, (julianday('now') - 2440587.5) * 86400.0
+        WHERE EXISTS (SELECT 1 FROM lven_agents_ip_addresses WHERE agent_uuid = OLD.uuid);
+    DELETE FROM lven_agents_ip_addresses WHERE agent_uuid = OLD.uuid;
+END;
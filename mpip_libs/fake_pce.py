@@ -0,0 +1,117 @@
+import threading
+import time
+from typing import List, Optional
+
+
+class FakePCEConnector:
+    # in-process stand-in for pylo.APIConnector implementing the calls made by ilo_api, used by the benchmark.
+    # every call sleeps 'latency' seconds to simulate the PCE round trip.
+    def __init__(self, latency: float = 0.05, workloads_count: int = 1000, rules_per_workload: int = 50,
+                 switches_count: int = 1, org_id: int = 1):
+        self.latency = latency
+        self.org_id = org_id
+        self.rules_per_workload = rules_per_workload
+        self.calls: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.workloads = [{'href': f'/orgs/{org_id}/workloads/{index}', 'name': workload_name(index),
+                           'hostname': workload_name(index), 'managed': False, 'interfaces': []}
+                          for index in range(workloads_count)]
+        self.network_devices = [{'href': f'/orgs/{org_id}/network_devices/{index}', 'supported_endpoint_type': 'switch_port',
+                                 'config': {'name': f'switch-{index}'}}
+                                for index in range(switches_count)]
+        self.network_endpoints: dict[str, list] = {device['href']: [] for device in self.network_devices}
+        # bumped by provision(), each provisioning adds one rule to the active policies of the workloads it affects
+        self.policy_version = 1
+        self.workload_policy_revisions: dict[str, int] = {}
+
+    def _call(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_software_version(self):
+        self._call('get_software_version')
+        return '23.2.0'
+
+    def objects_workload_get(self, include_deleted=False, filter_by_ip: str = None, filter_by_label=None,
+                             filter_by_name: str = None, filter_by_managed: bool = None, max_results: int = None,
+                             async_mode=False, **kwargs) -> List[dict]:
+        self._call('objects_workload_get')
+        workloads = self.workloads
+        if filter_by_name is not None:
+            # the PCE does a partial match on names
+            workloads = [workload for workload in workloads if filter_by_name in workload['name']]
+        if filter_by_managed is not None:
+            workloads = [workload for workload in workloads if workload['managed'] == filter_by_managed]
+        if max_results is not None:
+            workloads = workloads[:max_results]
+        return [dict(workload) for workload in workloads]
+
+    def objects_network_device_get(self, max_results: int = None) -> List[dict]:
+        self._call('objects_network_device_get')
+        return [dict(device) for device in self.network_devices]
+
+    def object_network_device_endpoints_get(self, network_device_href: str) -> List[dict]:
+        self._call('object_network_device_endpoints_get')
+        with self._lock:
+            return list(self.network_endpoints.get(network_device_href, []))
+
+    def object_network_device_endpoint_create(self, network_device_href: str, name: str, endpoint_type: str,
+                                              workloads_href: List[str]) -> dict:
+        self._call('object_network_device_endpoint_create')
+        with self._lock:
+            endpoints = self.network_endpoints.setdefault(network_device_href, [])
+            endpoint = {'href': f'{network_device_href}/network_endpoints/{len(endpoints)}',
+                        'config': {'name': name, 'endpoint_type': endpoint_type},
+                        'workloads': [{'href': workload_href} for workload_href in workloads_href]}
+            endpoints.append(endpoint)
+        return endpoint
+
+    def objects_workload_update_bulk(self, json_object: List[dict]) -> List[dict]:
+        self._call('objects_workload_update_bulk')
+        results = []
+        with self._lock:
+            workloads_by_href = {workload['href']: workload for workload in self.workloads}
+            for update in json_object:
+                workload = workloads_by_href.get(update['href'])
+                if workload is None:
+                    results.append({'href': update['href'], 'status': 'error', 'token': 'not_found'})
+                    continue
+                workload.update({key: value for key, value in update.items() if key != 'href'})
+                results.append({'href': update['href'], 'status': 'updated'})
+        return results
+
+    def object_workload_get_active_policies(self, workload_href: str) -> dict:
+        self._call('object_workload_get_active_policies')
+        with self._lock:
+            rules_count = self.rules_per_workload + self.workload_policy_revisions.get(workload_href, 0)
+        return {'workload': workload_href,
+                'rules': [{'href': f'/orgs/{self.org_id}/sec_policy/active/rule_sets/1/sec_rules/{index}',
+                           'ingress_services': [{'port': 1000 + index, 'proto': 6}],
+                           'consumers': [{'actors': 'ams'}], 'providers': [{'workload': {'href': workload_href}}]}
+                          for index in range(rules_count)]}
+
+    def do_get_call(self, path: str, params: dict = None, **kwargs):
+        self._call('do_get_call')
+        if path == '/sec_policy':
+            with self._lock:
+                return [{'href': f'/orgs/{self.org_id}/sec_policy/{self.policy_version}'}]
+        raise NotImplementedError(f'FakePCEConnector does not implement GET {path}')
+
+    def provision(self, workload_hrefs: List[str]):
+        with self._lock:
+            self.policy_version += 1
+            for workload_href in workload_hrefs:
+                self.workload_policy_revisions[workload_href] = self.workload_policy_revisions.get(workload_href, 0) + 1
+
+    def get_calls_count(self, name: Optional[str] = None) -> int:
+        with self._lock:
+            if name is not None:
+                return self.calls.get(name, 0)
+            return sum(self.calls.values())
+
+
+def workload_name(index: int) -> str:
+    return f'lven-agent-{index:06d}'
@@ -1,13 +1,86 @@
+import hashlib
+import json
 import logging
-from typing import List, Optional
+import re
+import threading
+import time
+from typing import Any, Callable, List, Optional, TypedDict
 
-from pylo.API.JsonPayloadTypes import WorkloadObjectJsonStructure, NetworkDeviceObjectJsonStructure
+from pylo.API.JsonPayloadTypes import WorkloadObjectJsonStructure, NetworkDeviceObjectJsonStructure, WorkloadBulkUpdateResponseEntry
 
 import mpip_libs.runtime_env as runtime_env
+from mpip_libs import metrics, shared_state
+from mpip_libs.cache import LRUCache, CacheStats
+from mpip_libs.misc import PeriodicWorker
+from mpip_libs.pce_guard import PCEGuard, PCEGuardStats, PCEUnavailableEx
+from mpip_libs.single_flight import SingleFlight, SingleFlightStats
 import pylo
 
 
-connector: pylo.APIConnector
+# created by init() on first use, so tools which don't talk to the PCE don't pay for the connection
+connector: Optional[pylo.APIConnector] = None
+_connector_lock = threading.Lock()
+
+
+class CachedActivePolicies(TypedDict):
+    policies: Any
+    json: str # policies serialized once so cache hits don't pay for it again
+    etag: str # hash of the serialized policies
+    compressed_json: dict[str, bytes] # content encoding -> compressed json, filled on first use
+    fetched_at: float # time.monotonic() when received from the PCE, orders the versions of a workload
+
+
+# workload href -> CachedActivePolicies, created on first use so runtime_env settings are loaded
+_active_policies_cache: Optional[LRUCache] = None
+_active_policies_cache_lock = threading.Lock()
+# (workload href, etag) -> CachedActivePolicies, the versions agents may still hold
+_active_policies_history: Optional[LRUCache] = None
+# workload href -> CachedActivePolicies without expiration, served while the PCE can't be called
+_active_policies_last_known: Optional[LRUCache] = None
+
+# switch_port network devices indexed by href and by name, replaced as a whole on each refresh
+_network_devices_by_href: dict[str, NetworkDeviceObjectJsonStructure] = {}
+_network_devices_by_name: dict[str, NetworkDeviceObjectJsonStructure] = {}
+_network_devices_index_loaded_at: Optional[float] = None
+
+# unmanaged workloads indexed by name and by hostname, only when settings_unmanaged_workloads_snapshot_enabled is set
+_unmanaged_workloads_by_name: dict[str, List[WorkloadObjectJsonStructure]] = {}
+_unmanaged_workloads_by_hostname: dict[str, List[WorkloadObjectJsonStructure]] = {}
+_unmanaged_workloads_snapshot_loaded_at: Optional[float] = None
+_unmanaged_workloads_snapshot_lock = threading.Lock()
+
+
+class SwitchEndpointsIndex(TypedDict):
+    loaded_at: float
+    endpoints_by_workload: dict[str, List[Optional[str]]] # workload href -> hrefs of the endpoints it is bound to
+    generation: int # shared_state 'switch_endpoints' generation when the load started, bumped by every binding
+
+
+# network device href -> SwitchEndpointsIndex, only for switches used by pairing keys
+_switch_endpoints_indexes: dict[str, SwitchEndpointsIndex] = {}
+# network device href -> (workload href, endpoint href) bound while its index is being loaded, the PCE answer may
+# not include them so they are added to the new index
+_switch_endpoints_bound_during_load: dict[str, List[tuple[str, Optional[str]]]] = {}
+_switch_endpoints_indexes_lock = threading.Lock()
+
+# concurrent identical PCE calls (ie: many agents of the same workload or switch) share one request, this also
+# makes sure an index is never refreshed twice at the same time
+_pce_single_flight = SingleFlight()
+
+# rate limit, retries and circuit breaker of the PCE calls, created on first use so runtime_env settings are loaded
+_pce_guard: Optional[PCEGuard] = None
+_pce_guard_lock = threading.Lock()
+
+_background_workers: List[PeriodicWorker] = []
+
+
+class GuardedAPIConnector(pylo.APIConnector):
+    # pylo retries 429 answers itself, sleeping 10s between attempts while holding a PCE guard slot and hiding the
+    # failures from the circuit breaker: every call is made without those retries, the PCE guard backs off instead.
+    # the pylo helpers (ie: objects_workload_get) don't expose the setting, all of them go through _do_call()
+    def _do_call(self, *args, **kwargs):
+        kwargs['retry_count_if_api_call_limit_reached'] = 0
+        return super()._do_call(*args, **kwargs)
 
 
 def init():
@@ -19,7 +92,7 @@ def init():
         raise ValueError(f"Invalid PCE FQDN and port: {runtime_env.settings_pce_fqdn_and_port}")
 
     # create the API connector
-    connector = pylo.APIConnector(
+    new_connector = GuardedAPIConnector(
         hostname=fqdn_and_port[0],
         port=int(fqdn_and_port[1]),
         apiuser=runtime_env.settings_pce_api_user,
@@ -27,15 +100,66 @@ def init():
         org_id=runtime_env.settings_pce_org_id
     )
 
-    #testing the PCE connection now:
-    connector.get_software_version()
+    #testing the PCE connection now, before it is used by anyone:
+    new_connector.get_software_version()
+    connector = new_connector
+
+
+def _coalesce(function_name: str, resource: Any, function: Callable[[], Any]) -> Any:
+    # resource identifies what is requested (ie: a workload href), None when the call has no parameter
+    result, shared = _pce_single_flight.do((function_name, resource), function)
+    if shared:
+        metrics.pce_calls_deduplicated_total.inc(function_name)
+    return result
+
+def get_single_flight_stats() -> SingleFlightStats:
+    return _pce_single_flight.get_stats()
+
+def get_pce_guard() -> PCEGuard:
+    global _pce_guard
+    if _pce_guard is None:
+        with _pce_guard_lock:
+            if _pce_guard is None:
+                _pce_guard = PCEGuard(rate_limit=runtime_env.settings_pce_rate_limit,
+                                      rate_limit_burst=runtime_env.settings_pce_rate_limit_burst,
+                                      max_concurrent_calls=runtime_env.settings_pce_max_concurrent_calls,
+                                      wait_timeout=runtime_env.settings_pce_call_wait_timeout,
+                                      retry_max_attempts=runtime_env.settings_pce_retry_max_attempts,
+                                      retry_base_delay=runtime_env.settings_pce_retry_base_delay,
+                                      retry_max_delay=runtime_env.settings_pce_retry_max_delay,
+                                      failure_threshold=runtime_env.settings_pce_circuit_breaker_failure_threshold,
+                                      reset_timeout=runtime_env.settings_pce_circuit_breaker_reset_timeout)
+    return _pce_guard
+
+def _call_pce(method_name: str, *args, idempotent: bool = True, **kwargs) -> Any:
+    # calls a connector method through the PCE guard, non idempotent calls (creations) are not retried
+    return get_pce_guard().call(lambda: metrics.instrument_pce_call(method_name, lambda: getattr(get_connector(), method_name)(*args, **kwargs)),
+                                idempotent=idempotent)
+
+def get_pce_guard_stats() -> PCEGuardStats:
+    return get_pce_guard().get_stats()
+
+
+def forget_connector():
+    # the next call creates a new connector, ie: in a forked process which must not share the parent's connections
+    global connector
+    with _connector_lock:
+        connector = None
+
+
+def get_connector() -> pylo.APIConnector:
+    if connector is None:
+        with _connector_lock:
+            if connector is None:
+                init()
+    return connector
 
 
-def find_unmanaged_workloads_with_specific_name(name: str) -> List[WorkloadObjectJsonStructure]:
+def _query_unmanaged_workloads_with_specific_name(name: str) -> List[WorkloadObjectJsonStructure]:
     # find the workload with the specific name
     workloads = []
 
-    json_workloads = connector.objects_workload_get(filter_by_name=name)
+    json_workloads = _coalesce('objects_workload_get_by_name', name, lambda: _call_pce('objects_workload_get', filter_by_name=name))
 
     for workload in json_workloads:
         #logging.warning(workload)
@@ -45,40 +169,371 @@ def find_unmanaged_workloads_with_specific_name(name: str) -> List[WorkloadObjec
             workloads.append(workload)
     return workloads
 
-def find_switch_from_href_or_name(switch_href_or_name: str) -> Optional[NetworkDeviceObjectJsonStructure]:
-    # find the switch from the href or name
-    search_on_href = False
-    if switch_href_or_name.startswith('/orgs/'):
-        search_on_href = True
+def find_unmanaged_workloads_with_specific_names(names: List[str]) -> dict[str, List[WorkloadObjectJsonStructure]]:
+    # bulk version of find_unmanaged_workloads_with_specific_name(): a single PCE query for all names
+    names_set = set(names)
+    workloads_by_name: dict[str, List[WorkloadObjectJsonStructure]] = {name: [] for name in names_set}
+
+    json_workloads = _get_all_unmanaged_workloads()
+
+    for workload in json_workloads:
+        if workload['managed'] is not False:
+            continue
+        if workload['name'] in names_set:
+            workloads_by_name[workload['name']].append(workload)
+        if workload['hostname'] in names_set and workload['hostname'] != workload['name']:
+            workloads_by_name[workload['hostname']].append(workload)
+    return workloads_by_name
+
+def _get_all_unmanaged_workloads() -> List[WorkloadObjectJsonStructure]:
+    # shared by the bulk lookups and the snapshot refresh, which download the same list
+    return _coalesce('objects_workload_get_unmanaged', None, lambda: _call_pce('objects_workload_get', filter_by_managed=False))
+
+def refresh_unmanaged_workloads_snapshot():
+    global _unmanaged_workloads_by_name, _unmanaged_workloads_by_hostname, _unmanaged_workloads_snapshot_loaded_at
+
+    start_time = time.monotonic()
+    json_workloads = _get_all_unmanaged_workloads()
+
+    workloads_by_name: dict[str, List[WorkloadObjectJsonStructure]] = {}
+    workloads_by_hostname: dict[str, List[WorkloadObjectJsonStructure]] = {}
+    for workload in json_workloads:
+        if workload['managed'] is not False:
+            continue
+        if workload['name'] is not None:
+            workloads_by_name.setdefault(workload['name'], []).append(workload)
+        if workload['hostname'] is not None:
+            workloads_by_hostname.setdefault(workload['hostname'], []).append(workload)
+
+    with _unmanaged_workloads_snapshot_lock:
+        _unmanaged_workloads_by_name = workloads_by_name
+        _unmanaged_workloads_by_hostname = workloads_by_hostname
+        _unmanaged_workloads_snapshot_loaded_at = time.monotonic()
+
+    logging.info('Unmanaged workloads snapshot refreshed in %.3fs: %d workloads',
+                 time.monotonic() - start_time, len(json_workloads))
+
+def _update_unmanaged_workloads_snapshot(name: str, workloads: List[WorkloadObjectJsonStructure]):
+    # incremental update from a live query, 'workloads' is the complete list of matches for 'name'
+    with _unmanaged_workloads_snapshot_lock:
+        _unmanaged_workloads_by_name[name] = [workload for workload in workloads if workload['name'] == name]
+        _unmanaged_workloads_by_hostname[name] = [workload for workload in workloads if workload['hostname'] == name]
+
+def find_unmanaged_workloads_with_specific_name(name: str, use_snapshot: bool = True) -> List[WorkloadObjectJsonStructure]:
+    # use_snapshot=False always asks the PCE: a snapshot hit can be up to settings_unmanaged_workloads_snapshot_max_age old
+    # and the workload may since have been deleted, become managed or got a same-named duplicate
+    if not runtime_env.settings_unmanaged_workloads_snapshot_enabled:
+        return _query_unmanaged_workloads_with_specific_name(name)
+
+    if not use_snapshot:
+        workloads = _query_unmanaged_workloads_with_specific_name(name)
+        _update_unmanaged_workloads_snapshot(name, workloads)
+        return workloads
+
+    # a stale snapshot is not trusted, the PCE is queried instead
+    snapshot_is_fresh = _unmanaged_workloads_snapshot_loaded_at is not None and \
+        time.monotonic() - _unmanaged_workloads_snapshot_loaded_at < runtime_env.settings_unmanaged_workloads_snapshot_max_age
+
+    if snapshot_is_fresh:
+        with _unmanaged_workloads_snapshot_lock:
+            workloads = list(_unmanaged_workloads_by_name.get(name, []))
+            workloads_hrefs = {workload['href'] for workload in workloads}
+            for workload in _unmanaged_workloads_by_hostname.get(name, []):
+                if workload['href'] not in workloads_hrefs:
+                    workloads.append(workload)
+        if len(workloads) > 0:
+            return workloads
 
-    devices_json = connector.objects_network_device_get()
+    # not in the snapshot: the workload may have been created since last refresh
+    workloads = _query_unmanaged_workloads_with_specific_name(name)
+    _update_unmanaged_workloads_snapshot(name, workloads)
+    return workloads
+
+def refresh_network_devices_index(if_older_than: Optional[float] = None):
+    # if_older_than: skip the refresh if the index was loaded less than this many seconds ago.
+    # callers arriving while a refresh is in progress wait for it rather than downloading the same list again
+    if if_older_than is not None and _network_devices_index_loaded_at is not None \
+            and time.monotonic() - _network_devices_index_loaded_at < if_older_than:
+        return
+
+    _coalesce('refresh_network_devices_index', None, _load_network_devices_index)
 
+def _load_network_devices_index():
+    global _network_devices_by_href, _network_devices_by_name, _network_devices_index_loaded_at
+
+    start_time = time.monotonic()
+    devices_json = _call_pce('objects_network_device_get')
+
+    devices_by_href = {}
+    devices_by_name = {}
     for device in devices_json:
         if device['supported_endpoint_type'] != 'switch_port':
             continue
-        if search_on_href:
-            if device['href'] == switch_href_or_name:
-                return device
-        else:
-            if device['config']['name'] == switch_href_or_name:
-                return device
+        devices_by_href[device['href']] = device
+        # first one wins in case of duplicate names
+        devices_by_name.setdefault(device['config']['name'], device)
 
-    return None
+    _network_devices_by_href = devices_by_href
+    _network_devices_by_name = devices_by_name
+    _network_devices_index_loaded_at = time.monotonic()
 
-def find_if_workload_is_already_assigned_to_a_switch_port(workload_href: str, network_device_href: str) -> bool:
-    endpoints = connector.object_network_device_endpoints_get(network_device_href=network_device_href)
+    logging.info('Network devices index refreshed in %.3fs: %d switches out of %d devices',
+                 _network_devices_index_loaded_at - start_time, len(devices_by_href), len(devices_json))
+
+def _lookup_switch_in_index(switch_href_or_name: str) -> Optional[NetworkDeviceObjectJsonStructure]:
+    if switch_href_or_name.startswith('/orgs/'):
+        return _network_devices_by_href.get(switch_href_or_name)
+    return _network_devices_by_name.get(switch_href_or_name)
+
+def find_switch_from_href_or_name(switch_href_or_name: str) -> Optional[NetworkDeviceObjectJsonStructure]:
+    # find the switch from the href or name
+    if _network_devices_index_loaded_at is None:
+        refresh_network_devices_index(if_older_than=runtime_env.settings_network_devices_index_miss_refresh_interval)
+
+    device = _lookup_switch_in_index(switch_href_or_name)
+    if device is not None:
+        return device
+
+    # the switch may have been created since last refresh, a refresh per miss is allowed once in a while
+    refresh_network_devices_index(if_older_than=runtime_env.settings_network_devices_index_miss_refresh_interval)
+    return _lookup_switch_in_index(switch_href_or_name)
+
+def refresh_switch_endpoints_index(network_device_href: str, if_older_than: Optional[float] = None):
+    # a binding made by another prefork worker is only seen by a refresh, the generation tells when one was made
+    index = _switch_endpoints_indexes.get(network_device_href)
+    if if_older_than is not None and index is not None and time.monotonic() - index['loaded_at'] < if_older_than \
+            and index['generation'] == shared_state.get_generation('switch_endpoints'):
+        return
+
+    # one refresh at a time per switch, different switches are refreshed in parallel
+    _coalesce('refresh_switch_endpoints_index', network_device_href, lambda: _load_switch_endpoints_index(network_device_href))
+
+def _record_switch_endpoint(endpoints_by_workload: dict[str, List[Optional[str]]], workload_href: str, endpoint_href: Optional[str]):
+    endpoints = endpoints_by_workload.setdefault(workload_href, [])
+    if endpoint_href not in endpoints:
+        endpoints.append(endpoint_href)
+
+def _load_switch_endpoints_index(network_device_href: str):
+    # loads of the same switch are coalesced by refresh_switch_endpoints_index(), a single one runs at a time
+    start_time = time.monotonic()
+    generation = shared_state.get_generation('switch_endpoints')
+    with _switch_endpoints_indexes_lock:
+        _switch_endpoints_bound_during_load[network_device_href] = []
+    try:
+        endpoints = _call_pce('object_network_device_endpoints_get', network_device_href=network_device_href)
+    except Exception:
+        with _switch_endpoints_indexes_lock:
+            del _switch_endpoints_bound_during_load[network_device_href]
+        raise
+
+    endpoints_by_workload: dict[str, List[Optional[str]]] = {}
     for endpoint in endpoints:
         for local_workload_href in endpoint['workloads']:
-            if local_workload_href['href'] == workload_href:
-                return True
+            _record_switch_endpoint(endpoints_by_workload, local_workload_href['href'], endpoint['href'])
 
-    return False
+    with _switch_endpoints_indexes_lock:
+        for workload_href, endpoint_href in _switch_endpoints_bound_during_load.pop(network_device_href):
+            _record_switch_endpoint(endpoints_by_workload, workload_href, endpoint_href)
+        _switch_endpoints_indexes[network_device_href] = SwitchEndpointsIndex(loaded_at=time.monotonic(),
+                                                                             endpoints_by_workload=endpoints_by_workload,
+                                                                             generation=generation)
+
+    logging.info('Switch endpoints index of %s refreshed in %.3fs: %d endpoints, %d workloads',
+                 network_device_href, time.monotonic() - start_time, len(endpoints), len(endpoints_by_workload))
+
+def refresh_all_switch_endpoints_indexes():
+    for network_device_href in list(_switch_endpoints_indexes.keys()):
+        try:
+            refresh_switch_endpoints_index(network_device_href)
+        except Exception:
+            logging.exception('Failed to refresh switch endpoints index of %s', network_device_href)
+
+def find_if_workload_is_already_assigned_to_a_switch_port(workload_href: str, network_device_href: str) -> bool:
+    # the index is kept up to date by bind_workload_to_switch() and refreshed periodically for changes made in the PCE
+    refresh_switch_endpoints_index(network_device_href, if_older_than=runtime_env.settings_switch_endpoints_index_refresh_interval)
+
+    with _switch_endpoints_indexes_lock:
+        return workload_href in _switch_endpoints_indexes[network_device_href]['endpoints_by_workload']
 
 def bind_workload_to_switch(workload_href: str, network_device_href: str):
-    connector.object_network_device_endpoint_create(name=workload_href,
-                                                    network_device_href=network_device_href,
-                                                    endpoint_type='switch_port',
-                                                    workloads_href=[workload_href])
+    created_endpoint = _call_pce('object_network_device_endpoint_create', idempotent=False, name=workload_href,
+                                 network_device_href=network_device_href, endpoint_type='switch_port',
+                                 workloads_href=[workload_href])
+
+    # record the new binding locally so the next duplicate check doesn't need a refresh, the other prefork workers
+    # refresh their index of this switch on their next check
+    endpoint_href = created_endpoint.get('href') if isinstance(created_endpoint, dict) else None
+    generation = shared_state.bump_generation('switch_endpoints')
+    with _switch_endpoints_indexes_lock:
+        index = _switch_endpoints_indexes.get(network_device_href)
+        if index is not None:
+            _record_switch_endpoint(index['endpoints_by_workload'], workload_href, endpoint_href)
+            if index['generation'] == generation - 1:
+                # no other binding since the index was loaded
+                index['generation'] = generation
+        bound_during_load = _switch_endpoints_bound_during_load.get(network_device_href)
+        if bound_during_load is not None:
+            bound_during_load.append((workload_href, endpoint_href))
+
+# names of the interfaces set from the IP addresses reported by the agents: mpip0, mpip1... The other interfaces of
+# the workloads (ie: defined by an admin) are kept as they are
+workload_interface_name_format = 'mpip{}'
+_workload_interface_name_regex = re.compile(r'^mpip\d+$')
+# interface fields which can be written back, the others are computed by the PCE
+_workload_interface_writable_fields = ('name', 'address', 'cidr_block', 'default_gateway_address', 'link_state', 'friendly_name')
+
+def get_unmanaged_workloads_by_href() -> dict[str, WorkloadObjectJsonStructure]:
+    # from the snapshot when it is enabled and fresh, its interfaces may then be up to
+    # unmanaged_workloads_snapshot_max_age seconds old. The PCE has no query by a list of hrefs, the complete list is
+    # downloaded otherwise, so callers with several batches to process should call this once for all of them
+    snapshot_is_fresh = runtime_env.settings_unmanaged_workloads_snapshot_enabled and _unmanaged_workloads_snapshot_loaded_at is not None \
+        and time.monotonic() - _unmanaged_workloads_snapshot_loaded_at < runtime_env.settings_unmanaged_workloads_snapshot_max_age
+    if snapshot_is_fresh:
+        with _unmanaged_workloads_snapshot_lock:
+            return {workload['href']: workload
+                    for workloads_index in (_unmanaged_workloads_by_name, _unmanaged_workloads_by_hostname)
+                    for workloads in workloads_index.values() for workload in workloads}
+    return {workload['href']: workload for workload in _get_all_unmanaged_workloads()}
+
+def update_workloads_ip_addresses(ip_addresses_by_workload: dict[str, List[str]],
+                                  workloads_by_href: dict[str, WorkloadObjectJsonStructure]) -> List[WorkloadBulkUpdateResponseEntry]:
+    # sets the agents interfaces of the workloads in a single bulk update, one result per workload. The bulk update
+    # replaces all the interfaces, the current ones (see get_unmanaged_workloads_by_href()) are kept but the agents ones.
+    results: List[WorkloadBulkUpdateResponseEntry] = []
+    updates = []
+    for workload_href, ip_addresses in ip_addresses_by_workload.items():
+        workload = workloads_by_href.get(workload_href)
+        if workload is None:
+            # deleted or now managed by a VEN, which reports its own interfaces
+            results.append({'href': workload_href, 'status': 'error', 'token': 'unmanaged_workload_not_found'})
+            continue
+        interfaces = [{field: interface[field] for field in _workload_interface_writable_fields if interface.get(field) is not None}
+                      for interface in workload.get('interfaces') or []
+                      if not _workload_interface_name_regex.match(interface.get('name') or '')]
+        interfaces.extend({'name': workload_interface_name_format.format(index), 'address': ip_address}
+                          for index, ip_address in enumerate(ip_addresses))
+        updates.append({'href': workload_href, 'interfaces': interfaces})
+
+    if len(updates) > 0:
+        results.extend(_call_pce('objects_workload_update_bulk', updates))
+    return results
+
+def get_workload_active_policies(workload_href: str, coalesce: bool = True):
+    # coalesce=False when the result must be newer than the call (ie: after a new policy version was seen)
+    if not coalesce:
+        return _call_pce('object_workload_get_active_policies', workload_href=workload_href)
+    return _coalesce('get_workload_active_policies', workload_href,
+                     lambda: _call_pce('object_workload_get_active_policies', workload_href=workload_href))
+
+
+def _get_active_policies_cache() -> LRUCache:
+    global _active_policies_cache
+    if _active_policies_cache is None:
+        with _active_policies_cache_lock:
+            if _active_policies_cache is None:
+                _active_policies_cache = LRUCache(max_entries=runtime_env.settings_active_policies_cache_max_entries,
+                                                  default_ttl=runtime_env.settings_active_policies_cache_ttl)
+    return _active_policies_cache
+
+def get_active_policy_version() -> Optional[str]:
+    # href of the last provisioned policy version, a cheap way to know if the active policies may have changed
+    versions = _coalesce('get_active_policy_version', None,
+                         lambda: _call_pce('do_get_call', path='/sec_policy', params={'max_results': 1}, include_org_id=True,
+                                           json_output_expected=True, async_call=False))
+    if len(versions) == 0:
+        return None
+    return versions[0]['href']
+
+
+def get_enabled_active_policies_cache() -> Optional[LRUCache]:
+    # a TTL of 0 disables the cache
+    return _get_active_policies_cache() if runtime_env.settings_active_policies_cache_ttl > 0 else None
+
+def make_cached_active_policies(policies: Any) -> CachedActivePolicies:
+    policies_json = json.dumps(policies, sort_keys=True, separators=(',', ':'))
+    return CachedActivePolicies(policies=policies, json=policies_json,
+                                etag=hashlib.sha256(policies_json.encode()).hexdigest(), compressed_json={},
+                                fetched_at=time.monotonic())
+
+def _get_active_policies_history() -> LRUCache:
+    global _active_policies_history
+    if _active_policies_history is None:
+        with _active_policies_cache_lock:
+            if _active_policies_history is None:
+                _active_policies_history = LRUCache(max_entries=runtime_env.settings_active_policies_history_max_entries,
+                                                    default_ttl=runtime_env.settings_active_policies_history_ttl)
+    return _active_policies_history
+
+def _get_active_policies_last_known() -> LRUCache:
+    global _active_policies_last_known
+    if _active_policies_last_known is None:
+        with _active_policies_cache_lock:
+            if _active_policies_last_known is None:
+                _active_policies_last_known = LRUCache(max_entries=runtime_env.settings_active_policies_cache_max_entries)
+    return _active_policies_last_known
+
+def store_active_policies(workload_href: str, cached_policies: CachedActivePolicies):
+    # latest version in the cache, every version in the history for deltas
+    cache = get_enabled_active_policies_cache()
+    if cache is not None:
+        cache.set(workload_href, cached_policies)
+    _get_active_policies_history().set((workload_href, cached_policies['etag']), cached_policies)
+    _get_active_policies_last_known().set(workload_href, cached_policies)
+
+def get_last_known_active_policies(workload_href: str, exception: PCEUnavailableEx) -> CachedActivePolicies:
+    # fallback when the PCE guard didn't let the call through, the exception is raised again if nothing is known
+    found, cached_policies = _get_active_policies_last_known().get(workload_href)
+    if not found:
+        raise exception
+    metrics.pce_stale_responses_total.inc('get_workload_active_policies')
+    return cached_policies
+
+def get_active_policies_version(workload_href: str, etag: str) -> Optional[CachedActivePolicies]:
+    found, cached_policies = _get_active_policies_history().get((workload_href, etag))
+    return cached_policies if found else None
+
+def get_workload_active_policies_cached(workload_href: str) -> CachedActivePolicies:
+    cache = get_enabled_active_policies_cache()
+    if cache is not None:
+        found, cached_policies = cache.get(workload_href)
+        if found:
+            return cached_policies
+
+    try:
+        cached_policies = make_cached_active_policies(get_workload_active_policies(workload_href))
+    except PCEUnavailableEx as exception:
+        return get_last_known_active_policies(workload_href, exception)
+    store_active_policies(workload_href, cached_policies)
+    return cached_policies
+
+def get_active_policies_cache_stats() -> CacheStats:
+    return _get_active_policies_cache().get_stats()
+
+def get_active_policies_history_stats() -> CacheStats:
+    return _get_active_policies_history().get_stats()
+
+
+def start_background_tasks():
+    # periodic refresh of the PCE objects indexes, only used by the server
+    if len(_background_workers) > 0:
+        return
+
+    _background_workers.append(PeriodicWorker('network-devices-index-refresh',
+                                              runtime_env.settings_network_devices_index_refresh_interval,
+                                              refresh_network_devices_index, run_on_stop=False))
+    _background_workers.append(PeriodicWorker('switch-endpoints-index-refresh',
+                                              runtime_env.settings_switch_endpoints_index_refresh_interval,
+                                              refresh_all_switch_endpoints_indexes, run_on_stop=False))
+    if runtime_env.settings_unmanaged_workloads_snapshot_enabled:
+        _background_workers.append(PeriodicWorker('unmanaged-workloads-snapshot-refresh',
+                                                  runtime_env.settings_unmanaged_workloads_snapshot_refresh_interval,
+                                                  refresh_unmanaged_workloads_snapshot, run_on_stop=False))
+    for worker in _background_workers:
+        worker.start()
+        # initial load right away rather than on first lookup
+        worker.wake()
 
-def get_workload_active_policies(workload_href: str):
-    return connector.object_workload_get_active_policies(workload_href=workload_href)
\ No newline at end of file
+def stop_background_tasks():
+    for worker in _background_workers:
+        worker.stop()
+    _background_workers.clear()
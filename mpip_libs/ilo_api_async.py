@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+import pylo
+
+import mpip_libs.ilo_api as ilo_api
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs import metrics
+from mpip_libs.pce_guard import PCEUnavailableEx
+from mpip_libs.single_flight import AsyncSingleFlight, SingleFlightStats
+
+# asyncio counterparts of the ilo_api calls made on the agents hot path, used by asgi_server.
+# with httpx installed the PCE is called without holding a thread, otherwise the ilo_api call runs in a worker thread.
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+_client: Optional['httpx.AsyncClient'] = None
+# same as ilo_api._pce_single_flight for the native calls, the threaded fallback is coalesced by ilo_api
+_single_flight = AsyncSingleFlight()
+
+
+def is_native() -> bool:
+    return _client is not None
+
+
+async def start():
+    global _client
+    if httpx is None:
+        logging.warning('httpx is not installed, PCE calls of the asgi server will use worker threads')
+        return
+
+    fqdn, port = runtime_env.settings_pce_fqdn_and_port.split(':')
+    # same URL, credentials and certificate checks as pylo.APIConnector
+    _client = httpx.AsyncClient(base_url=f'https://{fqdn}:{port}/api/v2/orgs/{runtime_env.settings_pce_org_id}',
+                                auth=(runtime_env.settings_pce_api_user, runtime_env.settings_pce_api_secret),
+                                headers={'Accept': 'application/json'},
+                                limits=httpx.Limits(max_connections=runtime_env.settings_pce_async_max_connections),
+                                timeout=runtime_env.settings_pce_async_timeout)
+
+
+async def stop():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _get(path: str, params: dict) -> Any:
+    try:
+        response = await _client.get(path, params=params)
+    except httpx.TransportError as e:
+        # same exception as pylo, so the PCE guard sees it as a failure
+        raise pylo.PyloApiEx(f'PCE connectivity or low level issue: {e}')
+    if response.status_code == 429:
+        raise pylo.PyloApiTooManyRequestsEx(f'PCE API rate limit reached for GET {path}')
+    if response.status_code >= 400:
+        raise pylo.PyloApiEx(f'PCE API returned HTTP {response.status_code} for GET {path}: {response.text}')
+    return response.json()
+
+
+async def get_workload_active_policies(workload_href: str) -> Any:
+    if _client is None:
+        return await asyncio.to_thread(ilo_api.get_workload_active_policies, workload_href)
+    # the guard is shared with ilo_api, so limits and circuit state apply to both kinds of calls
+    policies, shared = await _single_flight.do(('get_workload_active_policies', workload_href),
+                                               lambda: ilo_api.get_pce_guard().call_async(
+                                                   lambda: metrics.instrument_pce_call_async(
+                                                       'object_workload_get_active_policies',
+                                                       lambda: _get('/sec_policy/active/policy_view', {'workload': workload_href}))))
+    if shared:
+        metrics.pce_calls_deduplicated_total.inc('get_workload_active_policies')
+    return policies
+
+
+async def get_workload_active_policies_cached(workload_href: str) -> ilo_api.CachedActivePolicies:
+    # shares the ilo_api cache, so both server modes see the same entries
+    cache = ilo_api.get_enabled_active_policies_cache()
+    if cache is not None:
+        found, cached_policies = cache.get(workload_href)
+        if found:
+            return cached_policies
+
+    try:
+        cached_policies = ilo_api.make_cached_active_policies(await get_workload_active_policies(workload_href))
+    except PCEUnavailableEx as exception:
+        return ilo_api.get_last_known_active_policies(workload_href, exception)
+    ilo_api.store_active_policies(workload_href, cached_policies)
+    return cached_policies
+
+
+def get_single_flight_stats() -> SingleFlightStats:
+    return _single_flight.get_stats()
@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple, TypedDict
+
+# stale agents detection for the server: a timing wheel of heartbeats where each agent sits in the bucket
+# of its last heartbeat. For each threshold the set of stale agents is maintained by sweeping the buckets
+# crossing the threshold as time passes, so the cost follows the number of heartbeats, not the number of agents.
+
+max_tracked_thresholds = 16
+
+
+class LivenessStats(TypedDict):
+    agents: int
+    buckets: int
+    thresholds: int
+
+
+class LivenessTracker:
+    def __init__(self, granularity: float, thresholds: Iterable[int]):
+        self.granularity = granularity
+        self._lock = threading.Lock()
+        self._agent_bucket: dict[str, int] = {} # agent uuid -> bucket of its last heartbeat
+        self._buckets: dict[int, set[str]] = {} # bucket -> agents whose last heartbeat falls in it
+        self._stale_agents: dict[int, set[str]] = {} # threshold -> stale agents
+        self._swept_until: dict[int, int] = {} # threshold -> buckets before this one are in the stale set
+        for threshold in thresholds:
+            self._add_threshold(threshold, time.time())
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.granularity)
+
+    def _add_threshold(self, threshold: int, now: float):
+        # must be called with _lock held, costs a scan of the buckets once
+        cutoff = self._bucket(now - threshold)
+        stale_agents = set()
+        for bucket, agents in self._buckets.items():
+            if bucket < cutoff:
+                stale_agents.update(agents)
+        self._stale_agents[threshold] = stale_agents
+        self._swept_until[threshold] = cutoff
+
+    def _advance(self, now: float):
+        # must be called with _lock held
+        for threshold, swept_until in self._swept_until.items():
+            cutoff = self._bucket(now - threshold)
+            if cutoff <= swept_until:
+                continue
+            stale_agents = self._stale_agents[threshold]
+            for bucket in range(swept_until, cutoff):
+                agents = self._buckets.get(bucket)
+                if agents is not None:
+                    stale_agents.update(agents)
+            self._swept_until[threshold] = cutoff
+
+    def record(self, agent_uuid: str, timestamp: float):
+        new_bucket = self._bucket(timestamp)
+        with self._lock:
+            old_bucket = self._agent_bucket.get(agent_uuid)
+            # same bucket or out of order heartbeat
+            if old_bucket is not None and new_bucket <= old_bucket:
+                return
+            if old_bucket is not None:
+                self._remove_from_bucket(agent_uuid, old_bucket)
+            self._agent_bucket[agent_uuid] = new_bucket
+            self._buckets.setdefault(new_bucket, set()).add(agent_uuid)
+            for threshold, stale_agents in self._stale_agents.items():
+                # only happens for old timestamps, ie: when seeding from the database
+                if new_bucket < self._swept_until[threshold]:
+                    stale_agents.add(agent_uuid)
+                else:
+                    stale_agents.discard(agent_uuid)
+
+    def _remove_from_bucket(self, agent_uuid: str, bucket: int):
+        agents = self._buckets[bucket]
+        agents.discard(agent_uuid)
+        if len(agents) == 0:
+            del self._buckets[bucket]
+
+    def forget(self, agent_uuid: str):
+        with self._lock:
+            bucket = self._agent_bucket.pop(agent_uuid, None)
+            if bucket is None:
+                return
+            self._remove_from_bucket(agent_uuid, bucket)
+            for stale_agents in self._stale_agents.values():
+                stale_agents.discard(agent_uuid)
+
+    def forget_all(self):
+        with self._lock:
+            self._agent_bucket.clear()
+            self._buckets.clear()
+            for stale_agents in self._stale_agents.values():
+                stale_agents.clear()
+
+    def get_stale_agents(self, threshold: int) -> List[str]:
+        # agents without heartbeat for more than 'threshold' seconds (rounded to the granularity).
+        # thresholds not configured are tracked from their first use on, up to max_tracked_thresholds.
+        now = time.time()
+        with self._lock:
+            if threshold not in self._stale_agents:
+                if len(self._stale_agents) >= max_tracked_thresholds:
+                    cutoff = self._bucket(now - threshold)
+                    return [agent_uuid for bucket, agents in self._buckets.items() if bucket < cutoff for agent_uuid in agents]
+                self._add_threshold(threshold, now)
+            self._advance(now)
+            return list(self._stale_agents[threshold])
+
+    def get_stats(self) -> LivenessStats:
+        with self._lock:
+            return LivenessStats(agents=len(self._agent_bucket), buckets=len(self._buckets), thresholds=len(self._stale_agents))
+
+
+# only the server tracks liveness, these are no-ops until start() is called
+_tracker: Optional[LivenessTracker] = None
+
+
+def start(granularity: float, thresholds: Iterable[int], heartbeats: Iterable[Tuple[str, float]]):
+    # heartbeats: (agent uuid, last heartbeat) of the existing agents
+    global _tracker
+    start_time = time.monotonic()
+    tracker = LivenessTracker(granularity, thresholds)
+    for agent_uuid, last_heartbeat in heartbeats:
+        tracker.record(agent_uuid, last_heartbeat)
+    _tracker = tracker
+    logging.info('Liveness tracker seeded with %d agents in %.3fs', tracker.get_stats()['agents'], time.monotonic() - start_time)
+
+
+def stop():
+    global _tracker
+    _tracker = None
+
+
+def is_started() -> bool:
+    return _tracker is not None
+
+
+def record_heartbeat(agent_uuid: str, timestamp: float):
+    tracker = _tracker
+    if tracker is not None:
+        tracker.record(agent_uuid, timestamp)
+
+
+def forget(agent_uuid: str):
+    tracker = _tracker
+    if tracker is not None:
+        tracker.forget(agent_uuid)
+
+
+def forget_all():
+    tracker = _tracker
+    if tracker is not None:
+        tracker.forget_all()
+
+
+def get_stale_agents(threshold: int) -> List[str]:
+    if _tracker is None:
+        raise RuntimeError('Liveness tracker is not started')
+    return _tracker.get_stale_agents(threshold)
+
+
+def get_stats() -> LivenessStats:
+    tracker = _tracker
+    if tracker is None:
+        return LivenessStats(agents=0, buckets=0, thresholds=0)
+    return tracker.get_stats()
@@ -0,0 +1,203 @@
+import bisect
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Mapping, Optional, Sequence
+
+# in-process metrics exposed in Prometheus text format by the /metrics route.
+# recording is a dict lookup and a few additions under a lock, cheap enough to stay enabled in production.
+
+default_latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = '') -> str:
+    labels = [f'{name}="{_escape_label_value(str(value))}"' for name, value in zip(label_names, label_values)]
+    if extra != '':
+        labels.append(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = default_latency_buckets):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (not cumulative, last one is +Inf), sum]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[label_values] = entry
+            entry[0][bucket_index] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (bucket_counts, total) in self._values.items():
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets, bucket_counts):
+                    cumulative_count += count
+                    labels = _format_labels(self.label_names, label_values, 'le="' + str(upper_bound) + '"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative_count}')
+                cumulative_count += bucket_counts[-1]
+                labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative_count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.label_names, label_values)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.label_names, label_values)} {cumulative_count}')
+        return lines
+
+
+class StatsGauges:
+    # exposes the numeric fields of a stats TypedDict (ie: database.get_pool_stats()) as gauges named <prefix>_<field>
+    def __init__(self, prefix: str, description: str, stats_callback: Callable[[], Mapping]):
+        self.prefix = prefix
+        self.description = description
+        self.stats_callback = stats_callback
+
+    def render(self) -> list[str]:
+        lines = []
+        for field, value in self.stats_callback().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{self.prefix}_{field}'
+            lines.append(f'# HELP {name} {self.description}: {field}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return lines
+
+
+_registry: list = []
+_registry_lock = threading.Lock()
+
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def render_all() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+http_requests_total = register(Counter('mpip_http_requests_total', 'HTTP requests handled',
+                                       ('route', 'method', 'status')))
+http_request_duration_seconds = register(Histogram('mpip_http_request_duration_seconds', 'HTTP request handling time',
+                                                   ('route', 'method', 'status')))
+pce_calls_total = register(Counter('mpip_pce_calls_total', 'PCE API requests, retries included', ('function',)))
+pce_call_errors_total = register(Counter('mpip_pce_call_errors_total', 'PCE API requests which raised an exception', ('function',)))
+pce_calls_deduplicated_total = register(Counter('mpip_pce_calls_deduplicated_total',
+                                                'PCE calls which shared the result of an identical in-flight call', ('function',)))
+pce_stale_responses_total = register(Counter('mpip_pce_stale_responses_total',
+                                            'Cached data served because the PCE could not be called', ('function',)))
+pce_call_duration_seconds = register(Histogram('mpip_pce_call_duration_seconds', 'PCE API request time', ('function',)))
+db_statement_duration_seconds = register(Histogram('mpip_db_statement_duration_seconds', 'SQLite statement execution time',
+                                                   ('statement',)))
+
+
+def instrument_pce_call(function_name: str, call: Callable[[], Any]) -> Any:
+    # times a single PCE request: called by ilo_api._call_pce() inside the PCE guard, so calls served from a cache,
+    # shared with an identical call or refused by the guard are not counted. function_name is the connector method
+    start_time = time.perf_counter()
+    try:
+        return call()
+    except Exception:
+        pce_call_errors_total.inc(function_name)
+        raise
+    finally:
+        pce_calls_total.inc(function_name)
+        pce_call_duration_seconds.observe(time.perf_counter() - start_time, function_name)
+
+
+async def instrument_pce_call_async(function_name: str, call: Callable[[], Awaitable[Any]]) -> Any:
+    # same as instrument_pce_call() for the ilo_api_async requests
+    start_time = time.perf_counter()
+    try:
+        return await call()
+    except Exception:
+        pce_call_errors_total.inc(function_name)
+        raise
+    finally:
+        pce_calls_total.inc(function_name)
+        pce_call_duration_seconds.observe(time.perf_counter() - start_time, function_name)
+
+
+_statement_label_regex = re.compile(r'^\s*(\w+)(?:\s+(?:.*?\b(?:FROM|INTO)\s+)?(\w+))?', re.IGNORECASE | re.DOTALL)
+_statement_labels: dict[str, str] = {}
+
+
+def _statement_label(sql: str) -> str:
+    # 'SELECT lven_agents', 'UPDATE lven_agent_pairing_keys'... statements are literals so this cache stays small
+    label = _statement_labels.get(sql)
+    if label is None:
+        match = _statement_label_regex.match(sql)
+        if match is None:
+            label = 'other'
+        elif match.group(2) is not None:
+            label = f'{match.group(1).upper()} {match.group(2)}'
+        else:
+            label = match.group(1).upper()
+        _statement_labels[sql] = label
+    return label
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            db_statement_duration_seconds.observe(time.perf_counter() - start_time, _statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            db_statement_duration_seconds.observe(time.perf_counter() - start_time, _statement_label(sql))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # used as sqlite3.connect() factory so statements run through db.cursor() are timed
+    def cursor(self, factory: Optional[type] = None):
+        return super().cursor(factory if factory is not None else InstrumentedCursor)
@@ -2,6 +2,9 @@ default_runtime_env_file_location = '/etc/illumio-mpip/runtime_env.yml'
 
 import mpip_libs.runtime_env as runtime_env
 import os
+import logging
+import threading
+from typing import Callable, Optional
 
 def check_required_directories_exist():
     # check if the runtime directory exists and is writable
@@ -21,3 +24,37 @@ def check_required_directories_exist():
         raise FileNotFoundError(f"The directory {runtime_env.settings_log_directory} does not exist.")
     if not os.access(runtime_env.settings_log_directory, os.W_OK):
         raise PermissionError(f"The directory {runtime_env.settings_log_directory} is not writable.")
+
+
+class PeriodicWorker(threading.Thread):
+    # runs 'target' every 'interval' seconds in a daemon thread, or sooner when wake() is called.
+    # with run_on_stop, target is called one last time when the worker is stopped so pending work is not lost.
+    def __init__(self, name: str, interval: float, target: Callable[[], None], run_on_stop: bool = True):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.target = target
+        self.run_on_stop = run_on_stop
+        self._wake_event = threading.Event()
+        self._stop_requested = False
+
+    def run(self):
+        while not self._stop_requested:
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+            if self._stop_requested and not self.run_on_stop:
+                break
+            self._run_target()
+
+    def _run_target(self):
+        try:
+            self.target()
+        except Exception:
+            logging.exception('Background worker %s failed', self.name)
+
+    def wake(self):
+        self._wake_event.set()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop_requested = True
+        self._wake_event.set()
+        self.join(timeout)
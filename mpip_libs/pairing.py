@@ -0,0 +1,422 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlite3 import Connection
+from typing import Callable, List, Literal, NotRequired, Optional, TypedDict
+
+import mpip_libs.agent_tokens as agent_tokens
+import mpip_libs.database as database
+import mpip_libs.ilo_api as ilo_api
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs.database import LVENAgent, LVENPairingKey
+
+
+class PairingError(Exception):
+    def __init__(self, message: str, http_status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.http_status = http_status
+
+
+class PairingResult(TypedDict):
+    agent_uuid: str
+    authentication_key: str
+    authentication_token: NotRequired[str] # when runtime_env agent_tokens_enabled, see agent_tokens
+
+
+class BulkPairingRequestRow(TypedDict):
+    agent_name: str
+    target_switch: NotRequired[Optional[str]] # switch HREF or name, CLI import only: refused with an activation key
+
+
+class BulkPairingRowResult(TypedDict):
+    row: int # position of the row in the request, starting at 1
+    agent_name: Optional[str]
+    status: Literal['paired', 'failed']
+    error: Optional[str]
+    agent_uuid: Optional[str]
+    authentication_key: Optional[str]
+    authentication_token: Optional[str] # when runtime_env agent_tokens_enabled
+    pce_workload_href: Optional[str]
+    target_switch_href: Optional[str]
+
+
+class PairingJob(TypedDict):
+    job_id: str
+    agent_name: str
+    status: Literal['queued', 'running', 'done', 'failed']
+    step: Optional[str] # current step while running
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    result: Optional[PairingResult] # when status is 'done'
+    error: Optional[str] # when status is 'failed'
+    error_http_status: Optional[int]
+
+
+class PairingJobsStats(TypedDict):
+    queued: int
+    running: int
+    completed: int
+    failed: int
+    rejected: int # jobs refused because the queue was full
+    latency_average: Optional[float] # seconds from submission to completion
+    latency_max: Optional[float]
+
+
+_jobs: dict[str, PairingJob] = {}
+_jobs_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_jobs_stats = PairingJobsStats(queued=0, running=0, completed=0, failed=0, rejected=0, latency_average=None, latency_max=None)
+_jobs_latency_total = 0.0
+
+
+def validate_pairing_request(db: Connection, request_json: dict) -> LVENPairingKey.PairingKeyObject:
+    # checks which don't need the PCE, so async requests can be refused right away
+
+    # check if an agent name was provided
+    if 'agent_name' not in request_json:
+        raise PairingError('Agent name not provided')
+
+    agent_name = request_json['agent_name']
+    #does the agent name already exist?
+    if database.LVENAgent.name_exists(db, agent_name):
+        raise PairingError('Agent name already exists')
+
+    # check if an activation key was provided
+    if 'pairing_key' not in request_json:
+        raise PairingError('Activation key not provided')
+
+    return validate_activation_key(db, request_json['pairing_key'])
+
+
+def validate_activation_key(db: Connection, pairing_key: str) -> LVENPairingKey.PairingKeyObject:
+    #does the activation key exist?
+    activation_key: LVENPairingKey.PairingKeyObject = database.LVENPairingKey.get_single(db, pairing_key)
+    if activation_key is None:
+        raise PairingError('Activation key does not exist')
+
+    #is the activation key still valid?
+    if activation_key['valid_until'] is not None and activation_key['valid_until'] < int(time.time()):
+        raise PairingError('Activation key has expired')
+
+    #does it still have enough use counts?
+    if activation_key['remaining_uses'] is not None and activation_key['remaining_uses'] <= 0:
+        raise PairingError('Activation key has no more uses left')
+
+    return activation_key
+
+
+def pair_agent(db: Connection, agent_name: str, activation_key: LVENPairingKey.PairingKeyObject,
+               progress_callback: Optional[Callable[[str], None]] = None) -> PairingResult:
+    # PCE side of the pairing then agent creation, the request must have been validated first
+    def progress(step: str):
+        if progress_callback is not None:
+            progress_callback(step)
+
+    # one use of the activation key is taken before any PCE change, so a key used up or expired meanwhile can't leave
+    # a switch binding without its agent. The use is given back if the pairing fails.
+    _reserve_activation_key(db, activation_key['key'])
+    try:
+        agent = _pair_agent_with_reserved_use(db, agent_name, activation_key, progress)
+    except Exception:
+        _release_activation_key(db, activation_key['key'])
+        raise
+
+    result = PairingResult(agent_uuid=agent['uuid'], authentication_key=agent['authentication_key'])
+    if runtime_env.settings_agent_tokens_enabled:
+        result['authentication_token'] = agent_tokens.issue(agent['uuid'], agent['pce_workload_href'])
+    return result
+
+
+def _pair_agent_with_reserved_use(db: Connection, agent_name: str, activation_key: LVENPairingKey.PairingKeyObject,
+                                  progress: Callable[[str], None]) -> LVENAgent.LVENAgentObject:
+    # does the agent_name exists in the PCE?
+    progress('searching workload')
+    # a switch binding is not undone if the workload turns out to be wrong, so it is looked up in the PCE rather
+    # than trusted from the snapshot
+    pce_workloads = ilo_api.find_unmanaged_workloads_with_specific_name(agent_name,
+                                                                       use_snapshot=activation_key['target_switch_href'] is None)
+    if len(pce_workloads) == 0:
+        raise PairingError('Agent name does not exist in the PCE or is already managed')
+    if len(pce_workloads) > 1:
+        raise PairingError('Agent name exists more than once in the PCE')
+
+    workload_href = pce_workloads[0]['href']
+
+    if activation_key['target_switch_href'] is not None:
+        # does the switch still exist in the PCE?
+        progress('checking switch')
+        switch = ilo_api.find_switch_from_href_or_name(activation_key['target_switch_href'])
+        if switch is None:
+            raise PairingError('Target switch does not exist in the PCE')
+        # is the workload_href already bound to the switch?
+        if ilo_api.find_if_workload_is_already_assigned_to_a_switch_port(workload_href, activation_key['target_switch_href']):
+            raise PairingError('Workload is already bound to the switch')
+
+        # bind the workload to the switch
+        progress('binding workload to switch')
+        logging.info(f'Binding workload {workload_href} to switch {activation_key["target_switch_href"]}')
+        ilo_api.bind_workload_to_switch(workload_href, activation_key['target_switch_href'])
+
+    # the name may have been taken by another pairing while we were busy with the PCE
+    progress('creating agent')
+    if database.LVENAgent.name_exists(db, agent_name):
+        raise PairingError('Agent name already exists')
+
+    return database.LVENAgent.create(db, agent_name, pce_workload_href=workload_href)
+
+
+def _reserve_activation_key(db: Connection, pairing_key: str, count: int = 1):
+    # takes 'count' uses of the key and commits, see _release_activation_key() to give them back
+    try:
+        consumed = database.LVENPairingKey.consume(db, pairing_key, count)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if consumed is not None:
+        return
+    # the key changed since it was validated, find out why for the error message
+    validate_activation_key(db, pairing_key)
+    raise PairingError('Activation key has no more uses left')
+
+
+def _release_activation_key(db: Connection, pairing_key: str, count: int = 1):
+    if count > 0:
+        database.LVENPairingKey.release(db, pairing_key, count)
+
+
+def bulk_pair_agents(db: Connection, rows: List[BulkPairingRequestRow],
+                     activation_key: Optional[LVENPairingKey.PairingKeyObject] = None) -> List[BulkPairingRowResult]:
+    # pairs many agents at once: one PCE query to resolve all workloads, switch bindings made switch by switch
+    # (one endpoint creation per workload, the PCE API has no bulk creation) and all agents inserted in a single
+    # transaction. Failures are reported per row and don't stop the others.
+    # Without an activation key (CLI import) only the switch given in each row is used. With one, only its switch is
+    # used and rows naming a switch are refused, so a key holder can't bind workloads outside the key restriction.
+    results: List[BulkPairingRowResult] = []
+    for row_number, row in enumerate(rows, start=1):
+        results.append(BulkPairingRowResult(row=row_number, agent_name=row.get('agent_name'), status='failed', error=None,
+                                            agent_uuid=None, authentication_key=None, authentication_token=None,
+                                            pce_workload_href=None,
+                                            target_switch_href=None))
+
+    # local checks first
+    remaining_uses = activation_key['remaining_uses'] if activation_key is not None else None
+    names_seen = set()
+    pending: List[BulkPairingRowResult] = []
+    for result, row in zip(results, rows):
+        agent_name = result['agent_name']
+        if agent_name is None or agent_name == '':
+            result['error'] = 'Agent name not provided'
+        elif activation_key is not None and row.get('target_switch') is not None:
+            result['error'] = 'Target switch can not be set per agent with an activation key'
+        elif agent_name in names_seen:
+            result['error'] = 'Agent name is present more than once in the request'
+        elif database.LVENAgent.name_exists(db, agent_name):
+            result['error'] = 'Agent name already exists'
+        elif remaining_uses is not None and len(pending) >= remaining_uses:
+            result['error'] = 'Activation key has no more uses left'
+        else:
+            pending.append(result)
+        if agent_name is not None:
+            names_seen.add(agent_name)
+
+    if len(pending) == 0:
+        return results
+
+    # resolve all workloads with a single PCE query
+    workloads_by_name = ilo_api.find_unmanaged_workloads_with_specific_names([result['agent_name'] for result in pending])
+    to_bind: List[BulkPairingRowResult] = []
+    for result in pending:
+        pce_workloads = workloads_by_name[result['agent_name']]
+        if len(pce_workloads) == 0:
+            result['error'] = 'Agent name does not exist in the PCE or is already managed'
+        elif len(pce_workloads) > 1:
+            result['error'] = 'Agent name exists more than once in the PCE'
+        else:
+            result['pce_workload_href'] = pce_workloads[0]['href']
+            to_bind.append(result)
+
+    if len(to_bind) == 0:
+        return results
+
+    # the activation key uses are taken before any PCE change, the unused ones are given back at the end
+    reserved_uses = 0
+    if activation_key is not None:
+        try:
+            _reserve_activation_key(db, activation_key['key'], count=len(to_bind))
+        except PairingError as e:
+            for result in to_bind:
+                result['error'] = e.message
+            return results
+        reserved_uses = len(to_bind)
+    try:
+        _bind_and_create_agents(db, rows, to_bind, activation_key)
+    finally:
+        if activation_key is not None:
+            _release_activation_key(db, activation_key['key'], reserved_uses - len([result for result in to_bind if result['status'] == 'paired']))
+
+    return results
+
+
+def _bind_and_create_agents(db: Connection, rows: List[BulkPairingRequestRow], to_bind: List[BulkPairingRowResult],
+                            activation_key: Optional[LVENPairingKey.PairingKeyObject]):
+    # resolve target switches and order the rows per switch, each binding is still a PCE call
+    rows_per_switch: dict[str, List[BulkPairingRowResult]] = {}
+    to_create: List[BulkPairingRowResult] = []
+    for result in to_bind:
+        if activation_key is not None:
+            target_switch = activation_key['target_switch_href']
+        else:
+            target_switch = rows[result['row'] - 1].get('target_switch')
+        if target_switch is None:
+            to_create.append(result)
+            continue
+        switch = ilo_api.find_switch_from_href_or_name(target_switch)
+        if switch is None:
+            result['error'] = 'Target switch does not exist in the PCE'
+            continue
+        result['target_switch_href'] = switch['href']
+        rows_per_switch.setdefault(switch['href'], []).append(result)
+
+    for switch_href, switch_rows in rows_per_switch.items():
+        logging.info('Binding %d workloads to switch %s', len(switch_rows), switch_href)
+        for result in switch_rows:
+            try:
+                if ilo_api.find_if_workload_is_already_assigned_to_a_switch_port(result['pce_workload_href'], switch_href):
+                    result['error'] = 'Workload is already bound to the switch'
+                    continue
+                ilo_api.bind_workload_to_switch(result['pce_workload_href'], switch_href)
+            except Exception as e:
+                logging.exception('Failed to bind workload %s to switch %s', result['pce_workload_href'], switch_href)
+                result['error'] = f'Failed to bind workload to the switch: {e}'
+                continue
+            to_create.append(result)
+
+    if len(to_create) == 0:
+        return
+
+    # create all agents in a single transaction
+    to_create.sort(key=lambda result: result['row'])
+    try:
+        agents = database.LVENAgent.create_many(db, [(result['agent_name'], result['pce_workload_href']) for result in to_create], commit=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logging.exception('Failed to create %d agents', len(to_create))
+        # pylo can't delete the endpoints just created, the rows report them so they can be removed in the PCE
+        for result in to_create:
+            if result['target_switch_href'] is not None:
+                result['error'] = f'Agent could not be created, the workload stays bound to the switch: {e}'
+            else:
+                result['error'] = f'Agent could not be created: {e}'
+        return
+
+    for result, agent in zip(to_create, agents):
+        result['status'] = 'paired'
+        result['agent_uuid'] = agent['uuid']
+        result['authentication_key'] = agent['authentication_key']
+        if runtime_env.settings_agent_tokens_enabled:
+            result['authentication_token'] = agent_tokens.issue(agent['uuid'], agent['pce_workload_href'])
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _jobs_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=runtime_env.settings_pairing_workers,
+                                               thread_name_prefix='pairing-worker')
+    return _executor
+
+
+def _forget_old_jobs():
+    # must be called with _jobs_lock held
+    expired_before = time.time() - runtime_env.settings_pairing_jobs_retention
+    for job_id in [job['job_id'] for job in _jobs.values() if job['finished_at'] is not None and job['finished_at'] < expired_before]:
+        del _jobs[job_id]
+
+
+def submit_pairing_job(agent_name: str, activation_key: LVENPairingKey.PairingKeyObject) -> PairingJob:
+    with _jobs_lock:
+        _forget_old_jobs()
+        if _jobs_stats['queued'] >= runtime_env.settings_pairing_queue_size:
+            _jobs_stats['rejected'] += 1
+            raise PairingError('Pairing queue is full, try again later', 503)
+
+        job = PairingJob(job_id=str(uuid.uuid4()), agent_name=agent_name, status='queued', step=None,
+                         created_at=time.time(), started_at=None, finished_at=None,
+                         result=None, error=None, error_http_status=None)
+        _jobs[job['job_id']] = job
+        _jobs_stats['queued'] += 1
+
+    _get_executor().submit(_run_pairing_job, job, activation_key)
+    return PairingJob(**job)
+
+
+def _run_pairing_job(job: PairingJob, activation_key: LVENPairingKey.PairingKeyObject):
+    global _jobs_latency_total
+
+    with _jobs_lock:
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        _jobs_stats['queued'] -= 1
+        _jobs_stats['running'] += 1
+
+    def progress(step: str):
+        job['step'] = step
+
+    result: Optional[PairingResult] = None
+    error: Optional[PairingError] = None
+    try:
+        result = pair_agent(database.new_connection(), job['agent_name'], activation_key, progress_callback=progress)
+    except PairingError as e:
+        error = e
+    except Exception as e:
+        logging.exception('Pairing job %s failed', job['job_id'])
+        error = PairingError(f'Internal error: {e}', 500)
+
+    with _jobs_lock:
+        job['finished_at'] = time.time()
+        job['step'] = None
+        if error is None:
+            job['status'] = 'done'
+            job['result'] = result
+            _jobs_stats['completed'] += 1
+        else:
+            job['status'] = 'failed'
+            job['error'] = error.message
+            job['error_http_status'] = error.http_status
+            _jobs_stats['failed'] += 1
+        _jobs_stats['running'] -= 1
+
+        latency = job['finished_at'] - job['created_at']
+        _jobs_latency_total += latency
+        _jobs_stats['latency_average'] = _jobs_latency_total / (_jobs_stats['completed'] + _jobs_stats['failed'])
+        if _jobs_stats['latency_max'] is None or latency > _jobs_stats['latency_max']:
+            _jobs_stats['latency_max'] = latency
+
+
+def get_pairing_job(job_id: str) -> Optional[PairingJob]:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        return PairingJob(**job)
+
+
+def get_pairing_jobs_stats() -> PairingJobsStats:
+    with _jobs_lock:
+        return PairingJobsStats(**_jobs_stats)
+
+
+def shutdown_workers():
+    # waits for queued and running jobs so no pairing is left half done
+    global _executor
+    if _executor is None:
+        return
+    _executor.shutdown(wait=True)
+    _executor = None
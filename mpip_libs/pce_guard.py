@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypedDict
+
+import pylo
+
+# protects the PCE, and the server, when the PCE slows down or rejects calls: every ilo_api call goes through a
+# PCEGuard which applies, in this order:
+#  - a circuit breaker: after failure_threshold consecutive failed calls the PCE is not called for reset_timeout
+#    seconds, callers fail fast with PCEUnavailableEx (ilo_api serves cached data where it has some). One call is
+#    then let through, its result closes the circuit or opens it again.
+#  - a token bucket rate limit (rate_limit calls per second, bursts of rate_limit_burst)
+#  - a limit of max_concurrent_calls calls in progress
+#  - retries with jittered exponential backoff when the PCE is unreachable or answers 429/5xx, for idempotent calls only
+# a call which can't get a token or a slot within wait_timeout seconds fails with PCEUnavailableEx too.
+
+
+class PCEUnavailableEx(pylo.PyloApiEx):
+    # the PCE was not called, retry later
+    pass
+
+
+class PCEGuardStats(TypedDict):
+    circuit_state: str
+    circuit_opened: int # times the circuit was opened
+    in_progress: int
+    calls: int
+    failures: int # calls which failed after their retries
+    retries: int
+    throttled: int # calls delayed by the rate limit
+    rejected: int # calls failed fast: circuit open or waited more than wait_timeout
+
+
+_status_code_regex = re.compile(r'(?:error status "|HTTP )(\d{3})')
+
+
+def _get_status_code(exception: Exception) -> Optional[int]:
+    # pylo (and ilo_api_async) only keep the HTTP status in the message
+    match = _status_code_regex.search(str(exception))
+    return int(match.group(1)) if match is not None else None
+
+
+def is_pce_failure(exception: Exception) -> bool:
+    # failures which mean the PCE is overloaded or unreachable: worth a retry and counted by the circuit breaker.
+    # other errors (ie: 404, invalid parameters) are answers from a healthy PCE.
+    if isinstance(exception, PCEUnavailableEx):
+        return False
+    if isinstance(exception, pylo.PyloApiTooManyRequestsEx):
+        return True
+    if isinstance(exception, pylo.PyloApiEx):
+        status_code = _get_status_code(exception)
+        if status_code is None:
+            # 'PCE connectivity or low level issue'
+            return 'connectivity' in str(exception)
+        return status_code == 429 or status_code >= 500
+    return isinstance(exception, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        # takes a token, returns how long to wait before using it, or None (and no token taken) if more than max_wait.
+        # tokens may be borrowed from the future, so waiting callers are served in order without polling
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.closed
+        self.opened_count = 0
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.closed:
+                return True
+            if self.state == self.open:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.half_open
+                self._probe_started_at = None
+            # half open: a single call checks if the PCE is back. A probe which never reported (ie: it was
+            # rejected by the rate limit before calling the PCE) is replaced after reset_timeout
+            now = time.monotonic()
+            if self._probe_started_at is not None and now - self._probe_started_at < self.reset_timeout:
+                return False
+            self._probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.closed:
+                logging.info('PCE calls circuit closed')
+            self.state = self.closed
+            self._consecutive_failures = 0
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self.state == self.half_open or self._consecutive_failures >= self.failure_threshold:
+                if self.state != self.open:
+                    self.opened_count += 1
+                    logging.warning(f"PCE calls circuit opened for {self.reset_timeout}s after {self._consecutive_failures} failures")
+                self.state = self.open
+                self._opened_at = time.monotonic()
+                self._probe_started_at = None
+
+
+class PCEGuard:
+    # a setting of 0 disables rate_limit, max_concurrent_calls and the circuit breaker (failure_threshold)
+    def __init__(self, rate_limit: float, rate_limit_burst: int, max_concurrent_calls: int, wait_timeout: float,
+                 retry_max_attempts: int, retry_base_delay: float, retry_max_delay: float,
+                 failure_threshold: int, reset_timeout: float):
+        self.rate_limiter = TokenBucket(rate_limit, rate_limit_burst) if rate_limit > 0 else None
+        self.max_concurrent_calls = max_concurrent_calls
+        self.wait_timeout = wait_timeout
+        self.retry_max_attempts = max(retry_max_attempts, 1)
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout) if failure_threshold > 0 else None
+        self._slots = threading.BoundedSemaphore(max_concurrent_calls) if max_concurrent_calls > 0 else None
+        # asyncio.Semaphore can't be shared with threads, async calls have their own slots
+        self._async_slots: Optional[asyncio.Semaphore] = None
+        self._stats_lock = threading.Lock()
+        self._stats = PCEGuardStats(circuit_state=CircuitBreaker.closed, circuit_opened=0, in_progress=0, calls=0,
+                                    failures=0, retries=0, throttled=0, rejected=0)
+
+    def _count(self, field: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[field] += amount
+
+    def _check_circuit(self):
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            self._count('rejected')
+            raise PCEUnavailableEx('PCE calls circuit is open, the PCE is not responding properly')
+
+    def _reserve_token(self) -> float:
+        if self.rate_limiter is None:
+            return 0.0
+        wait = self.rate_limiter.reserve(self.wait_timeout)
+        if wait is None:
+            self._count('rejected')
+            raise PCEUnavailableEx(f'PCE calls rate limit: no call possible within {self.wait_timeout}s')
+        if wait > 0:
+            self._count('throttled')
+        return wait
+
+    def _slot_timeout(self):
+        self._count('rejected')
+        return PCEUnavailableEx(f'{self.max_concurrent_calls} PCE calls in progress, no slot within {self.wait_timeout}s')
+
+    def _handle_failure(self, exception: Exception, attempt: int, idempotent: bool) -> Optional[float]:
+        # returns the backoff delay before the next attempt, None if the exception must be raised
+        if not is_pce_failure(exception):
+            # the PCE answered
+            if self.circuit_breaker is not None and not isinstance(exception, PCEUnavailableEx):
+                self.circuit_breaker.record_success()
+            return None
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_failure()
+        if not idempotent or attempt >= self.retry_max_attempts:
+            self._count('failures')
+            return None
+        self._count('retries')
+        # full jitter, so callers which failed together don't retry together
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))
+
+    def _handle_success(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+
+    def call(self, function: Callable[[], Any], idempotent: bool = True) -> Any:
+        self._count('calls')
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_circuit()
+            time.sleep(self._reserve_token())
+            if self._slots is not None and not self._slots.acquire(timeout=self.wait_timeout):
+                raise self._slot_timeout()
+            self._count('in_progress')
+            try:
+                result = function()
+            except Exception as exception:
+                delay = self._handle_failure(exception, attempt, idempotent)
+                if delay is None:
+                    raise
+            else:
+                self._handle_success()
+                return result
+            finally:
+                self._count('in_progress', -1)
+                if self._slots is not None:
+                    self._slots.release()
+            time.sleep(delay)
+
+    async def call_async(self, coroutine_function: Callable[[], Awaitable[Any]], idempotent: bool = True) -> Any:
+        if self.max_concurrent_calls > 0 and self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrent_calls)
+        self._count('calls')
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_circuit()
+            await asyncio.sleep(self._reserve_token())
+            if self._async_slots is not None:
+                try:
+                    await asyncio.wait_for(self._async_slots.acquire(), self.wait_timeout)
+                except asyncio.TimeoutError:
+                    raise self._slot_timeout()
+            self._count('in_progress')
+            try:
+                result = await coroutine_function()
+            except Exception as exception:
+                delay = self._handle_failure(exception, attempt, idempotent)
+                if delay is None:
+                    raise
+            else:
+                self._handle_success()
+                return result
+            finally:
+                self._count('in_progress', -1)
+                if self._async_slots is not None:
+                    self._async_slots.release()
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> PCEGuardStats:
+        with self._stats_lock:
+            stats = PCEGuardStats(**self._stats)
+        if self.circuit_breaker is not None:
+            stats['circuit_state'] = self.circuit_breaker.state
+            stats['circuit_opened'] = self.circuit_breaker.opened_count
+        return stats
@@ -0,0 +1,124 @@
+import hashlib
+import json
+from collections import Counter
+from typing import Any, Iterable, Optional, TypedDict
+
+from werkzeug.http import quote_etag
+
+import mpip_libs.compression as compression
+import mpip_libs.ilo_api as ilo_api
+
+# builds the active policies responses of both server modes: 304 when the agent is up to date, a delta against the
+# version it holds when it asks for one (RFC 3229 'A-IM: mpip-delta' header, answered with '226 IM Used'), or the
+# full policies. The body is compressed according to Accept-Encoding.
+#
+# a delta lists, for each list in the policies (ie: 'rules'), the items added and the hashes of the items removed.
+# an item hash is the sha256 of its JSON with sorted keys and no spaces, agents compute it the same way to apply it.
+# anything else changing (or a delta bigger than the full policies) means the full policies are sent.
+
+delta_instance_manipulation = 'mpip-delta'
+
+
+class ListDelta(TypedDict):
+    added: list
+    removed: list[str] # hashes of the removed items
+
+
+class PolicyDelta(TypedDict):
+    base_version: str
+    version: str
+    changes: dict[str, ListDelta] # key of a list in the policies -> its changes
+
+
+class ActivePoliciesResponse(TypedDict):
+    status: int
+    body: bytes
+    headers: dict[str, str]
+
+
+def item_hash(item: Any) -> str:
+    return hashlib.sha256(json.dumps(item, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def compute_delta(base: ilo_api.CachedActivePolicies, current: ilo_api.CachedActivePolicies) -> Optional[PolicyDelta]:
+    # None when the changes can't be expressed as list items added/removed
+    base_policies = base['policies']
+    current_policies = current['policies']
+    if not isinstance(base_policies, dict) or not isinstance(current_policies, dict):
+        return None
+    if base_policies.keys() != current_policies.keys():
+        return None
+
+    changes: dict[str, ListDelta] = {}
+    for key, current_value in current_policies.items():
+        base_value = base_policies[key]
+        if current_value == base_value:
+            continue
+        if not isinstance(current_value, list) or not isinstance(base_value, list):
+            return None
+        # multisets, the same rule can appear twice
+        base_items = Counter(item_hash(item) for item in base_value)
+        added = []
+        for item in current_value:
+            hash_value = item_hash(item)
+            if base_items[hash_value] > 0:
+                base_items[hash_value] -= 1
+            else:
+                added.append(item)
+        removed = [hash_value for hash_value, count in base_items.items() for _ in range(count)]
+        changes[key] = ListDelta(added=added, removed=removed)
+
+    return PolicyDelta(base_version=base['etag'], version=current['etag'], changes=changes)
+
+
+def _compressed_policies_json(active_policies: ilo_api.CachedActivePolicies, encoding: str) -> bytes:
+    # the full policies are sent to every agent of the workload, compress them once
+    compressed = active_policies['compressed_json'].get(encoding)
+    if compressed is None:
+        compressed = compression.compress(active_policies['json'].encode(), encoding)
+        active_policies['compressed_json'][encoding] = compressed
+    return compressed
+
+
+def render_active_policies(workload_href: str, active_policies: ilo_api.CachedActivePolicies, known_versions: Iterable[str],
+                           accept_delta: bool, accept_encoding: Optional[str]) -> ActivePoliciesResponse:
+    known_versions = list(known_versions)
+    headers = {'ETag': quote_etag(active_policies['etag'])}
+    if active_policies['etag'] in known_versions:
+        return ActivePoliciesResponse(status=304, body=b'', headers=headers)
+
+    status = 200
+    body = None
+    if accept_delta:
+        for base_version in known_versions:
+            base = ilo_api.get_active_policies_version(workload_href, base_version)
+            if base is None:
+                continue
+            delta = compute_delta(base, active_policies)
+            if delta is None:
+                break
+            delta_json = json.dumps(delta, separators=(',', ':'))
+            if len(delta_json) < len(active_policies['json']):
+                status = 226
+                body = delta_json.encode()
+                headers['IM'] = delta_instance_manipulation
+                headers['Delta-Base'] = quote_etag(base_version)
+            break
+
+    headers['Content-Type'] = 'application/json'
+    headers['Vary'] = 'Accept-Encoding, A-IM'
+    encoding = compression.choose_encoding(accept_encoding)
+    if body is None:
+        body = active_policies['json'].encode()
+        if encoding is not None and compression.should_compress(len(body), 'application/json'):
+            body = _compressed_policies_json(active_policies, encoding)
+            headers['Content-Encoding'] = encoding
+    elif encoding is not None and compression.should_compress(len(body), 'application/json'):
+        body = compression.compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+
+    return ActivePoliciesResponse(status=status, body=body, headers=headers)
+
+
+def accepts_delta(a_im: Optional[str]) -> bool:
+    return a_im is not None and delta_instance_manipulation in [value.split(';')[0].strip() for value in a_im.split(',')]
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional, TypedDict
+
+import mpip_libs.ilo_api as ilo_api
+from mpip_libs import shared_state
+from mpip_libs.misc import PeriodicWorker
+
+# long-poll support for the active policies: agents wait for the version (etag) they hold to change.
+# a single background watcher polls the PCE policy version and, when a new version is provisioned (or every
+# full_recheck_interval as label or IP changes don't create one), fetches the active policies of the workloads
+# having waiters only. Waiters of the workloads whose policies changed are notified, the others keep waiting.
+# in the 'prefork' mode a single worker polls the PCE version, it bumps the shared 'active_policies' generation so the
+# watchers of the other workers (poll_pce False) recheck their own watched workloads.
+
+NotifyCallback = Callable[[ilo_api.CachedActivePolicies], None]
+
+
+class TooManyWaitersEx(Exception):
+    pass
+
+
+class PolicyWatcherStats(TypedDict):
+    watched_workloads: int
+    waiters: int
+    checks: int # PCE policy version checks, or shared generation checks when not polling the PCE
+    rechecks: int # workloads active policies fetched because of a new version or a full recheck
+    changes: int # workloads whose active policies changed
+    notifications: int # waiters woken up
+    blocking_waiters: int # wait_for_change() calls holding a thread
+    rejected_waiters: int # wait_for_change() calls refused as max_blocking_waiters were already waiting
+
+
+class _WatchedWorkload:
+    def __init__(self, latest: ilo_api.CachedActivePolicies):
+        self.latest = latest
+        self.waiters: list[NotifyCallback] = []
+
+
+class PolicyWatcher:
+    def __init__(self, interval: float, full_recheck_interval: float, max_blocking_waiters: Optional[int] = None,
+                 poll_pce: bool = True):
+        self.full_recheck_interval = full_recheck_interval
+        self.max_blocking_waiters = max_blocking_waiters # None for no limit
+        self.poll_pce = poll_pce
+        self._generation = shared_state.get_generation('active_policies')
+        self._blocking_waiters = 0
+        self._lock = threading.Lock()
+        self._watched: dict[str, _WatchedWorkload] = {} # workload href -> watched workload, while it has waiters
+        self._policy_version: Optional[str] = None
+        self._last_full_recheck = time.monotonic()
+        self._stats = PolicyWatcherStats(watched_workloads=0, waiters=0, checks=0, rechecks=0, changes=0, notifications=0,
+                                         blocking_waiters=0, rejected_waiters=0)
+        self._worker = PeriodicWorker('policy-watcher', interval, self.check, run_on_stop=False)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self):
+        self._worker.stop()
+
+    def add_waiter(self, workload_href: str, known_policies: ilo_api.CachedActivePolicies, callback: NotifyCallback):
+        # callback is called from the watcher thread once, unless remove_waiter() is called first.
+        # if the watcher already saw a newer version than the one the waiter knows, it is notified right away.
+        # a waiter knowing a newer version (ie: fetched by an agent request after the last check) makes it the latest.
+        with self._lock:
+            watched = self._watched.get(workload_href)
+            if watched is None:
+                watched = _WatchedWorkload(known_policies)
+                self._watched[workload_href] = watched
+            if watched.latest['etag'] == known_policies['etag'] or watched.latest['fetched_at'] <= known_policies['fetched_at']:
+                if watched.latest['etag'] != known_policies['etag']:
+                    watched.latest = known_policies
+                watched.waiters.append(callback)
+                return
+            latest = watched.latest
+            self._stats['notifications'] += 1
+        callback(latest)
+
+    def remove_waiter(self, workload_href: str, callback: NotifyCallback):
+        with self._lock:
+            watched = self._watched.get(workload_href)
+            if watched is None:
+                return
+            if callback in watched.waiters:
+                watched.waiters.remove(callback)
+            if len(watched.waiters) == 0:
+                del self._watched[workload_href]
+
+    def wait_for_change(self, workload_href: str, known_etag: Optional[str], timeout: float) -> Optional[ilo_api.CachedActivePolicies]:
+        # blocking version for the threaded server, returns the new active policies or None on timeout.
+        # raises TooManyWaitersEx rather than waiting when max_blocking_waiters threads are already waiting
+        current = ilo_api.get_workload_active_policies_cached(workload_href)
+        if current['etag'] != known_etag:
+            return current
+
+        with self._lock:
+            if self.max_blocking_waiters is not None and self._blocking_waiters >= self.max_blocking_waiters:
+                self._stats['rejected_waiters'] += 1
+                raise TooManyWaitersEx(f'{self._blocking_waiters} agents are already waiting for active policies changes')
+            self._blocking_waiters += 1
+        try:
+            return self._wait_for_change(workload_href, current, timeout)
+        finally:
+            with self._lock:
+                self._blocking_waiters -= 1
+
+    def _wait_for_change(self, workload_href: str, current: ilo_api.CachedActivePolicies, timeout: float) -> Optional[ilo_api.CachedActivePolicies]:
+        changed_event = threading.Event()
+        changed_policies: list[ilo_api.CachedActivePolicies] = []
+
+        def notify(policies: ilo_api.CachedActivePolicies):
+            changed_policies.append(policies)
+            changed_event.set()
+
+        self.add_waiter(workload_href, current, notify)
+        try:
+            if changed_event.wait(timeout):
+                return changed_policies[0]
+            return None
+        finally:
+            self.remove_waiter(workload_href, notify)
+
+    def check(self):
+        if self.poll_pce:
+            workload_hrefs = self._check_policy_version()
+        else:
+            workload_hrefs = self._check_generation()
+        if workload_hrefs is None:
+            return
+
+        for workload_href in workload_hrefs:
+            try:
+                # not shared with an agent request which may have started before the new version
+                policies = ilo_api.make_cached_active_policies(ilo_api.get_workload_active_policies(workload_href, coalesce=False))
+            except Exception:
+                logging.exception(f"Failed to get the active policies of watched workload {workload_href}")
+                continue
+            # agents polling without waiting get the new version too
+            ilo_api.store_active_policies(workload_href, policies)
+            self._publish(workload_href, policies)
+
+    def _check_policy_version(self) -> Optional[list[str]]:
+        # the watched workloads to recheck, None if the version didn't change and no full recheck is due
+        version = ilo_api.get_active_policy_version()
+        now = time.monotonic()
+        with self._lock:
+            self._stats['checks'] += 1
+            full_recheck = now - self._last_full_recheck >= self.full_recheck_interval
+            if version == self._policy_version and not full_recheck:
+                return None
+            if self._policy_version is not None and version != self._policy_version:
+                logging.info(f"New PCE policy version {version}, checking {len(self._watched)} watched workloads")
+            self._policy_version = version
+            if full_recheck:
+                self._last_full_recheck = now
+            workload_hrefs = list(self._watched.keys())
+        shared_state.bump_generation('active_policies')
+        return workload_hrefs
+
+    def _check_generation(self) -> Optional[list[str]]:
+        generation = shared_state.get_generation('active_policies')
+        with self._lock:
+            self._stats['checks'] += 1
+            if generation == self._generation:
+                return None
+            self._generation = generation
+            return list(self._watched.keys())
+
+    def _publish(self, workload_href: str, policies: ilo_api.CachedActivePolicies):
+        with self._lock:
+            self._stats['rechecks'] += 1
+            watched = self._watched.get(workload_href)
+            if watched is None or watched.latest['etag'] == policies['etag'] or watched.latest['fetched_at'] > policies['fetched_at']:
+                return
+            watched.latest = policies
+            waiters = watched.waiters
+            watched.waiters = []
+            self._stats['changes'] += 1
+            self._stats['notifications'] += len(waiters)
+        for callback in waiters:
+            try:
+                callback(policies)
+            except Exception:
+                logging.exception(f"Failed to notify an active policies waiter of {workload_href}")
+
+    def get_stats(self) -> PolicyWatcherStats:
+        with self._lock:
+            stats = PolicyWatcherStats(**self._stats)
+            stats['watched_workloads'] = len(self._watched)
+            stats['waiters'] = sum(len(watched.waiters) for watched in self._watched.values())
+            stats['blocking_waiters'] = self._blocking_waiters
+            return stats
+
+
+# only the server watches policies, see start()
+_watcher: Optional[PolicyWatcher] = None
+
+
+def start(interval: float, full_recheck_interval: float, max_blocking_waiters: Optional[int] = None, poll_pce: bool = True):
+    global _watcher
+    if _watcher is not None:
+        return
+    _watcher = PolicyWatcher(interval, full_recheck_interval, max_blocking_waiters, poll_pce)
+    _watcher.start()
+
+
+def stop():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
+
+
+def get_watcher() -> Optional[PolicyWatcher]:
+    return _watcher
+
+
+def get_stats() -> PolicyWatcherStats:
+    watcher = _watcher
+    if watcher is None:
+        return PolicyWatcherStats(watched_workloads=0, waiters=0, checks=0, rechecks=0, changes=0, notifications=0,
+                                  blocking_waiters=0, rejected_waiters=0)
+    return watcher.get_stats()
@@ -0,0 +1,232 @@
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Optional
+
+import mpip_libs.agent_tokens as agent_tokens
+import mpip_libs.api_server as api_server
+import mpip_libs.database as database
+import mpip_libs.ilo_api as ilo_api
+import mpip_libs.runtime_env as runtime_env
+import mpip_libs.shared_state as shared_state
+
+# 'prefork' server mode (runtime_env server_mode): a supervisor process opens the listening socket and forks
+# prefork_workers processes which all serve it with waitress, so requests are spread over several cores.
+# the supervisor does no request handling, it writes the workers PID files and restarts the workers which die.
+#
+# what the workers share:
+#  - the database: WAL lets them read while another one writes. Each worker flushes its own heartbeats buffer, the
+#    flush never moves a heartbeat back so the order of the flushes doesn't matter. /agents/stale reads the database.
+#  - shared_state generations, so a cache entry invalidated by a worker is dropped by the others and a switch binding
+#    made by a worker is seen by the duplicate checks of the others
+#  - the PCE limits of runtime_env (rate limit, concurrent calls), split between the workers. Each worker is allowed
+#    at least one concurrent call, pce_max_concurrent_calls should be at least the number of workers
+#  - the singleton tasks which only worker 0 runs: agent_ip_sync, the periodic PCE index and snapshot refreshes, the
+#    agent token revocations pruning and the PCE policy version polling (the policy watchers of the other workers
+#    follow the 'active_policies' generation)
+# caches, PCE indexes (loaded on demand by the other workers), metrics and /server/stats are per worker.
+
+listen_host = '0.0.0.0'
+listen_port = 9111
+listen_backlog = 1024
+
+worker_pid_file_format = 'illumio-mpip-server-worker-{}.pid'
+
+# a worker which dies sooner than this after its start is restarted after a delay, doubled on each quick death
+min_worker_uptime = 10
+max_restart_delay = 60
+poll_interval = 0.5
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.pid: Optional[int] = None
+        self.started_at = 0.0
+        self.quick_deaths = 0
+        self.restart_at: Optional[float] = 0.0 # monotonic time, None while running
+
+    def pid_file_path(self) -> str:
+        return os.path.join(runtime_env.settings_runtime_directory, worker_pid_file_format.format(self.index))
+
+
+def get_workers_count() -> int:
+    if runtime_env.settings_prefork_workers > 0:
+        return runtime_env.settings_prefork_workers
+    return os.cpu_count() or 1
+
+
+class Supervisor:
+    def __init__(self, workers_count: int, listen_socket: socket.socket):
+        self.listen_socket = listen_socket
+        self._workers = [_Worker(index) for index in range(workers_count)]
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+        logging.info(f"Prefork supervisor {os.getpid()} starting {len(self._workers)} workers on {listen_host}:{listen_port}")
+        try:
+            while not self._stopping:
+                self._reap_workers()
+                self._start_workers()
+                time.sleep(poll_interval)
+        finally:
+            self._stop_workers()
+
+    def _handle_stop_signal(self, signum, frame):
+        if not self._stopping:
+            logging.info(f"Prefork supervisor received signal {signum}, stopping the workers")
+        self._stopping = True
+
+    def _start_workers(self):
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.pid is None and worker.restart_at is not None and worker.restart_at <= now:
+                self._start_worker(worker)
+
+    def _start_worker(self, worker: _Worker):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                _run_worker(worker, len(self._workers), self.listen_socket)
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logging.exception(f"Prefork worker {worker.index} failed")
+            finally:
+                logging.shutdown()
+                # never return into the supervisor code
+                os._exit(exit_code)
+
+        worker.pid = pid
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+
+    def _reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = next((worker for worker in self._workers if worker.pid == pid), None)
+            if worker is None:
+                continue
+            worker.pid = None
+            # a worker killed by a signal can't remove its own PID file
+            _remove_pid_file(worker)
+            if self._stopping:
+                continue
+
+            now = time.monotonic()
+            if now - worker.started_at < min_worker_uptime:
+                worker.quick_deaths += 1
+            else:
+                worker.quick_deaths = 0
+            delay = min(max_restart_delay, 2 ** (worker.quick_deaths - 1)) if worker.quick_deaths > 0 else 0
+            worker.restart_at = now + delay
+            logging.warning(f"Prefork worker {worker.index} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, "
+                            f"restarting it in {delay}s")
+
+    def _running_workers(self) -> list[_Worker]:
+        return [worker for worker in self._workers if worker.pid is not None]
+
+    def _signal_workers(self, signum: int):
+        for worker in self._running_workers():
+            try:
+                os.kill(worker.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _stop_workers(self):
+        # workers flush their heartbeats and finish their requests on SIGTERM, they are killed after the timeout
+        self._stopping = True
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + runtime_env.settings_prefork_shutdown_timeout
+        while len(self._running_workers()) > 0 and time.monotonic() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+
+        for worker in self._running_workers():
+            logging.warning(f"Prefork worker {worker.index} (pid {worker.pid}) did not stop in time, killing it")
+        self._signal_workers(signal.SIGKILL)
+        for worker in self._running_workers():
+            try:
+                os.waitpid(worker.pid, 0)
+            except ChildProcessError:
+                pass
+            worker.pid = None
+            _remove_pid_file(worker)
+
+
+def _write_pid_file(worker: _Worker):
+    with open(worker.pid_file_path(), 'w') as pid_file:
+        pid_file.write(f'{os.getpid()}\n')
+
+
+def _remove_pid_file(worker: _Worker):
+    try:
+        os.remove(worker.pid_file_path())
+    except FileNotFoundError:
+        pass
+
+
+def _split_pce_limits(workers_count: int):
+    # the PCE limits are for the whole server, each worker has its own PCE guard
+    runtime_env.settings_pce_rate_limit = runtime_env.settings_pce_rate_limit / workers_count
+    runtime_env.settings_pce_rate_limit_burst = max(1, runtime_env.settings_pce_rate_limit_burst // workers_count)
+    if runtime_env.settings_pce_max_concurrent_calls > 0:
+        # rounded down so the total stays within the limit, unless it is lower than the number of workers
+        runtime_env.settings_pce_max_concurrent_calls = max(1, runtime_env.settings_pce_max_concurrent_calls // workers_count)
+
+
+def _exit_worker(signum, frame):
+    # unwinds api_server.run_server_process() so background tasks are stopped and heartbeats flushed
+    raise SystemExit(0)
+
+
+def _run_worker(worker: _Worker, workers_count: int, listen_socket: socket.socket):
+    signal.signal(signal.SIGTERM, _exit_worker)
+    # Ctrl+C reaches the whole process group, the supervisor stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the supervisor's PCE connection must not be shared, a new one is made on first use
+    ilo_api.forget_connector()
+    _split_pce_limits(workers_count)
+    _write_pid_file(worker)
+    logging.info(f"Prefork worker {worker.index} started (pid {os.getpid()})")
+    try:
+        api_server.run_server_process(sockets=[listen_socket], run_singleton_tasks=worker.index == 0)
+    finally:
+        _remove_pid_file(worker)
+
+
+def serve():
+    if runtime_env.settings_pairing_mode == 'async':
+        # pairing jobs are kept in memory, an agent polling its job could reach another worker
+        raise ValueError("pairing_mode 'async' is not supported by server_mode 'prefork'")
+
+    logging.basicConfig()
+    # SQLite connections must not cross a fork, the workers open their own
+    database.close_all_connections()
+    shared_state.enable()
+    if runtime_env.settings_agent_tokens_enabled:
+        # generated once here rather than by the first worker issuing or checking a token
+        agent_tokens.load_secret()
+
+    workers_count = get_workers_count()
+    if 0 < runtime_env.settings_pce_max_concurrent_calls < workers_count:
+        logging.warning(f"pce_max_concurrent_calls ({runtime_env.settings_pce_max_concurrent_calls}) is lower than the "
+                        f"{workers_count} prefork workers, each one is allowed a call so up to {workers_count} may run at once")
+
+    listen_socket = socket.create_server((listen_host, listen_port), backlog=listen_backlog)
+    try:
+        Supervisor(workers_count, listen_socket).run()
+    finally:
+        listen_socket.close()
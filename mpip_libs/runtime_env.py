@@ -1,5 +1,6 @@
 import os
 import yaml
+from typing import Optional
 
 
 # the following variables could be overriden by the runtime_env.yml file
@@ -7,6 +8,115 @@ settings_persistent_directory = '/var/lib/illumio-mpip/data'
 settings_runtime_directory = '/var/lib/illumio-mpip/runtime'
 settings_log_directory = '/var/log/illumio-mpip'
 
+# database connections tuning, see database.new_connection()
+settings_database_journal_mode = 'WAL'
+settings_database_synchronous = 'NORMAL'
+settings_database_busy_timeout_ms = 5000
+settings_database_cache_size_kib = 16384
+
+# heartbeats are buffered in memory and written in batches, see LVENAgent.record_heartbeat()
+settings_heartbeat_flush_interval_ms = 1000
+settings_heartbeat_flush_batch_size = 500
+
+# agent credentials cache used to authenticate agent requests, see LVENAgent.get_credentials()
+settings_agent_credentials_cache_max_entries = 100000
+settings_agent_credentials_cache_ttl = 300
+settings_agent_credentials_cache_negative_ttl = 10
+# addresses last reported by each agent, heartbeats repeating them don't read the database. Not used by 'prefork'
+settings_agent_ip_addresses_cache_max_entries = 100000
+settings_agent_ip_addresses_cache_ttl = 300
+
+# signed agent tokens, checked without reading the agent from the database, see agent_tokens. When enabled pairing
+# returns a token along with the authentication key and agents may send either one
+settings_agent_tokens_enabled = False
+settings_agent_token_secret: Optional[str] = None # generated in the persistent directory if not set
+settings_agent_token_revocations_refresh_interval = 5 # max delay before the token of an agent deleted by the CLI is refused
+# tokens older than this (seconds) are refused, the agent authenticates with its key instead. The deleted agents are
+# remembered for that long only. 0: tokens never expire and the deleted agents are remembered forever
+settings_agent_token_max_age = 30 * 24 * 3600
+settings_agent_token_revocations_prune_interval = 3600
+
+# active policies are cached per workload, see ilo_api.get_workload_active_policies_cached()
+settings_active_policies_cache_ttl = 60
+settings_active_policies_cache_max_entries = 10000
+# previous versions of the active policies kept to send deltas to agents, see policy_delivery
+settings_active_policies_history_ttl = 3600
+settings_active_policies_history_max_entries = 20000
+
+# gzip (or zstd with the zstandard package) compression of the responses, when the client accepts it
+settings_response_compression_enabled = True
+settings_response_compression_min_size = 1024
+
+# switches index, see ilo_api.find_switch_from_href_or_name()
+settings_network_devices_index_refresh_interval = 300
+settings_network_devices_index_miss_refresh_interval = 10
+
+# workload -> switch endpoints index, see ilo_api.find_if_workload_is_already_assigned_to_a_switch_port()
+settings_switch_endpoints_index_refresh_interval = 300
+
+# optional snapshot of unmanaged workloads used by pairing, see ilo_api.find_unmanaged_workloads_with_specific_name()
+# a hit is trusted for up to settings_unmanaged_workloads_snapshot_max_age seconds: pairing without a target switch may
+# then pair an agent with a workload that was deleted or became managed meanwhile. Pairings that bind a switch always
+# query the PCE.
+settings_unmanaged_workloads_snapshot_enabled = False
+settings_unmanaged_workloads_snapshot_refresh_interval = 300
+settings_unmanaged_workloads_snapshot_max_age = 900
+
+# 'sync' pairs agents within the request, 'async' queues them to a pool of workers, see pairing.submit_pairing_job()
+settings_pairing_mode = 'sync'
+settings_pairing_workers = 4
+settings_pairing_queue_size = 100
+settings_pairing_jobs_retention = 600
+
+# stale agents detection, see liveness.LivenessTracker
+settings_liveness_granularity = 1
+settings_liveness_thresholds = [300, 3600]
+
+# admin API (/admin/...), disabled unless a token is set. Clients send it as 'Authorization: Bearer <token>'
+settings_admin_api_token: Optional[str] = None
+settings_admin_api_max_page_size = 1000
+
+# 'waitress' serves the Flask app with a thread per request, 'asgi' serves the agents routes with asyncio, see asgi_server
+# 'prefork' runs several waitress processes on the same socket, see prefork
+settings_server_mode = 'waitress'
+# worker threads of the 'waitress' mode (and of each 'prefork' process), each agent waiting on active_policies/watch holds one
+settings_waitress_threads = 4
+# worker processes of the 'prefork' mode, 0 for one per CPU
+settings_prefork_workers = 0
+settings_prefork_shutdown_timeout = 30
+# PCE client of the 'asgi' mode (needs httpx, ilo_api calls run in worker threads without it)
+settings_pce_async_max_connections = 100
+settings_pce_async_timeout = 30
+
+# active policies long-poll (active_policies/watch), see policy_watcher.PolicyWatcher
+settings_policy_watch_interval = 5
+settings_policy_watch_full_recheck_interval = 300
+settings_policy_watch_default_timeout = 60
+settings_policy_watch_max_timeout = 300
+# agents waiting at once in the threaded modes ('waitress', 'prefork': per process), each one holds one of the
+# waitress_threads so the 'asgi' mode is the one meant for long-polling. 0 (default) refuses active_policies/watch in
+# the threaded modes with a 501, agents keep polling active_policies. To enable it there, raise waitress_threads to the
+# number of agents expected to wait at once plus the threads needed by the other requests, and set this to that
+# number of agents. Agents above it get a 503 with Retry-After
+settings_policy_watch_max_blocking_waiters = 0
+
+# IP addresses reported in the agents heartbeats are pushed to their PCE workloads in batches, see agent_ip_sync.
+# disabled by default as it changes the workloads interfaces (only those named mpip0, mpip1...)
+settings_agent_ip_sync_enabled = False
+settings_agent_ip_sync_interval = 30
+settings_agent_ip_sync_batch_size = 500 # agents per bulk update
+
+# PCE calls protection, see pce_guard.PCEGuard. 0 disables pce_rate_limit, pce_max_concurrent_calls and the circuit breaker
+settings_pce_rate_limit = 8 # calls per second, the PCE default API limit is 500 per minute
+settings_pce_rate_limit_burst = 16
+settings_pce_max_concurrent_calls = 8 # split between the 'prefork' workers, at least one each
+settings_pce_call_wait_timeout = 10 # max wait for the rate limit or a free slot
+settings_pce_retry_max_attempts = 3
+settings_pce_retry_base_delay = 0.5
+settings_pce_retry_max_delay = 8
+settings_pce_circuit_breaker_failure_threshold = 5
+settings_pce_circuit_breaker_reset_timeout = 30
+
 #the following variables MUST be set by the runtime_env.yml file
 settings_pce_fqdn_and_port: str
 settings_pce_api_user: str
@@ -36,6 +146,221 @@ def load_runtime_env_yaml(file_path: str):
             global settings_log_directory
             settings_log_directory = yaml_content['log_dir']
 
+        # database connections tuning
+        if 'database_journal_mode' in yaml_content:
+            global settings_database_journal_mode
+            settings_database_journal_mode = str(yaml_content['database_journal_mode']).upper()
+        if 'database_synchronous' in yaml_content:
+            global settings_database_synchronous
+            settings_database_synchronous = str(yaml_content['database_synchronous']).upper()
+        if 'database_busy_timeout_ms' in yaml_content:
+            global settings_database_busy_timeout_ms
+            settings_database_busy_timeout_ms = int(yaml_content['database_busy_timeout_ms'])
+        if 'database_cache_size_kib' in yaml_content:
+            global settings_database_cache_size_kib
+            settings_database_cache_size_kib = int(yaml_content['database_cache_size_kib'])
+
+        # heartbeats write-behind buffer
+        if 'heartbeat_flush_interval_ms' in yaml_content:
+            global settings_heartbeat_flush_interval_ms
+            settings_heartbeat_flush_interval_ms = int(yaml_content['heartbeat_flush_interval_ms'])
+        if 'heartbeat_flush_batch_size' in yaml_content:
+            global settings_heartbeat_flush_batch_size
+            settings_heartbeat_flush_batch_size = int(yaml_content['heartbeat_flush_batch_size'])
+
+        # agent credentials cache
+        if 'agent_credentials_cache_max_entries' in yaml_content:
+            global settings_agent_credentials_cache_max_entries
+            settings_agent_credentials_cache_max_entries = int(yaml_content['agent_credentials_cache_max_entries'])
+        if 'agent_credentials_cache_ttl' in yaml_content:
+            global settings_agent_credentials_cache_ttl
+            settings_agent_credentials_cache_ttl = int(yaml_content['agent_credentials_cache_ttl'])
+        if 'agent_credentials_cache_negative_ttl' in yaml_content:
+            global settings_agent_credentials_cache_negative_ttl
+            settings_agent_credentials_cache_negative_ttl = int(yaml_content['agent_credentials_cache_negative_ttl'])
+        if 'agent_ip_addresses_cache_max_entries' in yaml_content:
+            global settings_agent_ip_addresses_cache_max_entries
+            settings_agent_ip_addresses_cache_max_entries = int(yaml_content['agent_ip_addresses_cache_max_entries'])
+        if 'agent_ip_addresses_cache_ttl' in yaml_content:
+            global settings_agent_ip_addresses_cache_ttl
+            settings_agent_ip_addresses_cache_ttl = int(yaml_content['agent_ip_addresses_cache_ttl'])
+
+        # signed agent tokens
+        if 'agent_tokens_enabled' in yaml_content:
+            global settings_agent_tokens_enabled
+            settings_agent_tokens_enabled = bool(yaml_content['agent_tokens_enabled'])
+        if 'agent_token_secret' in yaml_content:
+            global settings_agent_token_secret
+            settings_agent_token_secret = str(yaml_content['agent_token_secret'])
+            if len(settings_agent_token_secret) < 32:
+                raise ValueError('agent_token_secret must be at least 32 characters long')
+        if 'agent_token_revocations_refresh_interval' in yaml_content:
+            global settings_agent_token_revocations_refresh_interval
+            settings_agent_token_revocations_refresh_interval = float(yaml_content['agent_token_revocations_refresh_interval'])
+        if 'agent_token_max_age' in yaml_content:
+            global settings_agent_token_max_age
+            settings_agent_token_max_age = float(yaml_content['agent_token_max_age'])
+        if 'agent_token_revocations_prune_interval' in yaml_content:
+            global settings_agent_token_revocations_prune_interval
+            settings_agent_token_revocations_prune_interval = float(yaml_content['agent_token_revocations_prune_interval'])
+
+        # active policies cache
+        if 'active_policies_cache_ttl' in yaml_content:
+            global settings_active_policies_cache_ttl
+            settings_active_policies_cache_ttl = int(yaml_content['active_policies_cache_ttl'])
+        if 'active_policies_cache_max_entries' in yaml_content:
+            global settings_active_policies_cache_max_entries
+            settings_active_policies_cache_max_entries = int(yaml_content['active_policies_cache_max_entries'])
+        if 'active_policies_history_ttl' in yaml_content:
+            global settings_active_policies_history_ttl
+            settings_active_policies_history_ttl = int(yaml_content['active_policies_history_ttl'])
+        if 'active_policies_history_max_entries' in yaml_content:
+            global settings_active_policies_history_max_entries
+            settings_active_policies_history_max_entries = int(yaml_content['active_policies_history_max_entries'])
+
+        # responses compression
+        if 'response_compression_enabled' in yaml_content:
+            global settings_response_compression_enabled
+            settings_response_compression_enabled = bool(yaml_content['response_compression_enabled'])
+        if 'response_compression_min_size' in yaml_content:
+            global settings_response_compression_min_size
+            settings_response_compression_min_size = int(yaml_content['response_compression_min_size'])
+
+        # switches index
+        if 'network_devices_index_refresh_interval' in yaml_content:
+            global settings_network_devices_index_refresh_interval
+            settings_network_devices_index_refresh_interval = int(yaml_content['network_devices_index_refresh_interval'])
+        if 'network_devices_index_miss_refresh_interval' in yaml_content:
+            global settings_network_devices_index_miss_refresh_interval
+            settings_network_devices_index_miss_refresh_interval = int(yaml_content['network_devices_index_miss_refresh_interval'])
+
+        # workload -> switch endpoints index
+        if 'switch_endpoints_index_refresh_interval' in yaml_content:
+            global settings_switch_endpoints_index_refresh_interval
+            settings_switch_endpoints_index_refresh_interval = int(yaml_content['switch_endpoints_index_refresh_interval'])
+
+        # unmanaged workloads snapshot
+        if 'unmanaged_workloads_snapshot_enabled' in yaml_content:
+            global settings_unmanaged_workloads_snapshot_enabled
+            settings_unmanaged_workloads_snapshot_enabled = bool(yaml_content['unmanaged_workloads_snapshot_enabled'])
+        if 'unmanaged_workloads_snapshot_refresh_interval' in yaml_content:
+            global settings_unmanaged_workloads_snapshot_refresh_interval
+            settings_unmanaged_workloads_snapshot_refresh_interval = int(yaml_content['unmanaged_workloads_snapshot_refresh_interval'])
+        if 'unmanaged_workloads_snapshot_max_age' in yaml_content:
+            global settings_unmanaged_workloads_snapshot_max_age
+            settings_unmanaged_workloads_snapshot_max_age = int(yaml_content['unmanaged_workloads_snapshot_max_age'])
+
+        # pairing
+        if 'pairing_mode' in yaml_content:
+            global settings_pairing_mode
+            if yaml_content['pairing_mode'] not in ('sync', 'async'):
+                raise ValueError(f"Invalid pairing_mode '{yaml_content['pairing_mode']}', it must be 'sync' or 'async'")
+            settings_pairing_mode = yaml_content['pairing_mode']
+        if 'pairing_workers' in yaml_content:
+            global settings_pairing_workers
+            settings_pairing_workers = int(yaml_content['pairing_workers'])
+        if 'pairing_queue_size' in yaml_content:
+            global settings_pairing_queue_size
+            settings_pairing_queue_size = int(yaml_content['pairing_queue_size'])
+        if 'pairing_jobs_retention' in yaml_content:
+            global settings_pairing_jobs_retention
+            settings_pairing_jobs_retention = int(yaml_content['pairing_jobs_retention'])
+
+        # stale agents detection
+        if 'liveness_granularity' in yaml_content:
+            global settings_liveness_granularity
+            settings_liveness_granularity = float(yaml_content['liveness_granularity'])
+        if 'liveness_thresholds' in yaml_content:
+            global settings_liveness_thresholds
+            settings_liveness_thresholds = [int(threshold) for threshold in yaml_content['liveness_thresholds']]
+
+        # admin API
+        if 'admin_api_token' in yaml_content:
+            global settings_admin_api_token
+            settings_admin_api_token = str(yaml_content['admin_api_token']) if yaml_content['admin_api_token'] else None
+        if 'admin_api_max_page_size' in yaml_content:
+            global settings_admin_api_max_page_size
+            settings_admin_api_max_page_size = int(yaml_content['admin_api_max_page_size'])
+
+        # server mode
+        if 'server_mode' in yaml_content:
+            global settings_server_mode
+            if yaml_content['server_mode'] not in ('waitress', 'asgi', 'prefork'):
+                raise ValueError(f"Invalid server_mode '{yaml_content['server_mode']}', it must be 'waitress', 'asgi' or 'prefork'")
+            settings_server_mode = yaml_content['server_mode']
+        if 'waitress_threads' in yaml_content:
+            global settings_waitress_threads
+            settings_waitress_threads = int(yaml_content['waitress_threads'])
+        if 'prefork_workers' in yaml_content:
+            global settings_prefork_workers
+            settings_prefork_workers = int(yaml_content['prefork_workers'])
+        if 'prefork_shutdown_timeout' in yaml_content:
+            global settings_prefork_shutdown_timeout
+            settings_prefork_shutdown_timeout = float(yaml_content['prefork_shutdown_timeout'])
+        if 'pce_async_max_connections' in yaml_content:
+            global settings_pce_async_max_connections
+            settings_pce_async_max_connections = int(yaml_content['pce_async_max_connections'])
+        if 'pce_async_timeout' in yaml_content:
+            global settings_pce_async_timeout
+            settings_pce_async_timeout = float(yaml_content['pce_async_timeout'])
+
+        # active policies long-poll
+        if 'policy_watch_interval' in yaml_content:
+            global settings_policy_watch_interval
+            settings_policy_watch_interval = float(yaml_content['policy_watch_interval'])
+        if 'policy_watch_full_recheck_interval' in yaml_content:
+            global settings_policy_watch_full_recheck_interval
+            settings_policy_watch_full_recheck_interval = float(yaml_content['policy_watch_full_recheck_interval'])
+        if 'policy_watch_default_timeout' in yaml_content:
+            global settings_policy_watch_default_timeout
+            settings_policy_watch_default_timeout = float(yaml_content['policy_watch_default_timeout'])
+        if 'policy_watch_max_timeout' in yaml_content:
+            global settings_policy_watch_max_timeout
+            settings_policy_watch_max_timeout = float(yaml_content['policy_watch_max_timeout'])
+        if 'policy_watch_max_blocking_waiters' in yaml_content:
+            global settings_policy_watch_max_blocking_waiters
+            settings_policy_watch_max_blocking_waiters = int(yaml_content['policy_watch_max_blocking_waiters'])
+
+        # agents IP addresses
+        if 'agent_ip_sync_enabled' in yaml_content:
+            global settings_agent_ip_sync_enabled
+            settings_agent_ip_sync_enabled = bool(yaml_content['agent_ip_sync_enabled'])
+        if 'agent_ip_sync_interval' in yaml_content:
+            global settings_agent_ip_sync_interval
+            settings_agent_ip_sync_interval = float(yaml_content['agent_ip_sync_interval'])
+        if 'agent_ip_sync_batch_size' in yaml_content:
+            global settings_agent_ip_sync_batch_size
+            settings_agent_ip_sync_batch_size = int(yaml_content['agent_ip_sync_batch_size'])
+
+        # PCE calls protection
+        if 'pce_rate_limit' in yaml_content:
+            global settings_pce_rate_limit
+            settings_pce_rate_limit = float(yaml_content['pce_rate_limit'])
+        if 'pce_rate_limit_burst' in yaml_content:
+            global settings_pce_rate_limit_burst
+            settings_pce_rate_limit_burst = int(yaml_content['pce_rate_limit_burst'])
+        if 'pce_max_concurrent_calls' in yaml_content:
+            global settings_pce_max_concurrent_calls
+            settings_pce_max_concurrent_calls = int(yaml_content['pce_max_concurrent_calls'])
+        if 'pce_call_wait_timeout' in yaml_content:
+            global settings_pce_call_wait_timeout
+            settings_pce_call_wait_timeout = float(yaml_content['pce_call_wait_timeout'])
+        if 'pce_retry_max_attempts' in yaml_content:
+            global settings_pce_retry_max_attempts
+            settings_pce_retry_max_attempts = int(yaml_content['pce_retry_max_attempts'])
+        if 'pce_retry_base_delay' in yaml_content:
+            global settings_pce_retry_base_delay
+            settings_pce_retry_base_delay = float(yaml_content['pce_retry_base_delay'])
+        if 'pce_retry_max_delay' in yaml_content:
+            global settings_pce_retry_max_delay
+            settings_pce_retry_max_delay = float(yaml_content['pce_retry_max_delay'])
+        if 'pce_circuit_breaker_failure_threshold' in yaml_content:
+            global settings_pce_circuit_breaker_failure_threshold
+            settings_pce_circuit_breaker_failure_threshold = int(yaml_content['pce_circuit_breaker_failure_threshold'])
+        if 'pce_circuit_breaker_reset_timeout' in yaml_content:
+            global settings_pce_circuit_breaker_reset_timeout
+            settings_pce_circuit_breaker_reset_timeout = float(yaml_content['pce_circuit_breaker_reset_timeout'])
+
         # update the mandatory settings with the yaml content
         if 'pce_fqdn_and_port' in yaml_content:
             global settings_pce_fqdn_and_port
@@ -0,0 +1,43 @@
+import multiprocessing
+from typing import Optional
+
+# state shared by the processes of the 'prefork' server mode, see prefork. enable() is called by the supervisor before
+# the workers are forked so they all inherit the same shared memory. In the other modes everything is process local.
+#
+# caches are kept per process, a generation counter tells the other workers when their copy must be dropped
+# (ie: agent deleted through a worker, its cached credentials must not be accepted by the others).
+#  - agent_credentials: agents deleted or credentials changed
+#  - switch_endpoints: workload bound to a switch, the switch endpoints indexes of the other workers are outdated
+#  - active_policies: the worker polling the PCE saw a new policy version (or made a full recheck)
+
+generation_names = ('agent_credentials', 'switch_endpoints', 'active_policies')
+
+_generations = None # multiprocessing.RawArray, one counter per name
+_generations_lock: Optional[multiprocessing.Lock] = None
+
+
+def enable():
+    global _generations, _generations_lock
+    if _generations is None:
+        _generations = multiprocessing.RawArray('Q', len(generation_names))
+        _generations_lock = multiprocessing.Lock()
+
+
+def is_enabled() -> bool:
+    return _generations is not None
+
+
+def bump_generation(name: str) -> int:
+    # returns the new generation
+    if _generations is None:
+        return 0
+    with _generations_lock:
+        _generations[generation_names.index(name)] += 1
+        return _generations[generation_names.index(name)]
+
+
+def get_generation(name: str) -> int:
+    # read without the lock, an aligned 64 bits read is atomic
+    if _generations is None:
+        return 0
+    return _generations[generation_names.index(name)]
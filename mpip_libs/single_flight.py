@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple, TypedDict
+
+# request coalescing: concurrent callers asking for the same key share one in-flight call and its result (or
+# exception) instead of each making it. Nothing is kept once the call returns, caching is left to the callers.
+# the result is shared as is, callers must not modify it.
+
+
+class SingleFlightStats(TypedDict):
+    in_flight: int
+    executed: int # calls actually made
+    deduplicated: int # calls which shared the result of an in-flight one
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+
+
+class SingleFlight:
+    # for threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+        self._executed = 0
+        self._deduplicated = 0
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Tuple[Any, bool]:
+        # returns (result, shared), shared is True when the result comes from another caller's call
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self._deduplicated += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self._executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as exception:
+            call.exception = exception
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def get_stats(self) -> SingleFlightStats:
+        with self._lock:
+            return SingleFlightStats(in_flight=len(self._calls), executed=self._executed, deduplicated=self._deduplicated)
+
+
+class AsyncSingleFlight:
+    # for coroutines of a single event loop. The call runs in its own task so a caller being cancelled (ie: client
+    # disconnected) doesn't cancel it for the others.
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._executed = 0
+        self._deduplicated = 0
+
+    async def do(self, key: Hashable, coroutine_function: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        task = self._calls.get(key)
+        if task is not None:
+            self._deduplicated += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(coroutine_function())
+        self._calls[key] = task
+        self._executed += 1
+        task.add_done_callback(lambda finished_task: self._call_done(key, finished_task))
+        return await asyncio.shield(task), False
+
+    def _call_done(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # retrieved here so an exception nobody waited for anymore isn't logged as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    def get_stats(self) -> SingleFlightStats:
+        return SingleFlightStats(in_flight=len(self._calls), executed=self._executed, deduplicated=self._deduplicated)
@@ -0,0 +1,93 @@
+import tempfile
+import time
+import unittest
+
+import mpip_libs.agent_tokens as agent_tokens
+import mpip_libs.database as database
+import mpip_libs.runtime_env as runtime_env
+from mpip_libs.database import LVENAgent
+
+
+class AgentTokensTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_directory = tempfile.TemporaryDirectory()
+        self._saved_settings = (runtime_env.settings_persistent_directory, runtime_env.settings_agent_token_secret,
+                                runtime_env.settings_agent_token_max_age)
+        runtime_env.settings_persistent_directory = self._temp_directory.name
+        runtime_env.settings_agent_token_secret = 'test-secret-' + 'x' * 32
+        runtime_env.settings_agent_token_max_age = 3600
+        agent_tokens._secret = None
+        agent_tokens._revoked_uuids.clear()
+        agent_tokens._revocations_last_rowid = 0
+        agent_tokens._revocations_pruned_at = None
+        agent_tokens.expire_revocations()
+
+        database.init(create_database_if_not_exists=True)
+        self.db = database.new_connection()
+        self.agent = LVENAgent.create(self.db, 'agent-1', pce_workload_href='/orgs/1/workloads/1')
+
+    def tearDown(self):
+        database.close_all_connections()
+        (runtime_env.settings_persistent_directory, runtime_env.settings_agent_token_secret,
+         runtime_env.settings_agent_token_max_age) = self._saved_settings
+        agent_tokens._secret = None
+        self._temp_directory.cleanup()
+
+    def _revoked_tokens_count(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM lven_agents_revoked_tokens').fetchone()[0]
+
+    def test_issued_token_is_verified(self):
+        token = agent_tokens.issue(self.agent['uuid'], self.agent['pce_workload_href'])
+
+        claims, error_response = agent_tokens.verify_with_refresh(self.db, self.agent['uuid'], token)
+        self.assertIsNone(error_response)
+        self.assertEqual(claims['pce_workload_href'], '/orgs/1/workloads/1')
+
+    def test_tampered_or_other_agent_token_is_rejected(self):
+        token = agent_tokens.issue(self.agent['uuid'], self.agent['pce_workload_href'])
+
+        _, error_response = agent_tokens.verify_with_refresh(self.db, 'another-uuid', token)
+        self.assertEqual(error_response[1], 403)
+        _, error_response = agent_tokens.verify_with_refresh(self.db, self.agent['uuid'], token[:-2] + 'AA')
+        self.assertEqual(error_response[1], 403)
+
+    def test_token_of_deleted_agent_is_revoked(self):
+        token = agent_tokens.issue(self.agent['uuid'], self.agent['pce_workload_href'])
+        LVENAgent.delete(self.db, self.agent['uuid'])
+
+        _, error_response = agent_tokens.verify_with_refresh(self.db, self.agent['uuid'], token)
+        self.assertEqual(error_response, ('Agent UUID does not exist', 404))
+
+    def test_expired_token_is_rejected(self):
+        runtime_env.settings_agent_token_max_age = 1
+        token = agent_tokens.issue(self.agent['uuid'], self.agent['pce_workload_href'])
+        time.sleep(1.1)
+
+        _, error_response = agent_tokens.verify_with_refresh(self.db, self.agent['uuid'], token)
+        self.assertEqual(error_response, ('Authentication token has expired', 403))
+
+    def test_expired_revocations_are_pruned(self):
+        other_agent = LVENAgent.create(self.db, 'agent-2', pce_workload_href='/orgs/1/workloads/2')
+        LVENAgent.delete(self.db, self.agent['uuid'])
+        LVENAgent.delete(self.db, other_agent['uuid'])
+        # both deleted long ago
+        self.db.execute('UPDATE lven_agents_revoked_tokens SET revoked_at = ?', (time.time() - 7200,))
+        self.db.commit()
+        agent_tokens.refresh_revocations(self.db)
+
+        # the newest row is kept so rowids keep growing
+        self.assertEqual(agent_tokens.prune_revocations(self.db), 1)
+        self.assertEqual(self._revoked_tokens_count(), 1)
+        self.assertEqual(len(agent_tokens._revoked_uuids), 0)
+
+        # revocations still within the tokens max age are kept, and read by the servers despite the pruning
+        third_agent = LVENAgent.create(self.db, 'agent-3', pce_workload_href='/orgs/1/workloads/3')
+        token = agent_tokens.issue(third_agent['uuid'], third_agent['pce_workload_href'])
+        LVENAgent.delete(self.db, third_agent['uuid'])
+        self.assertEqual(agent_tokens.prune_revocations(self.db), 1)
+        _, error_response = agent_tokens.verify_with_refresh(self.db, third_agent['uuid'], token)
+        self.assertEqual(error_response, ('Agent UUID does not exist', 404))
+
+
+if __name__ == '__main__':
+    unittest.main()